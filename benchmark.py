@@ -0,0 +1,458 @@
+"""
+Offline benchmark for update_data.py
+------------------------------------
+Runs update_data.py end to end against local stand-ins for TMDb, TVMaze and
+Wikidata, so crawler performance can be measured and regression-tested
+without spending real API quota.
+
+Each upstream gets its own local HTTP server (its own host:port, so the
+per-host rate limiters behave as they do in production). Responses are
+synthetic and deterministic, or replayed from fixtures recorded against the
+real APIs. Every server can inject latency, 429s and 5xx errors.
+
+Usage:
+  python benchmark.py                                   # synthetic upstream
+  python benchmark.py --latency-ms 80 --error-429 0.05 --error-5xx 0.02
+  python benchmark.py --runs 2                          # cold run, then warm run
+  python benchmark.py --fixtures fixtures --record      # proxy real APIs, save responses (needs real keys)
+  python benchmark.py --fixtures fixtures               # replay saved responses
+  python benchmark.py --baseline old.json --max-slowdown 1.2   # exit 1 on regression
+
+Results (wall-clock, requests/sec, retries, peak RSS, output size) are
+printed and written as JSON to --output.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+import requests
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "update_data.py")
+
+# service -> (real base URL, update_data.py env var that overrides it)
+SERVICES = {
+    "tmdb": ("https://api.themoviedb.org/3", "TMDB_BASE_URL"),
+    "tvmaze": ("https://api.tvmaze.com", "TVMAZE_BASE_URL"),
+    "wikidata": ("https://query.wikidata.org/sparql", "WIKIDATA_URL"),
+}
+_SECRET_PARAMS = {"api_key"}
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.services = {name: {"requests": 0, "injected_429": 0, "injected_5xx": 0, "bytes": 0,
+                                "fixture_hits": 0, "recorded": 0, "synthetic": 0}
+                         for name in SERVICES}
+
+    def add(self, service, key, amount=1):
+        with self.lock:
+            self.services[service][key] += amount
+
+    def snapshot(self):
+        with self.lock:
+            return {name: dict(counts) for name, counts in self.services.items()}
+
+
+# Synthetic upstream. Everything is derived from IDs and paths, so two runs
+# see identical data and deltas only reflect crawler behaviour.
+def _title(i, tv=False):
+    rng = random.Random(i * 2 + tv)
+    return {
+        "id": i,
+        ("name" if tv else "title"): f"{'Show' if tv else 'Film'} {i}",
+        ("first_air_date" if tv else "release_date"): f"{1950 + i % 75}-{1 + i % 12:02d}-01",
+        "overview": f"Synthetic overview for title {i}. " * 3,
+        "poster_path": f"/p{i}.jpg",
+        "vote_average": round(rng.uniform(4, 9), 1),
+    }
+
+
+def _tmdb_details(i, tv):
+    rng = random.Random(i * 7 + tv)
+    details = _title(i, tv)
+    regions = ["US", "GB", "IN", "DE", "FR", "JP", "BR", "CA"][:rng.randint(2, 8)]
+    details.update({
+        "genres": [{"id": g, "name": f"Genre {g}"} for g in rng.sample(range(20), 3)],
+        "production_countries": [{"iso_3166_1": regions[0]}],
+        "origin_country": [regions[0]],
+        "budget": rng.randint(0, 10 ** 8), "revenue": rng.randint(0, 10 ** 9),
+        "created_by": [{"name": f"Creator {i % 97}"}],
+        "networks": [{"name": f"Network {i % 13}"}] if tv else [],
+        "production_companies": [{"name": f"Studio {i % 41}"}],
+        "credits": {
+            "cast": [{"name": f"Actor {(i + k) % 500}", "character": f"Role {k}", "profile_path": f"/a{k}.jpg"}
+                     for k in range(15)],
+            "crew": [{"name": f"Director {i % 300}", "job": "Director"}, {"name": f"Writer {i % 200}", "job": "Screenplay"}],
+        },
+        "videos": {"results": [{"site": "YouTube", "key": f"v{i}_{k}", "type": "Trailer", "official": k == 0,
+                                "name": "Official Trailer" if k == 0 else f"Clip {k}"} for k in range(4)]},
+        "watch/providers": {"results": {
+            region: {"link": f"https://example.org/{i}/{region}",
+                     "flatrate": [{"provider_id": 8, "provider_name": "Netflix", "logo_path": "/n.jpg"}]}
+            for region in regions
+        }},
+        "external_ids": {"imdb_id": f"tt{i:07d}", "tvdb_id": i if tv else None, "wikidata_id": None},
+    })
+    return details
+
+
+def synth_tmdb(path, query, args):
+    segments = path.strip("/").split("/")
+    if len(segments) == 2 and segments[0] in ("movie", "tv") and segments[1].isdigit():
+        return 200, "application/json", _tmdb_details(int(segments[1]), segments[0] == "tv")
+    if segments == ["movie", "latest"]:
+        return 200, "application/json", _title(999999)
+    if len(segments) == 2 and segments[1] == "changes":
+        # Every 7th ID of the first few thousand changed
+        ids = list(range(7, 3000, 7))
+        page = int(query.get("page", 1))
+        chunk = ids[(page - 1) * 100:page * 100]
+        return 200, "application/json", {"results": [{"id": i, "adult": False} for i in chunk],
+                                         "page": page, "total_pages": (len(ids) + 99) // 100}
+    page = int(query.get("page", 1))
+    tv = "tv" in segments
+    if page > args.tmdb_pages:
+        return 200, "application/json", {"page": page, "results": [], "total_pages": args.tmdb_pages}
+    # Lists overlap a little, like the real categories do
+    base = (zlib.crc32(path.encode()) % 16) * 30
+    results = [_title(base + page * 20 + k, tv) for k in range(20)]
+    return 200, "application/json", {"page": page, "results": results, "total_pages": args.tmdb_pages}
+
+
+def synth_tvmaze(path, query, args):
+    def show(i):
+        return {"id": i, "name": f"Show {i}", "premiered": f"{1960 + i % 60}-01-01",
+                "summary": f"<p>Synthetic show {i}</p>", "image": {"medium": f"https://example.org/{i}.jpg"},
+                "rating": {"average": round(random.Random(i).uniform(4, 9), 1)}, "genres": ["Drama"],
+                "externals": {"imdb": f"tt{i + 5000000:07d}", "thetvdb": i}, "updated": 1700000000 + i}
+
+    if path == "/shows":
+        page = int(query.get("page", 0))
+        if page >= args.tvmaze_pages:
+            return 404, "application/json", {"name": "Not Found", "status": 404}
+        return 200, "application/json", [show(page * 250 + k) for k in range(250)]
+    match = re.fullmatch(r"/shows/(\d+)", path)
+    if match:
+        return 200, "application/json", show(int(match.group(1)))
+    if path == "/updates/shows":
+        now = int(time.time())
+        return 200, "application/json", {str(i): now for i in range(0, args.tvmaze_pages * 250, 50)}
+    return 404, "application/json", {"name": "Not Found", "status": 404}
+
+
+def synth_wikidata(path, query, args):
+    text = query.get("query", "")
+    after = re.search(r"FILTER\(\?num > (\d+)\)", text)
+    limit = re.search(r"LIMIT (\d+)", text)
+    after = int(after.group(1)) if after else 0
+    limit = int(limit.group(1)) if limit else 50
+    nums = [n for n in range(after + 1, args.wikidata_films + 1)][:limit]
+    lines = ["?num\t?movieLabel\t?posterSample\t?minDate\t?imdbSample\t?tmdbMovieSample\t?tmdbTvSample\t?genres\t?directors"]
+    for n in nums:
+        lines.append(
+            f'{n}\t"Film {n}"@en\t<https://commons.example.org/{n}.jpg>\t'
+            f'"{1950 + n % 75}-01-01T00:00:00Z"^^<http://www.w3.org/2001/XMLSchema#dateTime>\t'
+            f'"tt{n:07d}"\t"{n}"\t\t"drama film|comedy film"\t"Director {n % 300}"'
+        )
+    return 200, "text/tab-separated-values", "\n".join(lines) + "\n"
+
+
+SYNTHETIC = {"tmdb": synth_tmdb, "tvmaze": synth_tvmaze, "wikidata": synth_wikidata}
+
+
+# Fixtures: one JSON file per (service, path, query without api_key)
+def fixture_path(fixtures, service, path, query):
+    clean = urlencode(sorted((k, v) for k, v in query.items() if k not in _SECRET_PARAMS))
+    digest = hashlib.sha1(f"{path}?{clean}".encode()).hexdigest()
+    return os.path.join(fixtures, service, digest + ".json")
+
+
+def load_fixture(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def record_fixture(service, path, query, headers, fixture):
+    base, _ = SERVICES[service]
+    res = requests.get(base + path if service != "wikidata" else base, params=query,
+                       headers={k: v for k, v in headers.items() if k.lower() in ("accept", "user-agent")},
+                       timeout=120)
+    entry = {"status": res.status_code, "content_type": res.headers.get("Content-Type", "application/json"),
+             "body": res.text}
+    if res.status_code in (200, 404):
+        os.makedirs(os.path.dirname(fixture), exist_ok=True)
+        with open(fixture, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+    return entry
+
+
+def make_handler(service, args, stats, rng, rng_lock):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *a):
+            pass
+
+        def send_body(self, status, content_type, body, extra_headers=None):
+            if not isinstance(body, (str, bytes)):
+                body = json.dumps(body)
+            if isinstance(body, str):
+                body = body.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (extra_headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+            stats.add(service, "bytes", len(body))
+
+        def do_GET(self):
+            stats.add(service, "requests")
+            parts = urlsplit(self.path)
+            path = parts.path
+            prefix = urlsplit(SERVICES[service][0]).path if service != "wikidata" else ""
+            if prefix and path.startswith(prefix):
+                path = path[len(prefix):]
+            query = dict(parse_qsl(parts.query, keep_blank_values=True))
+
+            with rng_lock:
+                delay = args.latency_ms + rng.uniform(0, args.jitter_ms)
+                roll = rng.random()
+            time.sleep(delay / 1000)
+            if roll < args.error_429:
+                stats.add(service, "injected_429")
+                return self.send_body(429, "application/json", {"status_message": "Too Many Requests"},
+                                      {"Retry-After": str(args.retry_after)})
+            if roll < args.error_429 + args.error_5xx:
+                stats.add(service, "injected_5xx")
+                return self.send_body(503, "application/json", {"status_message": "Service Unavailable"})
+
+            if args.fixtures:
+                fixture = fixture_path(args.fixtures, service, path, query)
+                entry = load_fixture(fixture)
+                if entry is None and args.record:
+                    entry = record_fixture(service, path, query, dict(self.headers), fixture)
+                    stats.add(service, "recorded")
+                elif entry is not None:
+                    stats.add(service, "fixture_hits")
+                if entry is not None:
+                    return self.send_body(entry["status"], entry["content_type"], entry["body"])
+            stats.add(service, "synthetic")
+            status, content_type, body = SYNTHETIC[service](path, query, args)
+            self.send_body(status, content_type, body)
+
+    return Handler
+
+
+def start_servers(args, stats):
+    # One server per upstream, each on its own port
+    rng = random.Random(args.seed)
+    rng_lock = threading.Lock()
+    servers = {}
+    for service in SERVICES:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(service, args, stats, rng, rng_lock))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers[service] = server
+    return servers
+
+
+def local_base_url(service, server):
+    host, port = server.server_address[:2]
+    base = SERVICES[service][0]
+    return f"http://{host}:{port}{urlsplit(base).path}"
+
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total
+
+
+def output_sizes(workdir):
+    sizes = {}
+    for name in ("movies.json", "movies.json.gz"):
+        path = os.path.join(workdir, name)
+        if os.path.exists(path):
+            sizes[name] = os.path.getsize(path)
+    for name in ("deltas", "shards"):
+        path = os.path.join(workdir, name)
+        if os.path.isdir(path):
+            sizes[name + "/"] = dir_size(path)
+    return sizes
+
+
+def catalog_entries(workdir):
+    try:
+        with open(os.path.join(workdir, "movies.json"), "r", encoding="utf-8") as f:
+            return json.load(f).get("total_entries")
+    except (OSError, ValueError):
+        return None
+
+
+def run_retries(path):
+    # The child's own retry count (METRICS.retry()), from its run_metrics.json
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)["totals"]["retries"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def run_once(args, servers, stats, workdir, run_index):
+    env = dict(os.environ)
+    for service, server in servers.items():
+        env[SERVICES[service][1]] = local_base_url(service, server)
+    if not args.record:
+        env.setdefault("TMDB_API_KEY", "benchmark")
+        env.setdefault("TMDB_ACCESS_TOKEN", "benchmark")
+    env.setdefault("HTTP_CACHE", "1" if args.cache else "0")
+    env.setdefault("PAGES_PER_CATEGORY", str(args.pages_per_category))
+    env.setdefault("TVMAZE_PAGES_PER_RUN", str(args.tvmaze_pages_per_run))
+    env.setdefault("WIKIDATA_PAGES_PER_RUN", str(args.wikidata_pages_per_run))
+    env.setdefault("SLEEP_MS", str(args.sleep_ms))
+    env["PYTHONUNBUFFERED"] = "1"
+
+    metrics_path = os.path.join(workdir, env.get("RUN_METRICS_FILE", "run_metrics.json"))
+    # A kept workdir still has the previous run's file
+    if os.path.exists(metrics_path):
+        os.remove(metrics_path)
+
+    before = stats.snapshot()
+    log_path = os.path.join(workdir, f"run_{run_index}.log")
+    started = time.monotonic()
+    with open(log_path, "w", encoding="utf-8") as log:
+        proc = subprocess.Popen([sys.executable, SCRIPT], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        # wait4 gives this child's own rusage, so each run's peak RSS is separate
+        _, status, rusage = os.wait4(proc.pid, 0)
+    wall_clock = time.monotonic() - started
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    after = stats.snapshot()
+    by_service = {name: {key: after[name][key] - before[name][key] for key in after[name]} for name in after}
+    requests_total = sum(counts["requests"] for counts in by_service.values())
+    return {
+        "run": run_index,
+        "exit_code": proc.returncode,
+        "wall_clock_s": round(wall_clock, 3),
+        "requests": requests_total,
+        "requests_per_s": round(requests_total / wall_clock, 2) if wall_clock else None,
+        "retries": run_retries(metrics_path),
+        "injected_429": sum(counts["injected_429"] for counts in by_service.values()),
+        "injected_5xx": sum(counts["injected_5xx"] for counts in by_service.values()),
+        "peak_rss_mb": round(rusage.ru_maxrss / 1024, 1),  # ru_maxrss is in KiB on Linux
+        "output_bytes": output_sizes(workdir),
+        "total_entries": catalog_entries(workdir),
+        "by_service": by_service,
+        "log": log_path,
+    }
+
+
+def compare_to_baseline(results, baseline_path, max_slowdown):
+    # Compare run by run (cold with cold, warm with warm); True if nothing regressed
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    ok = True
+    for current, previous in zip(results["runs"], baseline.get("runs", [])):
+        ratio = current["wall_clock_s"] / previous["wall_clock_s"] if previous["wall_clock_s"] else 1.0
+        marker = "SLOWDOWN" if ratio > max_slowdown else "ok"
+        print(f"[BENCH] Run {current['run']}: {previous['wall_clock_s']:.2f}s -> {current['wall_clock_s']:.2f}s "
+              f"(x{ratio:.2f}, limit x{max_slowdown:.2f}) {marker}")
+        ok = ok and ratio <= max_slowdown
+    return ok
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark update_data.py against local stand-in upstreams")
+    parser.add_argument("--runs", type=int, default=1, help="consecutive runs in the same working dir (cold, then warm)")
+    parser.add_argument("--output", default="benchmark_results.json", help="where to write the JSON results")
+    parser.add_argument("--workdir", help="working dir for update_data.py (default: a fresh temp dir)")
+    parser.add_argument("--keep", action="store_true", help="keep the temp working dir")
+    parser.add_argument("--seed", type=int, default=1, help="seed for latency jitter and fault injection")
+    parser.add_argument("--latency-ms", type=float, default=20, help="added latency per response")
+    parser.add_argument("--jitter-ms", type=float, default=10, help="extra random latency per response")
+    parser.add_argument("--error-429", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--error-5xx", type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with injected 429s")
+    parser.add_argument("--fixtures", help="serve recorded responses from this dir (synthetic when missing)")
+    parser.add_argument("--record", action="store_true", help="with --fixtures: fetch missing responses from the real APIs and save them")
+    parser.add_argument("--cache", action="store_true", help="leave update_data.py's HTTP cache on")
+    parser.add_argument("--tmdb-pages", type=int, default=50, help="synthetic total_pages per TMDb list")
+    parser.add_argument("--tvmaze-pages", type=int, default=20, help="synthetic TVMaze index pages")
+    parser.add_argument("--wikidata-films", type=int, default=5000, help="synthetic Wikidata films")
+    parser.add_argument("--pages-per-category", type=int, default=2, help="PAGES_PER_CATEGORY for the run")
+    parser.add_argument("--tvmaze-pages-per-run", type=int, default=5, help="TVMAZE_PAGES_PER_RUN for the run")
+    parser.add_argument("--wikidata-pages-per-run", type=int, default=2, help="WIKIDATA_PAGES_PER_RUN for the run")
+    parser.add_argument("--sleep-ms", type=int, default=200, help="SLEEP_MS (base retry backoff) for the run")
+    parser.add_argument("--baseline", help="earlier results JSON to compare wall-clock against")
+    parser.add_argument("--max-slowdown", type=float, default=1.2, help="allowed wall-clock ratio vs --baseline")
+    args = parser.parse_args(argv)
+    if args.record and not args.fixtures:
+        parser.error("--record needs --fixtures")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    stats = Stats()
+    servers = start_servers(args, stats)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="movie-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    print(f"[BENCH] Working dir: {workdir}")
+    for service, server in servers.items():
+        print(f"[BENCH] {service}: {local_base_url(service, server)}")
+
+    results = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "baseline", "workdir", "keep")},
+        "runs": [],
+    }
+    try:
+        for run_index in range(1, args.runs + 1):
+            result = run_once(args, servers, stats, workdir, run_index)
+            results["runs"].append(result)
+            print(f"[BENCH] Run {run_index}: exit {result['exit_code']}, {result['wall_clock_s']:.2f}s, "
+                  f"{result['requests']} requests ({result['requests_per_s']}/s), {result['retries']} retries, "
+                  f"peak RSS {result['peak_rss_mb']} MB, {result['total_entries']} entries, "
+                  f"movies.json.gz {result['output_bytes'].get('movies.json.gz', 0)} bytes")
+    finally:
+        for server in servers.values():
+            server.shutdown()
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+            for result in results["runs"]:
+                result.pop("log", None)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"[BENCH] Results written to {args.output}")
+
+    failed = any(result["exit_code"] != 0 for result in results["runs"])
+    if args.baseline and not compare_to_baseline(results, args.baseline, args.max_slowdown):
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
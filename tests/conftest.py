@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import update_data
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    # Every artifact path in update_data is relative, so each test gets a
+    # fresh working tree; stores a test left open are closed afterwards
+    monkeypatch.chdir(tmp_path)
+    yield tmp_path
+    update_data.close_catalog_store()
+    update_data.close_http_cache()
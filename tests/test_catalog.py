@@ -0,0 +1,254 @@
+import gzip
+import json
+import os
+
+import pytest
+
+import update_data
+
+
+def tmdb_movie(ident, title, year, **extra):
+    record = {"id": ident, "source": "TMDb", "type": "movie", "title": title, "year": year,
+              "category": "popular", "categories": ["popular"], "_category_seen": {"popular": 1000}}
+    record.update(extra)
+    return record
+
+
+def tmdb_tv(ident, title, year, **extra):
+    record = {"id": ident, "source": "TMDb", "type": "tv", "title": title, "year": year,
+              "category": "popular", "categories": ["popular"], "_category_seen": {"popular": 1000}}
+    record.update(extra)
+    return record
+
+
+def tvmaze_show(ident, title, year, **extra):
+    record = {"id": ident, "source": "TVMaze", "type": "tv", "title": title, "year": year}
+    record.update(extra)
+    return record
+
+
+def wikidata_movie(ident, title, year, **extra):
+    record = {"id": ident, "source": "Wikidata", "title": title, "year": year}
+    record.update(extra)
+    return record
+
+
+# First run: a TMDb movie, a Wikidata film no other source has yet, and a
+# show both TMDb and TVMaze list
+FIRST_RUN = [
+    tmdb_movie(550, "Fight Club", "1999", rating=8.4, genres=["Drama"],
+               external_ids={"imdb_id": "tt0137523"}),
+    tmdb_movie(603, "The Matrix", "1999", rating=8.2, genres=["Action"]),
+    wikidata_movie("Q83495", "The Matrix Reloaded", "2003", directors=["Lana Wachowski"]),
+    tmdb_tv(1396, "Breaking Bad", "2008", external_ids={"imdb_id": "tt0903747", "tvdb_id": 81189}),
+    tvmaze_show(169, "Breaking Bad", "2008", external_ids={"imdb_id": "tt0903747", "tvdb_id": 81189},
+                network="AMC"),
+]
+
+# Second run: a changed rating and genres, Wikidata joining an existing TMDb
+# title, TMDb taking over a Wikidata-only row, and a brand new title
+SECOND_RUN = [
+    tmdb_movie(550, "Fight Club", "1999", rating=8.5, genres=["Drama", "Thriller"],
+               external_ids={"imdb_id": "tt0137523"}),
+    wikidata_movie("Q190050", "Fight Club", "1999", poster="https://commons.example.org/fc.jpg",
+                   external_ids={"imdb_id": "tt0137523", "tmdb_movie_id": "550"}),
+    tmdb_movie(604, "The Matrix Reloaded", "2003", rating=7.0, genres=["Action"]),
+    tmdb_movie(13, "Forrest Gump", "1994", rating=8.5, genres=["Comedy", "Drama"]),
+]
+
+
+def write_partial(name, records):
+    os.makedirs("partials", exist_ok=True)
+    with open(os.path.join("partials", name + ".ndjson"), "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def run_merge(name, records):
+    write_partial(name, records)
+    update_data.main(["--merge"])
+
+
+def load_catalog():
+    with open(update_data.CATALOG_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_delta(version):
+    with gzip.open(update_data.delta_path(version), "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def by_key(records):
+    records = list(records)
+    keyed = {update_data.record_key(record): record for record in records}
+    assert len(keyed) == len(records)
+    return keyed
+
+
+def apply_delta(records, delta):
+    # What a client holding the previous version does with the delta
+    keyed = by_key(records)
+    for removed in delta["removed"]:
+        keyed.pop((removed["source"], removed["type"], removed["id"]))
+    for change in delta["changed"]:
+        record = keyed[(change["source"], change["type"], change["id"])]
+        record.update(change["set"])
+        for field in change.get("unset", []):
+            record.pop(field, None)
+    for added in delta["added"]:
+        keyed[update_data.record_key(added)] = added
+    return keyed
+
+
+def published(catalog):
+    return {k: v for k, v in catalog.items() if k != "last_updated"}
+
+
+def test_delta_applied_to_previous_catalog_matches_full_rebuild():
+    run_merge("first", FIRST_RUN)
+    first = load_catalog()
+    run_merge("second", SECOND_RUN)
+    second = load_catalog()
+
+    assert first["version"] == 1 and second["version"] == 2
+    delta = load_delta(2)
+    assert delta["from_version"] == 1
+    assert delta["added"] and delta["changed"] and delta["removed"]
+    assert apply_delta(first["movies"], delta) == by_key(second["movies"])
+
+
+def test_patched_search_index_matches_rebuilt_one(capsys):
+    run_merge("first", FIRST_RUN)
+    run_merge("second", SECOND_RUN)
+    assert "search_index.json.gz patched" in capsys.readouterr().out
+
+    postings, keys = update_data.load_search_index(2)
+    rebuilt, rebuilt_keys = update_data.build_search_index()
+    assert keys == rebuilt_keys
+    assert {name: {term: sorted(offsets) for term, offsets in table.items()} for name, table in postings.items()} == \
+        {name: {term: sorted(offsets) for term, offsets in table.items()} for name, table in rebuilt.items()}
+
+
+def test_entities_merge_across_tmdb_tvmaze_and_wikidata():
+    records = [
+        tmdb_movie(550, "Fight Club", "1999", external_ids={"imdb_id": "tt0137523"}),
+        # Matched through its TMDb ID
+        wikidata_movie("Q190050", "Fight Club", "1999", poster="https://commons.example.org/fc.jpg",
+                       external_ids={"tmdb_movie_id": "550"}),
+        tmdb_tv(1396, "Breaking Bad", "2008", external_ids={"imdb_id": "tt0903747"}),
+        # Matched through its IMDb ID
+        tvmaze_show(169, "Breaking Bad", "2008", network="AMC", external_ids={"imdb_id": "tt0903747"}),
+        # Same IMDb ID as the show, but a film never merges with a show
+        wikidata_movie("Q1079", "Breaking Bad", "2008", external_ids={"imdb_id": "tt0903747"}),
+        # Same title and year, but its IMDb ID conflicts with the TMDb title
+        wikidata_movie("Q999", "Fight Club", "1999", external_ids={"imdb_id": "tt9999999"}),
+    ]
+    delta = update_data.new_delta()
+    stats = update_data.merge_catalog(records, delta)
+    update_data.commit_catalog(1)
+    catalog = by_key(update_data.catalog_store().records())
+
+    assert stats["total_entries"] == 4
+    assert stats["merged_entries"] == 2
+    film = catalog[("TMDb", "movie", 550)]
+    assert [update_data.record_key(m) for m in film["_members"]] == \
+        [("TMDb", "movie", 550), ("Wikidata", "movie", "Q190050")]
+    assert film["poster"] == "https://commons.example.org/fc.jpg"
+    assert film["provenance"] == {"poster": "Wikidata"}
+    show = catalog[("TMDb", "tv", 1396)]
+    assert show["sources"] == [{"source": "TMDb", "type": "tv", "id": 1396},
+                               {"source": "TVMaze", "type": "tv", "id": 169}]
+    assert show["network"] == "AMC"
+    assert ("Wikidata", "movie", "Q1079") in catalog
+    assert ("Wikidata", "movie", "Q999") in catalog
+
+
+def test_merge_across_runs_moves_a_title_onto_its_tmdb_row():
+    update_data.merge_catalog([wikidata_movie("Q83495", "The Matrix Reloaded", "2003")], update_data.new_delta())
+    update_data.commit_catalog(1)
+    delta = update_data.new_delta()
+    update_data.merge_catalog([tmdb_movie(604, "The Matrix Reloaded", "2003")], delta)
+    update_data.commit_catalog(2)
+
+    assert delta["removed"] == [{"source": "Wikidata", "type": "movie", "id": "Q83495"}]
+    assert [update_data.record_key(r) for r in delta["added"]] == [("TMDb", "movie", 604)]
+    assert [update_data.record_key(r) for r in update_data.catalog_store().records()] == [("TMDb", "movie", 604)]
+
+
+def test_memberships_not_listed_since_the_cutoff_expire():
+    stale = tmdb_movie(550, "Fight Club", "1999", categories=["popular", "top_rated"],
+                       _category_seen={"popular": 100, "top_rated": 300})
+    fresh = tmdb_movie(603, "The Matrix", "1999", _category_seen={"popular": 300})
+    update_data.merge_catalog([stale, fresh], update_data.new_delta())
+    update_data.commit_catalog(1)
+
+    delta = update_data.new_delta()
+    stats = update_data.merge_catalog([], delta, {("movie", "popular"): 200, ("movie", "top_rated"): 200})
+    update_data.commit_catalog(2)
+    catalog = by_key(update_data.catalog_store().records())
+
+    assert catalog[("TMDb", "movie", 550)]["categories"] == ["top_rated"]
+    assert catalog[("TMDb", "movie", 550)]["_category_seen"] == {"top_rated": 300}
+    assert catalog[("TMDb", "movie", 603)]["categories"] == ["popular"]
+    assert delta["changed"] == [{"source": "TMDb", "type": "movie", "id": 550, "set": {"categories": ["top_rated"]}}]
+    assert stats["tmdb_categories"] == {"popular": 1, "top_rated": 1}
+
+
+def test_expiry_keeps_other_sources_of_a_merged_title():
+    update_data.merge_catalog([
+        tmdb_movie(550, "Fight Club", "1999", _category_seen={"popular": 100}),
+        wikidata_movie("Q190050", "Fight Club", "1999", external_ids={"tmdb_movie_id": "550"}),
+    ], update_data.new_delta())
+    update_data.commit_catalog(1)
+
+    update_data.merge_catalog([], update_data.new_delta(), {("movie", "popular"): 200})
+    update_data.commit_catalog(2)
+    line = update_data.catalog_store().get(("TMDb", "movie", 550))
+
+    assert line["categories"] == []
+    assert len(line["_members"]) == 2
+
+
+@pytest.mark.parametrize("killed_in, after", [
+    ("write_delta", False),
+    ("commit_catalog", False),
+    ("commit_catalog", True),
+    ("write_catalog_outputs", False),
+])
+def test_run_killed_while_publishing_resumes_to_the_same_catalog(workdir, monkeypatch, killed_in, after):
+    # Reference: both runs complete
+    os.makedirs("clean")
+    monkeypatch.chdir("clean")
+    run_merge("first", FIRST_RUN)
+    run_merge("second", SECOND_RUN)
+    expected, expected_delta = load_catalog(), load_delta(2)
+
+    # The second run dies in (or right after) one step of publishing it
+    os.makedirs(workdir / "killed")
+    monkeypatch.chdir(workdir / "killed")
+    run_merge("first", FIRST_RUN)
+    original = getattr(update_data, killed_in)
+
+    def killed(*args, **kwargs):
+        if after:
+            original(*args, **kwargs)
+        raise RuntimeError("killed")
+
+    monkeypatch.setattr(update_data, killed_in, killed)
+    with pytest.raises(SystemExit):
+        run_merge("second", SECOND_RUN)
+    monkeypatch.setattr(update_data, killed_in, original)
+    assert load_catalog()["version"] == 1
+    assert os.path.exists(os.path.join("partials", "second.ndjson"))
+
+    update_data.main(["--merge"])
+    assert published(load_catalog()) == published(expected)
+    delta = load_delta(2)
+    assert {k: v for k, v in delta.items() if k != "generated_at"} == \
+        {k: v for k, v in expected_delta.items() if k != "generated_at"}
+    assert not os.path.exists(update_data.delta_path(3))
+    with open(update_data.STATE_FILE, "r", encoding="utf-8") as f:
+        catalog_state = json.load(f)["catalog"]
+    assert catalog_state["version"] == 2 and "pending_version" not in catalog_state
+    assert not os.listdir("partials")
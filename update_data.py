@@ -17,17 +17,52 @@ MIT License — Free to use, modify, and distribute with attribution.
 """
 
 import requests
+import argparse
 import json
 import os
+import re
+import sys
 import time
+import unicodedata
+import random
+import itertools
+import threading
+import queue
+import collections
+from contextlib import contextmanager
 from datetime import datetime, timezone
 import gzip
+import hashlib
+import shutil
+import sqlite3
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
 from typing import Dict, Any
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# Optional codecs (pip install brotli zstandard); gzip always works
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # TMDb API keys
 TMDB_API_KEY = os.environ.get("TMDB_API_KEY")
 TMDB_ACCESS_TOKEN = os.environ.get("TMDB_ACCESS_TOKEN")
 
+# Upstream base URLs; benchmark.py points these at its local stand-in server
+TMDB_BASE_URL = os.environ.get("TMDB_BASE_URL", "https://api.themoviedb.org/3").rstrip("/")
+TVMAZE_BASE_URL = os.environ.get("TVMAZE_BASE_URL", "https://api.tvmaze.com").rstrip("/")
+WIKIDATA_URL = os.environ.get("WIKIDATA_URL", "https://query.wikidata.org/sparql")
+TMDB_HOST, TVMAZE_HOST, WIKIDATA_HOST = (
+    urlsplit(url).netloc.lower() for url in (TMDB_BASE_URL, TVMAZE_BASE_URL, WIKIDATA_URL)
+)
+
 # Config via environment
 def _get_int_env(name: str, default: int) -> int:
     try:
@@ -35,8 +70,23 @@ def _get_int_env(name: str, default: int) -> int:
     except Exception:
         return default
 
+def _get_list_env(name: str, default: str = "") -> list:
+    return [v.strip() for v in os.environ.get(name, default).split(",") if v.strip()]
+
+# Pages fetched per category per run; the window advances every run
 PAGES_PER_CATEGORY = _get_int_env("PAGES_PER_CATEGORY", 10)
-SLEEP_MS = _get_int_env("SLEEP_MS", 200)
+TVMAZE_PAGES_PER_RUN = _get_int_env("TVMAZE_PAGES_PER_RUN", 20)
+# TMDb never serves list pages past 500
+TMDB_MAX_PAGES = 500
+# Base delay (ms) for jittered exponential retry backoff
+SLEEP_MS = _get_int_env("SLEEP_MS", 1000)
+# Sub-resources returned with every TMDb detail call, plus optional extras
+# from config, e.g. TMDB_EXTRA_APPEND="release_dates,external_ids,translations"
+TMDB_APPEND = ["credits", "videos", "watch/providers", "external_ids"]
+TMDB_EXTRA_APPEND = [v for v in _get_list_env("TMDB_EXTRA_APPEND") if v not in TMDB_APPEND]
+# Max concurrent HTTP requests in flight per host, shared by every pipeline
+# and pool talking to it (each also runs this many detail workers)
+MAX_IN_FLIGHT = max(1, _get_int_env("MAX_IN_FLIGHT", 8))
 
 def sleep_ms(ms: int) -> None:
     if ms and ms > 0:
@@ -52,592 +102,3587 @@ def load_state() -> Dict[str, Any]:
     except Exception:
         return {}
 
+# Sources run in parallel and all checkpoint into the same state dict
+STATE_LOCK = threading.RLock()
+
 def save_state(state: Dict[str, Any]) -> None:
+    # Write-then-rename so a killed run never leaves a truncated state.json
+    tmp_path = STATE_FILE + ".tmp"
     try:
-        with open(STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump(state, f, ensure_ascii=False, indent=2)
+        with STATE_LOCK:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, STATE_FILE)
     except Exception as e:
         print(f"[STATE] Failed to save state: {e}")
 
 def get_start_page(state: Dict[str, Any], namespace: str, key: str, default_start: int = 1) -> int:
     return int(((state or {}).get(namespace, {}) or {}).get(key, {}).get("next_page", default_start))
 
-def set_next_page(state: Dict[str, Any], namespace: str, key: str, next_page: int) -> None:
-    if namespace not in state:
-        state[namespace] = {}
-    if key not in state[namespace]:
-        state[namespace][key] = {}
-    state[namespace][key]["next_page"] = int(next_page)
+def set_next_page(state: Dict[str, Any], namespace: str, key: str, next_page: int, **extra) -> None:
+    with STATE_LOCK:
+        if namespace not in state:
+            state[namespace] = {}
+        if key not in state[namespace]:
+            state[namespace][key] = {}
+        state[namespace][key]["next_page"] = int(next_page)
+        state[namespace][key].update(extra)
+
+# Records fetched since the last completed run. Every page is appended here
+# before its cursor is checkpointed; main() folds it into the catalog.
+JOURNAL_FILE = "crawl_journal.ndjson"
+_journal_lock = threading.Lock()
+
+def append_journal(records, path: str = None) -> None:
+    if not records:
+        return
+    with _journal_lock:
+        with open(path or JOURNAL_FILE, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+def clear_journal() -> None:
+    try:
+        os.remove(JOURNAL_FILE)
+    except FileNotFoundError:
+        pass
+
+# Run metrics: every HTTP call is recorded per endpoint (latency histogram,
+# responses by status, retries, errors, bytes, cache results) and pipeline
+# stages add up their time. main() writes run_metrics.json and a Prometheus
+# textfile snapshot at the end, and appends a one-line summary to a history
+# file so throughput can be compared across runs.
+RUN_METRICS_FILE = os.environ.get("RUN_METRICS_FILE", "run_metrics.json")
+METRICS_PROM_FILE = os.environ.get("METRICS_PROM_FILE", "run_metrics.prom")
+METRICS_HISTORY_FILE = os.environ.get("METRICS_HISTORY_FILE", os.path.join(".cache", "metrics_history.ndjson"))
+METRICS_HISTORY_KEEP = _get_int_env("METRICS_HISTORY_KEEP", 96 * 7)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def endpoint_of(url: str) -> str:
+    # "tmdb:/movie/{id}", "tvmaze:/shows", ...; numeric path parts become {id}
+    parts = urlsplit(url)
+    host = parts.netloc.lower()
+    path = parts.path
+    for name, base in (("tmdb", TMDB_BASE_URL), ("tvmaze", TVMAZE_BASE_URL), ("wikidata", WIKIDATA_URL)):
+        base_parts = urlsplit(base)
+        if host == base_parts.netloc.lower():
+            if name != "wikidata" and path.startswith(base_parts.path):
+                path = path[len(base_parts.path):]
+            return f"{name}:{re.sub(r'/[0-9]+(?=/|$)', '/{id}', path) or '/'}"
+    return f"{host}:{re.sub(r'/[0-9]+(?=/|$)', '/{id}', path) or '/'}"
+
+class RunMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.endpoints = {}
+        self.stages = {}
+        self.sources = {}
+
+    def _endpoint(self, url: str) -> Dict[str, Any]:
+        name = endpoint_of(url)
+        if name not in self.endpoints:
+            self.endpoints[name] = {
+                "requests": 0, "statuses": {}, "retries": 0, "errors": 0, "bytes": 0,
+                "cache": {"hits": 0, "misses": 0, "revalidated": 0},
+                "latency": {"buckets": [0] * (len(LATENCY_BUCKETS) + 1), "sum": 0.0, "count": 0},
+            }
+        return self.endpoints[name]
+
+    def observe(self, url: str, status, seconds: float, size: int = 0) -> None:
+        # status is None when the request raised (timeout, connection reset)
+        with self.lock:
+            endpoint = self._endpoint(url)
+            endpoint["requests"] += 1
+            if status is None:
+                endpoint["errors"] += 1
+            else:
+                key = str(status)
+                endpoint["statuses"][key] = endpoint["statuses"].get(key, 0) + 1
+            endpoint["bytes"] += size
+            latency = endpoint["latency"]
+            latency["buckets"][next((i for i, le in enumerate(LATENCY_BUCKETS) if seconds <= le), len(LATENCY_BUCKETS))] += 1
+            latency["sum"] += seconds
+            latency["count"] += 1
+
+    def add_bytes(self, url: str, size: int) -> None:
+        with self.lock:
+            self._endpoint(url)["bytes"] += size
+
+    def retry(self, url: str) -> None:
+        with self.lock:
+            self._endpoint(url)["retries"] += 1
+
+    def cache(self, url: str, result: str) -> None:
+        with self.lock:
+            self._endpoint(url)["cache"][result] += 1
+
+    def add_stage(self, name: str, seconds: float, calls: int = 1) -> None:
+        with self.lock:
+            stage = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+            stage["seconds"] += seconds
+            stage["calls"] += calls
+
+    @contextmanager
+    def stage(self, name: str):
+        # Concurrent stages (detail fetches) add up, so seconds can exceed wall-clock
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - started)
+
+    def source(self, name: str, seconds: float, records: int) -> None:
+        with self.lock:
+            self.sources[name] = {"seconds": round(seconds, 3), "records": records}
+
+    def snapshot(self, extra: Dict[str, Any] = None) -> Dict[str, Any]:
+        with self.lock:
+            duration = time.time() - self.started
+            endpoints = json.loads(json.dumps(self.endpoints))
+            totals = {
+                "requests": sum(e["requests"] for e in endpoints.values()),
+                "retries": sum(e["retries"] for e in endpoints.values()),
+                "errors": sum(e["errors"] for e in endpoints.values()),
+                "bytes": sum(e["bytes"] for e in endpoints.values()),
+                "cache_hits": sum(e["cache"]["hits"] for e in endpoints.values()),
+            }
+            totals["requests_per_second"] = round(totals["requests"] / duration, 3) if duration else 0.0
+            return {
+                "started_at": datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+                "duration_seconds": round(duration, 3),
+                "totals": totals,
+                "stages": {k: {"seconds": round(v["seconds"], 3), "calls": v["calls"]} for k, v in self.stages.items()},
+                "sources": dict(self.sources),
+                "endpoints": endpoints,
+                "latency_buckets": list(LATENCY_BUCKETS),
+                **(extra or {}),
+            }
+
+def prometheus_text(snapshot: Dict[str, Any]) -> str:
+    def esc(value) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+    lines = [
+        "# HELP movie_metadata_http_request_duration_seconds Upstream request latency.",
+        "# TYPE movie_metadata_http_request_duration_seconds histogram",
+    ]
+    for name, endpoint in sorted(snapshot["endpoints"].items()):
+        cumulative = 0
+        for le, count in zip(list(LATENCY_BUCKETS) + ["+Inf"], endpoint["latency"]["buckets"]):
+            cumulative += count
+            lines.append(f'movie_metadata_http_request_duration_seconds_bucket{{endpoint="{esc(name)}",le="{le}"}} {cumulative}')
+        lines.append(f'movie_metadata_http_request_duration_seconds_sum{{endpoint="{esc(name)}"}} {endpoint["latency"]["sum"]:.6f}')
+        lines.append(f'movie_metadata_http_request_duration_seconds_count{{endpoint="{esc(name)}"}} {endpoint["latency"]["count"]}')
+
+    counters = (
+        ("http_responses_total", "Upstream responses by status.",
+         lambda e: [({"status": status}, count) for status, count in sorted(e["statuses"].items())]),
+        ("http_retries_total", "Retried upstream requests.", lambda e: [({}, e["retries"])]),
+        ("http_errors_total", "Upstream requests that raised (timeouts, resets).", lambda e: [({}, e["errors"])]),
+        ("http_bytes_total", "Response bytes downloaded.", lambda e: [({}, e["bytes"])]),
+        ("http_cache_total", "HTTP cache lookups by result.",
+         lambda e: [({"result": result}, count) for result, count in sorted(e["cache"].items())]),
+    )
+    for metric, help_text, samples in counters:
+        lines += [f"# HELP movie_metadata_{metric} {help_text}", f"# TYPE movie_metadata_{metric} counter"]
+        for name, endpoint in sorted(snapshot["endpoints"].items()):
+            for labels, value in samples(endpoint):
+                label_text = ",".join([f'endpoint="{esc(name)}"'] + [f'{k}="{esc(v)}"' for k, v in labels.items()])
+                lines.append(f"movie_metadata_{metric}{{{label_text}}} {value}")
+
+    gauges = (
+        ("stage_seconds", "Time spent per pipeline stage (summed across threads).",
+         [({"stage": k}, v["seconds"]) for k, v in sorted(snapshot["stages"].items())]),
+        ("source_seconds", "Wall-clock per source.",
+         [({"source": k}, v["seconds"]) for k, v in sorted(snapshot["sources"].items())]),
+        ("source_records", "Records fetched per source.",
+         [({"source": k}, v["records"]) for k, v in sorted(snapshot["sources"].items())]),
+        ("run_duration_seconds", "Wall-clock of the whole run.", [({}, snapshot["duration_seconds"])]),
+        ("run_requests_per_second", "Upstream requests per second over the run.",
+         [({}, snapshot["totals"]["requests_per_second"])]),
+        ("run_timestamp_seconds", "When the run finished.", [({}, int(time.time()))]),
+    )
+    if snapshot.get("total_entries") is not None:
+        gauges += (("catalog_entries", "Records in the published catalog.", [({}, snapshot["total_entries"])]),)
+    for metric, help_text, samples in gauges:
+        lines += [f"# HELP movie_metadata_{metric} {help_text}", f"# TYPE movie_metadata_{metric} gauge"]
+        for labels, value in samples:
+            label_text = ",".join(f'{k}="{esc(v)}"' for k, v in labels.items())
+            lines.append(f"movie_metadata_{metric}{{{label_text}}} {value}" if label_text else f"movie_metadata_{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+def write_run_metrics(extra: Dict[str, Any] = None) -> Dict[str, Any]:
+    snapshot = METRICS.snapshot(extra)
+    for path, text in ((RUN_METRICS_FILE, json.dumps(snapshot, ensure_ascii=False, indent=2)),
+                       (METRICS_PROM_FILE, prometheus_text(snapshot))):
+        # Textfile collectors must never see a half-written file
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(path + ".tmp", path)
+
+    summary = {"started_at": snapshot["started_at"], "duration_seconds": snapshot["duration_seconds"],
+               **snapshot["totals"], "total_entries": snapshot.get("total_entries")}
+    history = []
+    if os.path.exists(METRICS_HISTORY_FILE):
+        history = list(iter_ndjson(METRICS_HISTORY_FILE))[-(METRICS_HISTORY_KEEP - 1):] if METRICS_HISTORY_KEEP > 1 else []
+    elif os.path.dirname(METRICS_HISTORY_FILE):
+        os.makedirs(os.path.dirname(METRICS_HISTORY_FILE), exist_ok=True)
+    with open(METRICS_HISTORY_FILE + ".tmp", "w", encoding="utf-8") as f:
+        for line in history + [summary]:
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+    os.replace(METRICS_HISTORY_FILE + ".tmp", METRICS_HISTORY_FILE)
+    return snapshot
+
+METRICS = RunMetrics()
+
+# Run budget: RUN_BUDGET_SECONDS caps a run's wall clock so it fits the cron
+# interval. Fetching stops early enough to leave a reserve for merging and
+# writing outputs (RUN_BUDGET_RESERVE, otherwise 1.5x the last run's publish
+# time and at least 10% of the budget). Work is done in priority tiers:
+#   0: fresh lists (trending, now_playing, airing_today)
+#   1: the rest of the TMDb back-catalog, change-feed refreshes, TVMaze
+#   2: Wikidata
+# Tier N stops issuing requests once less than N x 10% of the budget is left
+# before the fetch cutoff. Work that is cut off keeps its cursor, so it
+# resumes next run, and is listed in state["scheduler"]["deferred"]; next
+# run bumps it one tier up so it can't starve.
+RUN_BUDGET_SECONDS = _get_int_env("RUN_BUDGET_SECONDS", 0)
+RUN_BUDGET_RESERVE = _get_int_env("RUN_BUDGET_RESERVE", 0)
+BUDGET_TIER_SHARE = 0.1
+BUDGET_MIN_RESERVE_SHARE = 0.1
+
+class RunBudget:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset(0)
+
+    def reset(self, seconds: int, reserve: float = 0.0, boosted=()) -> None:
+        self.seconds = seconds
+        self.reserve = reserve
+        self.started = time.monotonic()
+        self.cutoff = self.started + seconds - reserve if seconds else None
+        self.boosted = set(boosted)
+        self.deferred = {}
+        # Detail fetches dropped at the cutoff
+        self.dropped = 0
+
+    def start(self, state: Dict[str, Any]) -> None:
+        scheduler = state.get("scheduler") or {}
+        if not RUN_BUDGET_SECONDS:
+            self.reset(0)
+            return
+        reserve = RUN_BUDGET_RESERVE or max(BUDGET_MIN_RESERVE_SHARE * RUN_BUDGET_SECONDS,
+                                            1.5 * float(scheduler.get("publish_seconds") or 0))
+        reserve = min(reserve, 0.5 * RUN_BUDGET_SECONDS)
+        self.reset(RUN_BUDGET_SECONDS, reserve, scheduler.get("deferred") or [])
+        print(f"[BUDGET] {RUN_BUDGET_SECONDS}s budget: fetching stops after {RUN_BUDGET_SECONDS - reserve:.0f}s, "
+              f"{reserve:.0f}s kept for merging and outputs"
+              + (f"; deferred last run: {', '.join(sorted(self.boosted))}" if self.boosted else ""))
+
+    def left(self) -> float:
+        # Seconds until the fetch cutoff
+        return float("inf") if self.cutoff is None else self.cutoff - time.monotonic()
+
+    def tier(self, work: str, tier: int) -> int:
+        # Work deferred last run moves up one step from its own tier. Tier 0
+        # work goes to -1, which only orders it ahead of the rest of tier 0;
+        # allows() treats it as tier 0.
+        return tier - 1 if work in self.boosted else tier
+
+    def allows(self, work: str, tier: int) -> bool:
+        # Called before each new unit of work (a list page, a batch of titles)
+        if self.cutoff is None:
+            return True
+        tier = max(0, self.tier(work, tier))
+        left = self.left()
+        if left > tier * BUDGET_TIER_SHARE * self.seconds:
+            return True
+        with self.lock:
+            if work not in self.deferred:
+                print(f"[BUDGET] Deferring {work} (tier {tier}) to the next run, {max(left, 0):.0f}s left before the cutoff")
+            self.deferred[work] = self.deferred.get(work, 0) + 1
+        return False
+
+    def drop(self, work) -> None:
+        # A queued detail fetch skipped past the cutoff; its page isn't checkpointed
+        with self.lock:
+            self.dropped += 1
+            if work and work not in self.deferred:
+                print(f"[BUDGET] Deferring {work} to the next run, cutoff reached with titles still queued")
+            if work:
+                self.deferred[work] = self.deferred.get(work, 0) + 1
+
+    def expired(self) -> bool:
+        # Past the fetch cutoff: no more retries either
+        return self.left() <= 0
+
+    def summary(self) -> Dict[str, Any]:
+        return {"budget_seconds": self.seconds, "reserve_seconds": round(self.reserve, 1),
+                "elapsed_seconds": round(time.monotonic() - self.started, 1), "deferred": dict(sorted(self.deferred.items())),
+                "dropped_details": self.dropped}
+
+    def finish(self, state: Dict[str, Any], publish_seconds: float) -> None:
+        with STATE_LOCK:
+            state["scheduler"] = {"deferred": sorted(self.deferred), "publish_seconds": round(publish_seconds, 1)}
+
+BUDGET = RunBudget()
+
+# Catalog store: the merged catalog kept between runs in SQLite
+# (.cache/catalog.sqlite, WAL mode). It is the canonical dataset; movies.json
+# and every other artifact are exported from it. There is one row per
+# (source, type, id): the record as JSON plus indexed columns for ad-hoc
+# queries. "seq" is the record's position in movies.json. Merges load and
+# upsert only the rows an update links to, in one transaction that is
+# committed once the delta is written.
+CATALOG_FILE = "movies.json"
+CATALOG_GZ_FILE = "movies.json.gz"
+CATALOG_DB = os.environ.get("CATALOG_DB", os.path.join(".cache", "catalog.sqlite"))
+# The NDJSON spool used before the store; imported once if found
+CATALOG_SPOOL = os.environ.get("CATALOG_SPOOL", os.path.join(".cache", "catalog.ndjson"))
+CATALOG_BATCH = 500
+# Raw records resolved per merge batch; a --merge of a full back-catalog
+# crawl is folded in batches of this many so memory stays bounded
+MERGE_BATCH = _get_int_env("MERGE_BATCH", 50000)
+
+def record_key(record: Dict[str, Any]) -> tuple:
+    media_type = record.get("type") or ("tv" if record.get("source") == "TVMaze" else "movie")
+    ident = record.get("id") if record.get("id") is not None else record.get("title")
+    return (record.get("source"), media_type, ident)
+
+def iter_ndjson(path: str):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Torn last line from a killed run
+                    continue
+    except FileNotFoundError:
+        return
+
+def record_categories(record: Dict[str, Any]) -> list:
+    # TMDb titles only ever reached through the back-catalog discover crawl
+    # have none, and neither do titles whose list memberships all expired
+    if record.get("categories") is not None:
+        return record["categories"]
+    return [record.get("category", "unknown")] if "category" in record else []
+
+class CatalogStore:
+    # "id" has no declared type so TMDb's 550 and Wikidata's "Q123" keep
+    # their JSON types. catalog_members maps every raw source record folded
+    # into a row to that row. catalog_links holds the external IDs and
+    # title+year keys entity resolution matches on. catalog_category_seen has
+    # the last time each TMDb row was listed under each of its categories.
+    # catalog_meta holds the catalog version the store was last committed at.
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS catalog ("
+        " seq INTEGER PRIMARY KEY, source TEXT, type TEXT, id, year INTEGER, rating REAL, category TEXT,"
+        " origin_country TEXT, categories TEXT, merged INTEGER NOT NULL DEFAULT 0, updated_at TEXT,"
+        " payload TEXT NOT NULL, UNIQUE (source, type, id))",
+        "CREATE INDEX IF NOT EXISTS catalog_year ON catalog (year)",
+        "CREATE INDEX IF NOT EXISTS catalog_rating ON catalog (rating)",
+        "CREATE INDEX IF NOT EXISTS catalog_category ON catalog (category)",
+        "CREATE INDEX IF NOT EXISTS catalog_origin_country ON catalog (origin_country)",
+        "CREATE INDEX IF NOT EXISTS catalog_updated_at ON catalog (updated_at)",
+        "CREATE TABLE IF NOT EXISTS catalog_members ("
+        " source TEXT, type TEXT, id, seq INTEGER NOT NULL, PRIMARY KEY (source, type, id))",
+        "CREATE INDEX IF NOT EXISTS catalog_members_seq ON catalog_members (seq)",
+        "CREATE TABLE IF NOT EXISTS catalog_links (type TEXT, namespace TEXT, value TEXT, seq INTEGER NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS catalog_links_value ON catalog_links (type, namespace, value)",
+        "CREATE INDEX IF NOT EXISTS catalog_links_seq ON catalog_links (seq)",
+        "CREATE TABLE IF NOT EXISTS catalog_category_seen (type TEXT, category TEXT, seen INTEGER, seq INTEGER NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS catalog_category_seen_seen ON catalog_category_seen (type, category, seen)",
+        "CREATE INDEX IF NOT EXISTS catalog_category_seen_seq ON catalog_category_seen (seq)",
+        "CREATE TABLE IF NOT EXISTS catalog_meta (key TEXT PRIMARY KEY, value)",
+    )
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Source threads read held IDs while crawling, merges run on the main thread
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        indexed = self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'catalog_category_seen'").fetchone()
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+        if not indexed:
+            # Stores from before the table existed: rows without stamps count
+            # as never listed, so they expire unless the next cycle lists them
+            self.db.execute("BEGIN")
+            for seq, payload in self.db.execute(
+                    "SELECT seq, payload FROM catalog WHERE source = 'TMDb' AND categories != '[]'").fetchall():
+                self.db.executemany("INSERT INTO catalog_category_seen VALUES (?, ?, ?, ?)",
+                                    category_seen_rows(seq, json.loads(payload)))
+            self.db.execute("COMMIT")
+
+    def count(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM catalog").fetchone()[0]
+
+    def max_seq(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COALESCE(MAX(seq), 0) FROM catalog").fetchone()[0]
+
+    def version(self):
+        # None for a store committed before versions were recorded
+        with self.lock:
+            row = self.db.execute("SELECT value FROM catalog_meta WHERE key = 'version'").fetchone()
+        return row[0] if row else None
+
+    def set_version(self, version: int) -> None:
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO catalog_meta VALUES ('version', ?)", (int(version),))
+
+    def begin(self) -> None:
+        with self.lock:
+            self.db.execute("BEGIN")
+
+    def commit(self) -> None:
+        with self.lock:
+            if self.db.in_transaction:
+                self.db.execute("COMMIT")
+
+    def records(self):
+        # Every row in movies.json order. Only the exporters call this, after
+        # the crawl threads are done with the store.
+        for (payload,) in self.db.execute("SELECT payload FROM catalog ORDER BY seq"):
+            yield json.loads(payload)
+
+    def get(self, key: tuple):
+        with self.lock:
+            row = self.db.execute("SELECT payload FROM catalog WHERE source IS ? AND type IS ? AND id IS ?",
+                                  key).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def rows(self, seqs) -> Dict[int, Dict[str, Any]]:
+        seqs = sorted(seqs)
+        rows = {}
+        with self.lock:
+            for i in range(0, len(seqs), CATALOG_BATCH):
+                chunk = seqs[i:i + CATALOG_BATCH]
+                rows.update((seq, json.loads(payload)) for seq, payload in self.db.execute(
+                    f"SELECT seq, payload FROM catalog WHERE seq IN ({','.join('?' * len(chunk))})", chunk))
+        return rows
+
+    def member_seq(self, key: tuple):
+        with self.lock:
+            row = self.db.execute("SELECT seq FROM catalog_members WHERE source IS ? AND type IS ? AND id IS ?",
+                                  key).fetchone()
+        return row[0] if row else None
+
+    def linked_seqs(self, links) -> set:
+        seqs = set()
+        with self.lock:
+            for link in links:
+                seqs.update(seq for (seq,) in self.db.execute(
+                    "SELECT seq FROM catalog_links WHERE type = ? AND namespace = ? AND value = ?", link))
+        return seqs
+
+    def expired_seqs(self, cutoffs) -> set:
+        # Rows still listed under a category they were last seen in before
+        # that category's cutoff; cutoffs: (type, category) -> epoch seconds
+        seqs = set()
+        with self.lock:
+            for (media_type, category), cutoff in cutoffs.items():
+                seqs.update(seq for (seq,) in self.db.execute(
+                    "SELECT seq FROM catalog_category_seen WHERE type = ? AND category = ? AND seen < ?",
+                    (media_type, category, cutoff)))
+        return seqs
+
+    def held_ids(self, source: str, media_type: str) -> set:
+        with self.lock:
+            return {ident for (ident,) in self.db.execute(
+                "SELECT id FROM catalog_members WHERE source = ? AND type = ? AND typeof(id) = 'integer'",
+                (source, media_type))}
+
+    def stats(self) -> Dict[str, Any]:
+        # Counts and keys from the indexed columns, without decoding payloads
+        stats = new_catalog_stats()
+        with self.lock:
+            rows = self.db.execute("SELECT source, type, id, merged, categories FROM catalog ORDER BY seq").fetchall()
+        for source, media_type, ident, merged, categories in rows:
+            add_catalog_stats(stats, {"source": source, "type": media_type, "id": ident,
+                                      "_members": merged, "categories": json.loads(categories)})
+        return stats
+
+    def write(self, removed, lines, updated_at) -> None:
+        # removed: seqs whose rows go away; lines: [(seq, line)] to upsert.
+        # Rows are replaced by seq, so a merged title can move to the slot of
+        # another row it absorbed once that row is removed.
+        touched = [(seq,) for seq in removed] + [(seq,) for seq, _ in lines]
+        rows, members, links, seen = [], [], [], []
+        for seq, line in lines:
+            source, media_type, ident = record_key(line)
+            year = str(line.get("year") or "")
+            rating = line.get("rating")
+            country = line.get("origin_country")
+            rows.append((seq, source, media_type, ident, int(year) if year.isdigit() else None,
+                         rating if isinstance(rating, (int, float)) and not isinstance(rating, bool) else None,
+                         line.get("category"), country if isinstance(country, str) else None,
+                         json.dumps(record_categories(line), ensure_ascii=False), 1 if line.get("_members") else 0,
+                         updated_at, json.dumps(line, ensure_ascii=False)))
+            members.extend(record_key(member) + (seq,) for member in members_of(line))
+            links.extend(link + (seq,) for link in line_links(line))
+            seen.extend(category_seen_rows(seq, line))
+        with self.lock:
+            self.db.executemany("DELETE FROM catalog WHERE seq = ?", [(seq,) for seq in removed])
+            self.db.executemany("DELETE FROM catalog_members WHERE seq = ?", touched)
+            self.db.executemany("DELETE FROM catalog_links WHERE seq = ?", touched)
+            self.db.executemany("DELETE FROM catalog_category_seen WHERE seq = ?", touched)
+            self.db.executemany(
+                "INSERT INTO catalog (seq, source, type, id, year, rating, category, origin_country, categories,"
+                " merged, updated_at, payload) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (seq) DO UPDATE SET source = excluded.source, type = excluded.type, id = excluded.id,"
+                " year = excluded.year, rating = excluded.rating, category = excluded.category,"
+                " origin_country = excluded.origin_country, categories = excluded.categories,"
+                " merged = excluded.merged, updated_at = excluded.updated_at, payload = excluded.payload", rows)
+            self.db.executemany("INSERT OR REPLACE INTO catalog_members VALUES (?, ?, ?, ?)", members)
+            self.db.executemany("INSERT INTO catalog_links VALUES (?, ?, ?, ?)", links)
+            self.db.executemany("INSERT INTO catalog_category_seen VALUES (?, ?, ?, ?)", seen)
+
+    def close(self) -> None:
+        # An uncommitted merge is rolled back
+        with self.lock:
+            self.db.close()
+
+_catalog_store = []
+
+def catalog_store() -> CatalogStore:
+    if not _catalog_store:
+        _catalog_store.append(CatalogStore(CATALOG_DB))
+    return _catalog_store[0]
+
+def close_catalog_store() -> None:
+    if _catalog_store:
+        _catalog_store.pop().close()
+
+def drop_catalog_store() -> None:
+    close_catalog_store()
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(CATALOG_DB + suffix)
+        except FileNotFoundError:
+            pass
+
+def ensure_catalog_store(expected_version: int = None):
+    # First run (or lost cache): seed the store from the old NDJSON spool,
+    # or else from the published movies.json. The store lives in the
+    # evictable CI cache while state.json and movies.json are in git, so a
+    # store whose version isn't the one state.json expects (an older cache)
+    # is rebuilt from movies.json. Returns the store's version: one past
+    # expected_version when a run was killed after committing the store but
+    # before state.json recorded it. Its delta is written before the commit,
+    # so that version only still needs publishing.
+    store = catalog_store()
+    if store.count():
+        version = store.version()
+        if expected_version is None or version == expected_version:
+            return version
+        if version == expected_version + 1 and os.path.exists(delta_path(version)):
+            print(f"[CATALOG] {CATALOG_DB} is at version {version}, committed by a run that stopped before "
+                  f"publishing it")
+            return version
+        print(f"[CATALOG] {CATALOG_DB} is at version {store.version()}, state.json expects {expected_version}: "
+              f"rebuilding it from {CATALOG_FILE}")
+        drop_catalog_store()
+        store = catalog_store()
+    version = expected_version
+    if os.path.exists(CATALOG_SPOOL):
+        origin, records = CATALOG_SPOOL, iter_ndjson(CATALOG_SPOOL)
+    else:
+        try:
+            with open(CATALOG_FILE, "r", encoding="utf-8") as f:
+                published = json.load(f)
+            records, version = published.get("movies", []), published.get("version", 0)
+        except Exception:
+            records = []
+        origin = CATALOG_FILE
+    updated_at = datetime.now(timezone.utc).isoformat()
+    store.begin()
+    batch, count = [], 0
+    for record in records:
+        count += 1
+        batch.append((count, record))
+        if len(batch) >= CATALOG_BATCH:
+            store.write([], batch, updated_at)
+            batch = []
+    store.write([], batch, updated_at)
+    if version is not None:
+        store.set_version(version)
+    store.commit()
+    if origin == CATALOG_SPOOL:
+        os.remove(CATALOG_SPOOL)
+    if count:
+        print(f"[CATALOG] Seeded {CATALOG_DB} with {count} records from {origin}")
+    return version
+
+def merge_record(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+    merged = dict(old)
+    merged.update(new)
+    # "category" stays where the title was first seen, so it doesn't churn
+    if old.get("category"):
+        merged["category"] = old["category"]
+    if old.get("categories") or new.get("categories"):
+        categories = list(old.get("categories") or [])
+        for category in new.get("categories") or []:
+            if category not in categories:
+                categories.append(category)
+        merged["categories"] = categories
+    if old.get("_category_seen") or new.get("_category_seen"):
+        seen = dict(old.get("_category_seen") or {})
+        for category, when in (new.get("_category_seen") or {}).items():
+            seen[category] = max(seen.get(category, 0), when)
+        merged["_category_seen"] = seen
+    return merged
+
+# TMDb list memberships expire: every journaled listing stamps
+# "_category_seen" with the time the title was last listed under each of
+# its categories, and a category the title was not listed under during the
+# last full cursor cycle over that list is dropped (see category_cutoffs).
+def category_seen_rows(seq: int, line: Dict[str, Any]) -> list:
+    source, media_type, _ = record_key(line)
+    if source != "TMDb":
+        return []
+    seen = line.get("_category_seen") or {}
+    return [(media_type, category, seen.get(category, 0), seq) for category in record_categories(line)]
+
+def expire_memberships(line: Dict[str, Any], cutoffs: Dict[tuple, int]) -> Dict[str, Any]:
+    def prune(member):
+        source, media_type, _ = record_key(member)
+        seen = member.get("_category_seen") or {}
+        categories = record_categories(member)
+        kept = [c for c in categories if source != "TMDb" or seen.get(c, 0) >= cutoffs.get((media_type, c), 0)]
+        if kept == categories:
+            return member
+        return dict(member, categories=kept, _category_seen={c: seen[c] for c in kept if c in seen})
+
+    if line.get("_members"):
+        return build_canonical([prune(member) for member in line["_members"]])
+    return prune(line)
+
+BREAKDOWN_KEYS = {
+    ("TMDb", "movie"): "tmdb_movies", ("TMDb", "tv"): "tmdb_tv",
+    ("TVMaze", "tv"): "tvmaze_shows", ("Wikidata", "movie"): "wikidata_movies"
+}
 
-if not TMDB_API_KEY or not TMDB_ACCESS_TOKEN:
-    print("[ERROR] TMDB_API_KEY or TMDB_ACCESS_TOKEN not set in environment variables.")
-    exit(1)
+def new_catalog_stats() -> Dict[str, Any]:
+    return {
+        "total_entries": 0,
+        "merged_entries": 0,
+        "breakdown": {name: 0 for name in BREAKDOWN_KEYS.values()},
+        "tmdb_categories": {},
+        "tmdb_tv_categories": {},
+        # Record keys in store order, i.e. by offset in movies.json
+        "keys": [],
+    }
 
-CURRENCY_MAP = {
-    "US": "$", "GB": "£", "EU": "€", "IN": "₹", "JP": "¥"
+def add_catalog_stats(stats: Dict[str, Any], record: Dict[str, Any]) -> None:
+    # A title listed in several categories counts once per category
+    source, media_type, _ = record_key(record)
+    stats["keys"].append(record_key(record))
+    stats["total_entries"] += 1
+    if record.get("_members"):
+        stats["merged_entries"] += 1
+    name = BREAKDOWN_KEYS.get((source, media_type))
+    if name:
+        stats["breakdown"][name] += 1
+    if source != "TMDb":
+        return
+    counts = stats["tmdb_tv_categories"] if media_type == "tv" else stats["tmdb_categories"]
+    for category in record_categories(record):
+        counts[category] = counts.get(category, 0) + 1
+
+# Entity resolution: records for the same title from different sources are
+# folded into one canonical record. Matching uses external IDs first and a
+# normalized title+year key as fallback, through hash indexes and
+# union-find, so the work stays near-linear. Catalog rows for merged titles
+# keep the raw source records under "_members" so they can be re-merged
+# whenever one source updates; "_" fields never reach published outputs.
+SOURCE_PRIORITY = {"TMDb": 0, "TVMaze": 1, "Wikidata": 2}
+# Fields that identify a member record rather than describe the title
+MEMBER_ONLY_FIELDS = {"id", "source", "type", "category", "categories"}
+
+def members_of(line: Dict[str, Any]) -> list:
+    return line.get("_members") or [line]
+
+def public_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in record.items() if not k.startswith("_")}
+
+def normalize_title(title: str) -> str:
+    text = unicodedata.normalize("NFKD", title or "").encode("ascii", "ignore").decode("ascii").lower()
+    text = re.sub(r"[^a-z0-9]+", " ", text).strip()
+    return text[4:] if text.startswith("the ") else text
+
+def resolution_ids(record: Dict[str, Any]) -> Dict[str, str]:
+    # namespace -> value, e.g. {"imdb": "tt0903747", "tmdb_tv": "1396"}
+    source, media_type, ident = record_key(record)
+    ids = {}
+    if source == "TMDb":
+        ids[f"tmdb_{media_type}"] = str(ident)
+    elif source == "TVMaze":
+        ids["tvmaze"] = str(ident)
+    elif source == "Wikidata" and str(ident).startswith("Q"):
+        ids["wikidata"] = str(ident)
+    external = record.get("external_ids") or {}
+    for namespace, field in (("imdb", "imdb_id"), ("tvdb", "tvdb_id"), ("wikidata", "wikidata_id"),
+                             ("tmdb_movie", "tmdb_movie_id"), ("tmdb_tv", "tmdb_tv_id")):
+        if external.get(field):
+            ids.setdefault(namespace, str(external[field]))
+    return ids
+
+def title_year_key(record: Dict[str, Any]):
+    year = str(record.get("year") or "")
+    title = normalize_title(record.get("title"))
+    if not title or not year.isdigit():
+        return None
+    return (record_key(record)[1], title, year)
+
+def _is_empty(value) -> bool:
+    return value is None or value == "" or value == "N/A" or value == [] or value == {}
+
+def sort_key(key: tuple) -> tuple:
+    source, media_type, ident = key
+    numeric = isinstance(ident, int)
+    return (SOURCE_PRIORITY.get(source, 99), media_type or "", not numeric, ident if numeric else 0, str(ident))
+
+def build_canonical(members: list) -> Dict[str, Any]:
+    members = sorted(members, key=lambda m: sort_key(record_key(m)))
+    if len(members) == 1:
+        return members[0]
+    record = dict(members[0])
+    provenance = {}
+    external_ids = dict(record.get("external_ids") or {})
+    for other in members[1:]:
+        for field, value in other.items():
+            if field in MEMBER_ONLY_FIELDS or field.startswith("_") or field == "external_ids":
+                continue
+            if _is_empty(record.get(field)) and not _is_empty(value):
+                record[field] = value
+                provenance[field] = other.get("source")
+        for name, value in (other.get("external_ids") or {}).items():
+            external_ids.setdefault(name, value)
+    if external_ids:
+        record["external_ids"] = external_ids
+    # Fields not listed in "provenance" come from "source"
+    record["sources"] = [delta_key(record_key(m)) for m in members]
+    if provenance:
+        record["provenance"] = provenance
+    record["_members"] = members
+    return record
+
+class EntityIndex:
+    # Union-find over nodes (catalog rows and new records) joined through
+    # shared IDs; nodes with conflicting IDs in one namespace never merge
+    def __init__(self):
+        self.parent = {}
+        self.ids = {}
+        self.by_id = {}
+        self.by_title = {}
+
+    def find(self, node):
+        root = node
+        while self.parent.get(root, root) != root:
+            root = self.parent[root]
+        while node != root:
+            self.parent[node], node = root, self.parent.get(node, node)
+        return root
+
+    def _union(self, a, b) -> None:
+        ra, rb = self.find(a), self.find(b)
+        if ra == rb:
+            return
+        ids_a, ids_b = self.ids.get(ra, {}), self.ids.get(rb, {})
+        if any(ids_a[ns] != value for ns, value in ids_b.items() if ns in ids_a):
+            return
+        self.parent[rb] = ra
+        ids_a.update(ids_b)
+        self.ids[ra] = ids_a
+        self.ids.pop(rb, None)
+
+    def add(self, node, record: Dict[str, Any]) -> None:
+        root = self.find(node)
+        ids = resolution_ids(record)
+        root_ids = self.ids.setdefault(root, {})
+        for namespace, value in ids.items():
+            root_ids.setdefault(namespace, value)
+        # A movie and a TV show never merge, even if an ID collides
+        media_type = record_key(record)[1]
+        root_ids.setdefault("type", media_type)
+        for namespace, value in ids.items():
+            other = self.by_id.setdefault((media_type, namespace, value), node)
+            if other != node:
+                self._union(other, node)
+        weak = title_year_key(record)
+        if weak:
+            other = self.by_title.setdefault(weak, node)
+            if other != node:
+                self._union(other, node)
+
+def line_links(line: Dict[str, Any]) -> set:
+    # (type, namespace, value) rows for catalog_links, over every member
+    links = set()
+    for member in members_of(line):
+        media_type = record_key(member)[1]
+        for namespace, value in resolution_ids(member).items():
+            links.add((media_type, namespace, value))
+        weak = title_year_key(member)
+        if weak:
+            links.add((media_type, "title", f"{weak[2]}:{weak[1]}"))
+    return links
+
+def merge_catalog(updates, delta: Dict[str, Any], cutoffs: Dict[tuple, int] = None) -> Dict[str, Any]:
+    # Fold this run's records into the store, resolving entities across
+    # sources and noting what changed in `delta`. Only rows an update links
+    # to (through a member key, an external ID or title+year, followed
+    # transitively) are loaded and re-resolved, so the rest of the catalog
+    # is never decoded. A merged title takes the position of the last row it
+    # absorbs and new titles are appended, which keeps movies.json's order.
+    # Updates are resolved in batches of MERGE_BATCH raw keys; a key seen
+    # again in a later batch merges onto the row the earlier one wrote, and
+    # the delta lists the steps in order. List memberships older than their
+    # category's cutoff are dropped last. Changes stay in one open
+    # transaction until commit_catalog().
+    ensure_catalog_store()
+    store = catalog_store()
+    updated_at = datetime.now(timezone.utc).isoformat()
+    store.begin()
+    records = {}
+    for record in updates:
+        raw_key = record_key(record)
+        records[raw_key] = merge_record(records[raw_key], record) if raw_key in records else record
+        if len(records) >= MERGE_BATCH:
+            merge_batch(store, records, delta, updated_at)
+            records = {}
+    merge_batch(store, records, delta, updated_at)
+    records = None
+
+    expired = sorted(store.expired_seqs(cutoffs or {}))
+    for i in range(0, len(expired), CATALOG_BATCH):
+        batch = []
+        for seq, line in sorted(store.rows(expired[i:i + CATALOG_BATCH]).items()):
+            pruned = expire_memberships(line, cutoffs)
+            change = diff_record(record_key(line), public_record(line), public_record(pruned))
+            if change:
+                delta["changed"].append(change)
+            batch.append((seq, pruned))
+        store.write([], batch, updated_at)
+    if expired:
+        print(f"[CATALOG] {len(expired)} titles dropped list memberships not seen in the last full cycle")
+    return store.stats()
+
+def merge_batch(store: CatalogStore, records: Dict[tuple, Dict[str, Any]], delta: Dict[str, Any],
+                updated_at: str) -> None:
+    # records: raw key -> this batch's record for it
+    if not records:
+        return
+    seqs = set()
+    queued = set()
+    for raw_key, record in records.items():
+        seq = store.member_seq(raw_key)
+        if seq is not None:
+            seqs.add(seq)
+        queued |= line_links(record)
+    lines = {}
+    checked = set()
+    while queued:
+        checked |= queued
+        seqs |= store.linked_seqs(queued)
+        queued = set()
+        for seq, line in store.rows(seqs - set(lines)).items():
+            lines[seq] = line
+            queued |= line_links(line) - checked
+
+    index = EntityIndex()
+    member_of = {}
+    seq_of = {}
+    for seq in sorted(lines):
+        key = record_key(lines[seq])
+        seq_of[key] = seq
+        for member in members_of(lines[seq]):
+            member_of[record_key(member)] = key
+            index.add(key, member)
+
+    pending = {}
+    for raw_key, record in records.items():
+        node = member_of.get(raw_key, raw_key)
+        index.add(node, record)
+        pending.setdefault(node, {})[raw_key] = record
+    records = None
+
+    groups = {}
+    for seq in sorted(lines):
+        groups.setdefault(index.find(record_key(lines[seq])), []).append(lines[seq])
+    pending_by_root = {}
+    for node, bucket in pending.items():
+        pending_by_root.setdefault(index.find(node), []).extend(bucket.values())
+
+    removed, batch = [], []
+    next_seq = store.max_seq()
+
+    def emit(seq, old_lines, new_records) -> None:
+        members = {}
+        for line in old_lines:
+            for member in members_of(line):
+                members[record_key(member)] = member
+        for record in new_records:
+            raw_key = record_key(record)
+            members[raw_key] = merge_record(members[raw_key], record) if raw_key in members else record
+        line = build_canonical(list(members.values()))
+        key = record_key(line)
+        old_by_key = {record_key(old): old for old in old_lines}
+        for old_key in old_by_key:
+            if old_key != key:
+                delta["removed"].append(delta_key(old_key))
+            if seq_of[old_key] != seq:
+                removed.append(seq_of[old_key])
+        if key in old_by_key:
+            change = diff_record(key, public_record(old_by_key[key]), public_record(line))
+            if change:
+                delta["changed"].append(change)
+            elif len(old_lines) == 1 and line == old_lines[0]:
+                return
+        else:
+            delta["added"].append(public_record(line))
+        batch.append((seq, line))
+        if len(batch) >= CATALOG_BATCH:
+            store.write(removed, batch, updated_at)
+            removed.clear()
+            batch.clear()
+
+    # Rewritten groups in movies.json order, then new titles in key order
+    # (sources journal in parallel, so arrival order isn't deterministic)
+    for root, old_lines in sorted(groups.items(), key=lambda item: seq_of[record_key(item[1][-1])]):
+        if len(old_lines) > 1 or root in pending_by_root:
+            emit(seq_of[record_key(old_lines[-1])], old_lines, pending_by_root.pop(root, []))
+    for root in sorted(pending_by_root, key=sort_key):
+        next_seq += 1
+        emit(next_seq, [], pending_by_root[root])
+    store.write(removed, batch, updated_at)
+
+def commit_catalog(version: int) -> None:
+    store = catalog_store()
+    store.set_version(version)
+    store.commit()
+
+# Output compression: the compact JSON is serialized once to a plain temp
+# file, then every codec in OUTPUT_CODECS compresses those same bytes, each
+# on its own worker (zlib, brotli and zstd release the GIL while they work).
+# gzip is always produced; br/zst need their optional modules.
+OUTPUT_CODECS = _get_list_env("OUTPUT_CODECS", "gzip")
+CODEC_EXTENSIONS = {"gzip": ".gz", "br": ".br", "zstd": ".zst"}
+GZIP_LEVEL = _get_int_env("GZIP_LEVEL", 9)
+BROTLI_QUALITY = _get_int_env("BROTLI_QUALITY", 9)
+ZSTD_LEVEL = _get_int_env("ZSTD_LEVEL", 12)
+COMPRESS_WORKERS = _get_int_env("COMPRESS_WORKERS", os.cpu_count() or 2)
+# Sizes and ratios of the last compression stage, for the run summary
+COMPRESSION_STATS = []
+_output_codecs = []
+
+def output_codecs() -> list:
+    if _output_codecs:
+        return _output_codecs
+    codecs = _output_codecs
+    codecs.append("gzip")
+    for codec in OUTPUT_CODECS:
+        codec = codec.lower()
+        if codec in codecs:
+            continue
+        if codec not in CODEC_EXTENSIONS:
+            print(f"[COMPRESS] Unknown codec {codec!r}, skipping")
+        elif codec == "br" and brotli is None:
+            print("[COMPRESS] brotli is not installed (pip install brotli), skipping br")
+        elif codec == "zstd" and zstandard is None:
+            print("[COMPRESS] zstandard is not installed (pip install zstandard), skipping zstd")
+        else:
+            codecs.append(codec)
+    return codecs
+
+def compress_file(src: str, dst: str, codec: str, zstd_dict=None) -> None:
+    chunk = 1 << 20
+    with open(src, "rb") as source, open(dst, "wb") as out:
+        if codec == "gzip":
+            # mtime=0 keeps the bytes stable for unchanged content
+            with gzip.GzipFile(filename="", mode="wb", fileobj=out, compresslevel=GZIP_LEVEL, mtime=0) as gz:
+                shutil.copyfileobj(source, gz, chunk)
+        elif codec == "br":
+            compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+            for block in iter(lambda: source.read(chunk), b""):
+                out.write(compressor.process(block))
+            out.write(compressor.finish())
+        elif codec == "zstd":
+            compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=zstd_dict)
+            with compressor.stream_writer(out, closefd=False) as writer:
+                shutil.copyfileobj(source, writer, chunk)
+        else:
+            raise ValueError(f"unknown codec {codec}")
+
+def compress_outputs(jobs: list, label: str = "") -> list:
+    # jobs: (plain source, destination, codec[, zstd dictionary]). Every
+    # destination is written to .tmp and renamed once all jobs succeed.
+    # Returns one stats dict per job.
+    def run(job):
+        src, dst, codec = job[:3]
+        started = time.perf_counter()
+        compress_file(src, dst + ".tmp", codec, job[3] if len(job) > 3 else None)
+        raw, size = os.path.getsize(src), os.path.getsize(dst + ".tmp")
+        return {"file": dst, "codec": codec, "raw_bytes": raw, "bytes": size,
+                "ratio": round(raw / size, 2) if size else None, "seconds": round(time.perf_counter() - started, 3)}
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, min(COMPRESS_WORKERS, len(jobs)))) as pool:
+        results = list(pool.map(run, jobs))
+    for result in results:
+        os.replace(result["file"] + ".tmp", result["file"])
+    METRICS.add_stage("compress", time.perf_counter() - started)
+    if label:
+        COMPRESSION_STATS.extend(dict(result, output=label) for result in results)
+    return results
+
+def print_compression_summary() -> None:
+    # Shard parts are summed per codec so the summary stays one line each
+    totals = {}
+    for result in COMPRESSION_STATS:
+        key = (result["output"], result["codec"])
+        entry = totals.setdefault(key, {"raw_bytes": 0, "bytes": 0, "seconds": 0.0})
+        entry["raw_bytes"] += result["raw_bytes"]
+        entry["bytes"] += result["bytes"]
+        entry["seconds"] += result["seconds"]
+    if not totals:
+        return
+    print("📦 Compressed outputs:")
+    for (output, codec), entry in totals.items():
+        ratio = entry["raw_bytes"] / entry["bytes"] if entry["bytes"] else 0
+        print(f"   • {output} [{codec}]: {entry['bytes']} bytes (ratio {ratio:.2f}, {entry['seconds']:.2f}s)")
+
+def catalog_encodings(base: str) -> Dict[str, str]:
+    return {codec: base + CODEC_EXTENSIONS[codec] for codec in output_codecs()}
+
+def write_catalog_outputs(header: Dict[str, Any]) -> None:
+    # Single pass over the store feeding movies.json (indent=2) and the
+    # compact serialization, which is then compressed once per codec. Every
+    # file goes to a temp name first and is renamed into place at the end,
+    # so readers never see a half-written file.
+    json_tmp = CATALOG_FILE + ".tmp"
+    min_tmp = CATALOG_FILE + ".min.tmp"
+    pretty_head = json.dumps(header, ensure_ascii=False, indent=2)[:-2]
+    compact_head = json.dumps(header, ensure_ascii=False)[:-1]
+    started = time.perf_counter()
+    with open(json_tmp, "w", encoding="utf-8") as pretty, open(min_tmp, "w", encoding="utf-8") as compact:
+        pretty.write(pretty_head + ',\n  "movies": [')
+        compact.write(compact_head + ', "movies": [')
+        first = True
+        for record in catalog_store().records():
+            record = public_record(record)
+            body = json.dumps(record, ensure_ascii=False, indent=2).replace("\n", "\n    ")
+            pretty.write(("\n    " if first else ",\n    ") + body)
+            compact.write(("" if first else ", ") + json.dumps(record, ensure_ascii=False))
+            first = False
+        pretty.write("]\n}" if first else "\n  ]\n}")
+        compact.write("]}")
+    METRICS.add_stage("serialize", time.perf_counter() - started)
+    compress_outputs([(min_tmp, path, codec) for codec, path in catalog_encodings(CATALOG_FILE).items()], CATALOG_FILE)
+    os.remove(min_tmp)
+    os.replace(json_tmp, CATALOG_FILE)
+
+# Delta feed: each run that changes the catalog bumps its version and
+# writes deltas/delta_<version>.json.gz with the added, changed (field
+# level) and removed records since the previous version. The last
+# DELTA_KEEP deltas are kept so clients can patch forward.
+DELTA_DIR = "deltas"
+DELTA_KEEP = _get_int_env("DELTA_KEEP", 96)
+
+def new_delta() -> Dict[str, Any]:
+    return {"added": [], "changed": [], "removed": []}
+
+def delta_key(key: tuple) -> Dict[str, Any]:
+    return {"source": key[0], "type": key[1], "id": key[2]}
+
+def diff_record(key: tuple, old: Dict[str, Any], new: Dict[str, Any]):
+    changed = {k: v for k, v in new.items() if old.get(k) != v or k not in old}
+    unset = [k for k in old if k not in new]
+    if not changed and not unset:
+        return None
+    entry = dict(delta_key(key), set=changed)
+    if unset:
+        entry["unset"] = unset
+    return entry
+
+def delta_size(delta: Dict[str, Any]) -> int:
+    return len(delta["added"]) + len(delta["changed"]) + len(delta["removed"])
+
+def delta_path(version: int) -> str:
+    return os.path.join(DELTA_DIR, f"delta_{version}.json.gz")
+
+def write_delta(delta: Dict[str, Any], version: int) -> None:
+    os.makedirs(DELTA_DIR, exist_ok=True)
+    payload = dict(
+        delta,
+        from_version=version - 1,
+        version=version,
+        generated_at=datetime.now(timezone.utc).isoformat()
+    )
+    tmp_path = delta_path(version) + ".tmp"
+    with open(tmp_path, "wb") as raw:
+        with gzip.GzipFile(filename="", mode="wb", fileobj=raw, mtime=0) as f:
+            f.write(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+    os.replace(tmp_path, delta_path(version))
+
+def prune_deltas(version: int) -> int:
+    # Returns the oldest version still available
+    oldest = version
+    try:
+        names = os.listdir(DELTA_DIR)
+    except FileNotFoundError:
+        return oldest
+    for name in names:
+        if not (name.startswith("delta_") and name.endswith(".json.gz")):
+            continue
+        try:
+            v = int(name[len("delta_"):-len(".json.gz")])
+        except ValueError:
+            continue
+        if v <= version - DELTA_KEEP:
+            os.remove(os.path.join(DELTA_DIR, name))
+        else:
+            oldest = min(oldest, v)
+    return oldest
+
+# Optional sharded output: per source/type and per TMDb category shards,
+# split into size-bounded chunks (one file per codec), plus a manifest with
+# counts, sizes and hashes so clients fetch only the shards they need. With
+# zstd enabled and SHARD_ZSTD_DICT_KB set, the .zst parts share a dictionary
+# trained on this run's records (shards/shards.zstd.dict).
+SHARDED_OUTPUT = _get_int_env("SHARDED_OUTPUT", 0) == 1
+SHARD_DIR = "shards"
+SHARD_MAX_BYTES = _get_int_env("SHARD_MAX_KB", 2048) * 1024
+SHARD_ZSTD_DICT_KB = _get_int_env("SHARD_ZSTD_DICT_KB", 0)
+SHARD_DICT_SAMPLES = 5000
+
+class ShardWriter:
+    def __init__(self, out_dir: str, name: str, meta: Dict[str, Any], max_bytes: int):
+        self.out_dir = out_dir
+        self.name = name
+        self.meta = meta
+        self.max_bytes = max_bytes
+        self.entries = []
+        self.file = None
+
+    def _open_part(self) -> None:
+        # Plain JSON here; write_shard_outputs compresses every part per codec
+        part = len(self.entries) + 1
+        filename = f"{self.name}.part{part:03d}.json"
+        self.file = open(os.path.join(self.out_dir, filename), "wb")
+        self.entries.append({"file": filename, "part": part, "records": 0, "raw_bytes": 0})
+        self.file.write(b"[")
+
+    def _close_part(self) -> None:
+        self.file.write(b"]")
+        self.file.close()
+        self.file = None
+
+    def write(self, line: bytes) -> None:
+        if self.file is not None and self.entries[-1]["raw_bytes"] + len(line) > self.max_bytes:
+            self._close_part()
+        if self.file is None:
+            self._open_part()
+        entry = self.entries[-1]
+        if entry["records"]:
+            self.file.write(b",")
+        self.file.write(line)
+        entry["records"] += 1
+        entry["raw_bytes"] += len(line)
+
+    def close(self) -> list:
+        if self.file is not None:
+            self._close_part()
+        return [dict(self.meta, shard=self.name, **entry) for entry in self.entries]
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def write_shard_outputs(header: Dict[str, Any]) -> int:
+    # One pass over the store; each record goes to its source/type shard and
+    # to one shard per TMDb category it belongs to. The new shard set is
+    # built next to the old one and swapped in at the end.
+    tmp_dir = SHARD_DIR + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    writers = {}
+
+    def writer(name: str, meta: Dict[str, Any]) -> ShardWriter:
+        if name not in writers:
+            writers[name] = ShardWriter(tmp_dir, name, meta, SHARD_MAX_BYTES)
+        return writers[name]
+
+    samples = []
+    for count, record in enumerate(catalog_store().records()):
+        source, media_type, _ = record_key(record)
+        line = json.dumps(public_record(record), ensure_ascii=False).encode("utf-8")
+        if len(samples) < SHARD_DICT_SAMPLES:
+            samples.append(line)
+        elif random.randrange(count + 1) < SHARD_DICT_SAMPLES:
+            samples[random.randrange(SHARD_DICT_SAMPLES)] = line
+        base = f"{(source or 'unknown').lower()}_{media_type}"
+        writer(base, {"source": source, "type": media_type}).write(line)
+        if source == "TMDb":
+            for category in record_categories(record):
+                writer(f"{base}_{category}", {"source": source, "type": media_type, "category": category}).write(line)
+
+    shards = []
+    for name in sorted(writers):
+        shards.extend(writers[name].close())
+
+    codecs = output_codecs()
+    zstd_dict = None
+    manifest = dict(header)
+    if "zstd" in codecs and SHARD_ZSTD_DICT_KB > 0 and len(samples) >= 8:
+        try:
+            zstd_dict = zstandard.train_dictionary(SHARD_ZSTD_DICT_KB * 1024, samples)
+            dict_path = os.path.join(tmp_dir, "shards.zstd.dict")
+            with open(dict_path, "wb") as f:
+                f.write(zstd_dict.as_bytes())
+            manifest["zstd_dictionary"] = {"file": "shards.zstd.dict", "dict_id": zstd_dict.dict_id(),
+                                           "bytes": os.path.getsize(dict_path), "sha256": file_sha256(dict_path)}
+        except Exception as e:
+            print(f"[COMPRESS] zstd dictionary training failed, compressing shards without one: {e}")
+            zstd_dict = None
+    jobs = []
+    for shard in shards:
+        raw_path = os.path.join(tmp_dir, shard["file"])
+        for codec in codecs:
+            jobs.append((raw_path, raw_path + CODEC_EXTENSIONS[codec], codec, zstd_dict if codec == "zstd" else None))
+    compress_outputs(jobs, SHARD_DIR)
+    for shard in shards:
+        raw_path = os.path.join(tmp_dir, shard["file"])
+        shard["encodings"] = {}
+        for codec in codecs:
+            path = raw_path + CODEC_EXTENSIONS[codec]
+            shard["encodings"][codec] = {"file": shard["file"] + CODEC_EXTENSIONS[codec],
+                                         "bytes": os.path.getsize(path), "sha256": file_sha256(path)}
+        os.remove(raw_path)
+        # Top-level file/bytes/sha256 stay the gzip part, as before
+        shard.update(shard["encodings"]["gzip"])
+    manifest["shards"] = shards
+    with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    old_dir = SHARD_DIR + ".old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(SHARD_DIR):
+        os.replace(SHARD_DIR, old_dir)
+    os.replace(tmp_dir, SHARD_DIR)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return len(shards)
+
+# Optional compact encoding (movies.compact.json.gz). Watch providers are
+# kept only for COMPACT_PROVIDER_REGIONS, and repeated values are hoisted
+# into top-level tables that records point at by index:
+#   genres -> tables.genres, directors/writers/creators/cast[].name -> tables.people,
+#   providers[region][kind] -> tables.providers, poster/cast[].profile -> [tables.images index, path]
+# The header carries "encoding": {"name": "compact", "version": N}; bump the
+# version whenever the layout changes.
+COMPACT_OUTPUT = _get_int_env("COMPACT_OUTPUT", 0) == 1
+COMPACT_BASE = "movies.compact.json"
+COMPACT_FILE = COMPACT_BASE + ".gz"
+COMPACT_ENCODING_VERSION = 1
+COMPACT_PROVIDER_REGIONS = _get_list_env("COMPACT_PROVIDER_REGIONS", "US,GB,IN")
+PEOPLE_FIELDS = ("directors", "writers", "creators")
+
+class CompactEncoder:
+    def __init__(self, regions):
+        # "*" keeps every region
+        self.regions = None if "*" in regions else {r.upper() for r in regions}
+        self.tables = {"images": [], "genres": [], "people": [], "providers": []}
+        self.index = {name: {} for name in self.tables}
+
+    def ref(self, table: str, key, value=None) -> int:
+        index = self.index[table]
+        if key not in index:
+            index[key] = len(self.tables[table])
+            self.tables[table].append(key if value is None else value)
+        return index[key]
+
+    def image(self, url):
+        # TMDb URLs split after the size segment, anything else after the host
+        if not isinstance(url, str) or not url.startswith("http"):
+            return url
+        match = re.match(r"(https?://image\.tmdb\.org/t/p/[^/]+)(/.*)", url)
+        if not match:
+            parts = urlsplit(url)
+            prefix = f"{parts.scheme}://{parts.netloc}"
+            match = re.match(f"({re.escape(prefix)})(.*)", url)
+        return [self.ref("images", match.group(1)), match.group(2)]
+
+    def providers(self, providers):
+        encoded = {}
+        for region, entry in sorted((providers or {}).items()):
+            if self.regions is not None and region.upper() not in self.regions:
+                continue
+            encoded[region] = {
+                kind: [self.ref("providers", p.get("provider_id"),
+                                {"id": p.get("provider_id"), "name": p.get("provider_name"), "logo": p.get("logo_path")})
+                       for p in value] if isinstance(value, list) else value
+                for kind, value in entry.items()
+            }
+        return encoded
+
+    def encode(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        record = dict(record)
+        if "genres" in record:
+            record["genres"] = [self.ref("genres", g) for g in record["genres"] or []]
+        for field in PEOPLE_FIELDS:
+            if field in record:
+                record[field] = [self.ref("people", name) for name in record[field] or []]
+        if "cast" in record:
+            record["cast"] = [
+                {**member, "name": self.ref("people", member.get("name")), "profile": self.image(member.get("profile"))}
+                for member in record["cast"] or []
+            ]
+        if "poster" in record:
+            record["poster"] = self.image(record["poster"])
+        if "providers" in record:
+            record["providers"] = self.providers(record["providers"])
+        return record
+
+def write_compact_output(header: Dict[str, Any]) -> int:
+    # Records are encoded into a temp body first because the tables they
+    # fill have to come before them in the output
+    encoder = CompactEncoder(COMPACT_PROVIDER_REGIONS)
+    body_tmp = COMPACT_BASE + ".body.tmp"
+    count = 0
+    with open(body_tmp, "w", encoding="utf-8") as body:
+        for record in catalog_store().records():
+            body.write(("" if count == 0 else ", ") + json.dumps(encoder.encode(public_record(record)), ensure_ascii=False))
+            count += 1
+    head = dict(header)
+    head["encoding"] = {"name": "compact", "version": COMPACT_ENCODING_VERSION,
+                        "provider_regions": sorted(encoder.regions) if encoder.regions is not None else "*"}
+    head["tables"] = encoder.tables
+    out_tmp = COMPACT_BASE + ".min.tmp"
+    with open(out_tmp, "w", encoding="utf-8") as out, open(body_tmp, "r", encoding="utf-8") as body:
+        out.write(json.dumps(head, ensure_ascii=False)[:-1] + ', "movies": [')
+        shutil.copyfileobj(body, out)
+        out.write("]}")
+    os.remove(body_tmp)
+    compress_outputs([(out_tmp, path, codec) for codec, path in catalog_encodings(COMPACT_BASE).items()], COMPACT_BASE)
+    os.remove(out_tmp)
+    return count
+
+# Search index (search_index.json.gz, one file per codec): normalized-token
+# postings for title, cast, crew (directors/creators) and genres, plus
+# facets by year, origin_country and provider. Every posting list holds
+# offsets into the "movies" array of movies.json, sorted and gap-encoded
+# (first offset, then differences). The index states the catalog version it
+# was built for, and movies.json's header points at it, so clients fetch it
+# only when they need search. Bump SEARCH_INDEX_VERSION whenever the layout
+# changes.
+# When a run publishes a delta on top of the previous index, that index is
+# patched instead of rebuilt: postings are remapped to the new offsets and
+# only added/changed records are re-read from the store and re-tokenized.
+# .cache/search_index_docs.json maps the previous offsets to record keys.
+SEARCH_INDEX = _get_int_env("SEARCH_INDEX", 1) == 1
+SEARCH_INDEX_BASE = "search_index.json"
+SEARCH_INDEX_FILE = SEARCH_INDEX_BASE + ".gz"
+SEARCH_INDEX_VERSION = 1
+SEARCH_DOCS_FILE = os.path.join(".cache", "search_index_docs.json")
+SEARCH_FIELDS = ("title", "cast", "crew", "genres")
+SEARCH_FACETS = ("year", "origin_country", "provider")
+
+def search_tokens(text) -> set:
+    # Accents are stripped but non-Latin scripts are kept, unlike normalize_title
+    text = unicodedata.normalize("NFKD", str(text or "")).casefold()
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return set(re.findall(r"\w+", text))
+
+def search_terms(record: Dict[str, Any]) -> Dict[str, set]:
+    # (field or facet) -> terms for one record
+    terms = {name: set() for name in SEARCH_FIELDS + SEARCH_FACETS}
+    terms["title"] = search_tokens(record.get("title"))
+    for member in record.get("cast") or []:
+        if isinstance(member, dict):
+            terms["cast"] |= search_tokens(member.get("name"))
+    for name in (record.get("directors") or []) + (record.get("creators") or []):
+        terms["crew"] |= search_tokens(name)
+    for genre in record.get("genres") or []:
+        terms["genres"] |= search_tokens(genre)
+    year = str(record.get("year") or "")
+    if year.isdigit():
+        terms["year"].add(year)
+    if isinstance(record.get("origin_country"), str) and record["origin_country"]:
+        terms["origin_country"].add(record["origin_country"].upper())
+    for entry in (record.get("providers") or {}).values():
+        for value in (entry.values() if isinstance(entry, dict) else []):
+            for provider in value if isinstance(value, list) else []:
+                if isinstance(provider, dict) and provider.get("provider_name"):
+                    terms["provider"].add(provider["provider_name"])
+    return terms
+
+def new_search_postings() -> Dict[str, Dict[str, list]]:
+    return {name: {} for name in SEARCH_FIELDS + SEARCH_FACETS}
+
+def add_search_postings(postings: Dict[str, Dict[str, list]], offset: int, record: Dict[str, Any]) -> None:
+    for name, terms in search_terms(record).items():
+        table = postings[name]
+        for term in terms:
+            table.setdefault(term, []).append(offset)
+
+def gap_encode(offsets: list) -> list:
+    offsets = sorted(offsets)
+    return [offset - prev for offset, prev in zip(offsets, [0] + offsets[:-1])]
+
+def gap_decode(gaps: list) -> list:
+    return list(itertools.accumulate(gaps))
+
+def load_search_index(version: int):
+    # Previous index + offset keys, or None when they can't be patched to `version`
+    try:
+        with gzip.open(SEARCH_INDEX_FILE, "rt", encoding="utf-8") as f:
+            index = json.load(f)
+        with open(SEARCH_DOCS_FILE, "r", encoding="utf-8") as f:
+            docs = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (index.get("format_version") != SEARCH_INDEX_VERSION or index.get("catalog_version") != version
+            or docs.get("catalog_version") != version or len(docs.get("keys", [])) != index.get("docs")):
+        return None
+    postings = new_search_postings()
+    for group in ("fields", "facets"):
+        for name, table in index.get(group, {}).items():
+            if name in postings:
+                postings[name] = {term: gap_decode(gaps) for term, gaps in table.items()}
+    return postings, [tuple(key) for key in docs["keys"]]
+
+def patch_search_index(previous, delta: Dict[str, Any], keys: list):
+    # Existing postings move to their record's new offset; changed and new
+    # records are looked up in the store by key (only those rows are decoded)
+    # and records no longer in the catalog drop out
+    postings, old_keys = previous
+    offsets = {key: offset for offset, key in enumerate(keys)}
+    changed = {(change["source"], change["type"], change["id"]) for change in delta["changed"]}
+    moved = {old: offsets[key] for old, key in enumerate(old_keys) if key in offsets and key not in changed}
+    for table in postings.values():
+        for term in list(table):
+            kept = [moved[offset] for offset in table[term] if offset in moved]
+            if kept:
+                table[term] = kept
+            else:
+                del table[term]
+    kept_keys = set(old_keys) - changed
+    store = catalog_store()
+    for offset, key in enumerate(keys):
+        if key not in kept_keys:
+            record = store.get(key)
+            if record is None:
+                return None
+            add_search_postings(postings, offset, record)
+    return postings, keys
+
+def build_search_index():
+    postings = new_search_postings()
+    keys = []
+    for offset, record in enumerate(catalog_store().records()):
+        add_search_postings(postings, offset, record)
+        keys.append(record_key(record))
+    return postings, keys
+
+def write_search_index(version: int, delta: Dict[str, Any], keys: list) -> str:
+    # Returns "patched" or "rebuilt"
+    built = None
+    if delta_size(delta):
+        previous = load_search_index(version - 1)
+        built = patch_search_index(previous, delta, keys) if previous else None
+    mode = "patched" if built else "rebuilt"
+    postings, keys = built or build_search_index()
+
+    index = {
+        "format": "search-index",
+        "format_version": SEARCH_INDEX_VERSION,
+        "catalog_version": version,
+        "last_updated": datetime.now(timezone.utc).isoformat(),
+        "docs": len(keys),
+        "postings": "gap",
+        "fields": {name: {term: gap_encode(postings[name][term]) for term in sorted(postings[name])}
+                   for name in SEARCH_FIELDS},
+        "facets": {name: {term: gap_encode(postings[name][term]) for term in sorted(postings[name])}
+                   for name in SEARCH_FACETS},
+    }
+    min_tmp = SEARCH_INDEX_BASE + ".min.tmp"
+    with open(min_tmp, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, separators=(",", ":"))
+    compress_outputs([(min_tmp, path, codec) for codec, path in catalog_encodings(SEARCH_INDEX_BASE).items()],
+                     SEARCH_INDEX_BASE)
+    os.remove(min_tmp)
+    os.makedirs(os.path.dirname(SEARCH_DOCS_FILE), exist_ok=True)
+    with open(SEARCH_DOCS_FILE + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"catalog_version": version, "keys": keys}, f, ensure_ascii=False)
+    os.replace(SEARCH_DOCS_FILE + ".tmp", SEARCH_DOCS_FILE)
+    return mode
+
+def require_tmdb_keys() -> None:
+    # Only crawling needs the keys; --merge works offline
+    if not TMDB_API_KEY or not TMDB_ACCESS_TOKEN:
+        print("[ERROR] TMDB_API_KEY or TMDB_ACCESS_TOKEN not set in environment variables.")
+        exit(1)
+
+# One shared session = one connection pool for every fetcher and worker thread
+def _make_session() -> requests.Session:
+    session = requests.Session()
+    # send_request keeps at most MAX_IN_FLIGHT requests open per host
+    adapter = requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=MAX_IN_FLIGHT)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+SESSION = _make_session()
+
+# Per-host adaptive rate limiting (token bucket). Every network request
+# takes a token from its host's bucket. Healthy responses nudge the rate up
+# (additive increase); 429/5xx cut it (multiplicative decrease), and
+# Retry-After / X-RateLimit-* headers pause the whole host until reset.
+HOST_RATE_LIMITS = {
+    # host: (starting requests/sec, max requests/sec)
+    TMDB_HOST: (_get_int_env("RATE_LIMIT_TMDB", 35), _get_int_env("RATE_LIMIT_TMDB_MAX", 50)),
+    TVMAZE_HOST: (_get_int_env("RATE_LIMIT_TVMAZE", 2), _get_int_env("RATE_LIMIT_TVMAZE_MAX", 4)),
+    WIKIDATA_HOST: (_get_int_env("RATE_LIMIT_WIKIDATA", 1), _get_int_env("RATE_LIMIT_WIKIDATA_MAX", 2)),
 }
+DEFAULT_RATE_LIMIT = (5, 10)
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
 
 
-def fetch_tmdb():
-    print("[INFO] Fetching MAXIMUM TMDb data from all categories...")
-    
-    # Define all categories with pagination support
-    categories = {
-        "trending": "https://api.themoviedb.org/3/trending/movie/week",
-        "popular": "https://api.themoviedb.org/3/movie/popular", 
-        "top_rated": "https://api.themoviedb.org/3/movie/top_rated",
-        "now_playing": "https://api.themoviedb.org/3/movie/now_playing",
-        "upcoming": "https://api.themoviedb.org/3/movie/upcoming",
-        "latest": "https://api.themoviedb.org/3/movie/latest"
-    }
-    
-    # Pages to fetch per category (increase for more data)
-    PAGES_PER_CATEGORY = 10  # Fetch 10 pages = 200 movies per category
-    all_movies = []
-    
-    for category, base_url in categories.items():
-        print(f"[INFO] Fetching {category} movies (up to {PAGES_PER_CATEGORY} pages = {PAGES_PER_CATEGORY * 20} movies)...")
-        category_movies = []
-        
-        for page in range(1, PAGES_PER_CATEGORY + 1):
-            try:
-                url = f"{base_url}?api_key={TMDB_API_KEY}&page={page}"
-                
-                # Retry logic for each page
-                for attempt in range(3):
-                    try:
-                        res = requests.get(url, timeout=60)  # Increased timeout
-                        if res.status_code == 200:
-                            break
-                        else:
-                            print(f"[TMDb {category} Page {page} Retry {attempt+1}] Status Code: {res.status_code}")
-                            if attempt < 2:
-                                time.sleep(5)
-                    except Exception as e:
-                        print(f"[TMDb {category} Page {page} Retry {attempt+1}] {e}")
-                        if attempt < 2:
-                            time.sleep(5)
+def parse_retry_after(value) -> float:
+    if not value:
+        return 0.0
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return 0.0
+
+
+# Longest a Retry-After or X-RateLimit-Reset may pause a host; the pause
+# also never runs past the run budget's fetch cutoff
+MAX_HOST_PAUSE = 60.0
+
+
+class BudgetExpiredError(Exception):
+    pass
+
+
+class HostRateLimiter:
+    def __init__(self, rate: float, max_rate: float, min_rate: float = 0.2):
+        self.rate = float(rate)
+        self.max_rate = float(max(rate, max_rate))
+        self.min_rate = min(min_rate, self.rate)
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        # Raises BudgetExpiredError instead of waiting past the fetch cutoff
+        while True:
+            if BUDGET.expired():
+                raise BudgetExpiredError("run budget spent")
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
                 else:
-                    print(f"[TMDb Error] Failed to fetch {category} page {page} after retries")
-                    continue
+                    capacity = max(1.0, self.rate)
+                    self.tokens = min(capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1.0:
+                        self.tokens -= 1.0
+                        return
+                    wait = (1.0 - self.tokens) / self.rate
+            time.sleep(max(0.0, min(wait, BUDGET.left())))
+
+    def pause(self, seconds: float) -> None:
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def on_response(self, status: int, headers) -> None:
+        with self.lock:
+            if status == 429:
+                self.rate = max(self.min_rate, self.rate * 0.5)
+            elif status >= 500:
+                self.rate = max(self.min_rate, self.rate * 0.7)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.01)
+        wait = parse_retry_after(headers.get("Retry-After")) if status in (429, 503) else 0.0
+        if headers.get("X-RateLimit-Remaining") == "0":
+            reset = parse_retry_after(headers.get("X-RateLimit-Reset"))
+            # Reset may be an epoch timestamp or a delta in seconds
+            if reset > time.time() - 1:
+                reset -= time.time()
+            wait = max(wait, reset)
+        wait = min(wait, MAX_HOST_PAUSE, BUDGET.left())
+        if wait > 0:
+            self.pause(wait)
+
+    def on_failure(self) -> None:
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * 0.7)
+
+
+_rate_limiters: Dict[str, HostRateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def rate_limiter(url: str) -> HostRateLimiter:
+    host = urlsplit(url).netloc.lower()
+    with _rate_limiters_lock:
+        if host not in _rate_limiters:
+            rate, max_rate = HOST_RATE_LIMITS.get(host, DEFAULT_RATE_LIMIT)
+            _rate_limiters[host] = HostRateLimiter(rate, max_rate)
+        return _rate_limiters[host]
+
+
+# Per-host request slots: the TMDb movie and TV pipelines (and any other
+# pool on the same host) together keep at most MAX_IN_FLIGHT requests open
+_host_slots: Dict[str, threading.BoundedSemaphore] = {}
+_host_slots_lock = threading.Lock()
+
+
+def host_slots(url: str) -> threading.BoundedSemaphore:
+    host = urlsplit(url).netloc.lower()
+    with _host_slots_lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+        return _host_slots[host]
+
+
+# Per-host circuit breakers: after a host's threshold of consecutive failed
+# requests (network errors, timeouts, 5xx) its breaker opens, and every
+# later request to it fails fast with CircuitOpenError for the rest of the
+# run, skipping retries and backoff sleeps. Any other response resets the
+# count; 429s are left to the rate limiter. 0 disables a host's breaker.
+HOST_CIRCUIT_THRESHOLDS = {
+    TMDB_HOST: _get_int_env("CIRCUIT_BREAKER_TMDB", 10),
+    TVMAZE_HOST: _get_int_env("CIRCUIT_BREAKER_TVMAZE", 3),
+    WIKIDATA_HOST: _get_int_env("CIRCUIT_BREAKER_WIKIDATA", 2),
+}
+DEFAULT_CIRCUIT_THRESHOLD = 5
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, host: str, threshold: int):
+        self.host = host
+        self.threshold = threshold
+        self.failures = 0
+        self.opened_at = None
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def check(self) -> None:
+        if self.opened_at is not None:
+            with self.lock:
+                self.rejected += 1
+            raise CircuitOpenError(f"circuit open for {self.host}")
+
+    def on_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+
+    def on_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if not self.threshold or self.failures < self.threshold or self.opened_at is not None:
+                return
+            self.opened_at = datetime.now(timezone.utc).isoformat()
+        print(f"[CIRCUIT] {self.host}: {self.failures} consecutive failures, failing fast for the rest of the run")
+
+    def summary(self) -> Dict[str, Any]:
+        return {"state": "open" if self.is_open() else "closed", "threshold": self.threshold,
+                "failures": self.failures, "opened_at": self.opened_at, "rejected": self.rejected}
+
 
-                page_movies = []
-                for movie in res.json().get("results", []):
-                    release_date = movie.get("release_date")
-                    year = release_date[:4] if release_date else "N/A"
-                    movie_id = movie.get("id")
-
-                    try:
-                        # Movie details with retry logic
-                        details = None
-                        for attempt in range(2):
-                            try:
-                                details = requests.get(
-                                    f"https://api.themoviedb.org/3/movie/{movie_id}?api_key={TMDB_API_KEY}&append_to_response=watch/providers",
-                                    timeout=60
-                                ).json()
-                                break
-                            except Exception as e:
-                                print(f"[TMDb Details Retry {attempt+1}] {movie.get('title')}: {e}")
-                                if attempt < 1:
-                                    time.sleep(3)
-
-                        if not details:
-                            continue
-
-                        # Credits with retry logic
-                        credits = None
-                        for attempt in range(2):
-                            try:
-                                credits = requests.get(
-                                    f"https://api.themoviedb.org/3/movie/{movie_id}/credits?api_key={TMDB_API_KEY}",
-                                    timeout=60
-                                ).json()
-                                break
-                            except Exception as e:
-                                print(f"[TMDb Credits Retry {attempt+1}] {movie.get('title')}: {e}")
-                                if attempt < 1:
-                                    time.sleep(3)
-
-                        if not credits:
-                            credits = {"cast": [], "crew": []}
-
-                        cast_list = [
-                            {
-                                "name": c.get("name"),
-                                "character": c.get("character"),
-                                "profile": f"https://image.tmdb.org/t/p/w300{c.get('profile_path')}" if c.get("profile_path") else ""
-                            }
-                            for c in credits.get("cast", [])[:10]
-                        ]
-
-                        directors = [
-                            c.get("name") for c in credits.get("crew", [])
-                            if c.get("job") == "Director"
-                        ]
-
-                        writers = [
-                            c.get("name") for c in credits.get("crew", [])
-                            if c.get("job") in ["Writer", "Screenplay", "Story"]
-                        ]
-
-                        # Trailers with retry logic (dedupe and cap: prefer official YouTube, max 2)
-                        trailers = []
-                        for attempt in range(2):
-                            try:
-                                videos = requests.get(
-                                    f"https://api.themoviedb.org/3/movie/{movie_id}/videos?api_key={TMDB_API_KEY}",
-                                    timeout=60
-                                ).json().get("results", [])
-
-                                def trailer_priority(v):
-                                    # Higher is better
-                                    is_youtube = 1 if v.get("site") == "YouTube" else 0
-                                    is_official = 1 if v.get("official") else 0
-                                    name = (v.get("name") or "").lower()
-                                    name_bonus = 1 if "official trailer" in name else 0
-                                    type_val = v.get("type") or ""
-                                    type_rank = {"Trailer": 3, "Teaser": 2, "Clip": 1}.get(type_val, 0)
-                                    date = v.get("published_at") or ""
-                                    return (is_youtube, is_official, name_bonus, type_rank, date)
-
-                                # Sort by priority and pick top 2 unique URLs
-                                sorted_videos = sorted(videos, key=trailer_priority, reverse=True)
-                                seen = set()
-                                for v in sorted_videos:
-                                    url = None
-                                    if v.get("site") == "YouTube" and v.get("key"):
-                                        url = f"https://www.youtube.com/watch?v={v.get('key')}"
-                                    elif v.get("url"):
-                                        url = v.get("url")
-                                    if not url or url in seen:
-                                        continue
-                                    seen.add(url)
-                                    trailers.append(url)
-                                    if len(trailers) >= 2:
-                                        break
-                                break
-                            except Exception as e:
-                                print(f"[TMDb Videos Retry {attempt+1}] {movie.get('title')}: {e}")
-                                if attempt < 1:
-                                    time.sleep(3)
-
-                        # Currency sign
-                        country_code = details.get("production_countries")[0]["iso_3166_1"] if details.get("production_countries") else "US"
-                        currency_symbol = CURRENCY_MAP.get(country_code, "$")
-
-                        # OTT providers
-                        providers = details.get("watch/providers", {}).get("results", {})
-
-                        page_movies.append({
-                            "id": movie_id,
-                            "title": movie.get("title"),
-                            "year": year,
-                            "overview": movie.get("overview") or "",
-                            "poster": f"https://image.tmdb.org/t/p/w500{movie.get('poster_path')}" if movie.get("poster_path") else "",
-                            "rating": movie.get("vote_average") or None,
-                            "genres": [g["name"] if isinstance(g, dict) else g for g in details.get("genres", [])],
-                            "budget": f"{currency_symbol}{details.get('budget', 0):,}" if details.get("budget") else None,
-                            "revenue": f"{currency_symbol}{details.get('revenue', 0):,}" if details.get("revenue") else None,
-                            "directors": directors,
-                            "writers": writers,
-                            "cast": cast_list,
-                            "trailers": trailers,
-                            "networks": [n["name"] for n in details.get("networks", [])],
-                            "origin_country": country_code,
-                            "providers": providers,
-                            "production_companies": [pc["name"] for pc in details.get("production_companies", [])],
-                            "category": category,
-                            "source": "TMDb"
-                        })
-
-                    except Exception as e:
-                        print(f"[TMDb Movie Error] {movie.get('title')} ({movie_id}): {e}")
-
-                category_movies.extend(page_movies)
-                print(f"[INFO] {category} Page {page}: {len(page_movies)} movies fetched")
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+_circuit_breakers_lock = threading.Lock()
 
+
+def circuit_breaker(url: str) -> CircuitBreaker:
+    host = urlsplit(url).netloc.lower()
+    with _circuit_breakers_lock:
+        if host not in _circuit_breakers:
+            _circuit_breakers[host] = CircuitBreaker(host, HOST_CIRCUIT_THRESHOLDS.get(host, DEFAULT_CIRCUIT_THRESHOLD))
+        return _circuit_breakers[host]
+
+
+def circuit_open(url: str) -> bool:
+    return circuit_breaker(url).is_open()
+
+
+def backoff_ms(attempt: int) -> int:
+    # Jittered exponential backoff: SLEEP_MS * 2^attempt * [0.5, 1.5), capped at 60s
+    return int(min(60000, SLEEP_MS * (2 ** attempt)) * random.uniform(0.5, 1.5))
+
+
+def send_request(url: str, params: Dict[str, Any] = None, headers: Dict[str, str] = None, timeout: int = 60,
+                 stream: bool = False) -> requests.Response:
+    breaker = circuit_breaker(url)
+    breaker.check()
+    limiter = rate_limiter(url)
+    with host_slots(url):
+        limiter.acquire()
+        started = time.perf_counter()
+        try:
+            res = SESSION.get(url, params=params, headers=headers, timeout=timeout, stream=stream)
+        except Exception:
+            METRICS.observe(url, None, time.perf_counter() - started)
+            limiter.on_failure()
+            breaker.on_failure()
+            raise
+    # Streamed bodies are counted by whoever reads them
+    METRICS.observe(url, res.status_code, time.perf_counter() - started, 0 if stream else len(res.content))
+    limiter.on_response(res.status_code, res.headers)
+    if res.status_code >= 500 or res.status_code == 408:
+        breaker.on_failure()
+    elif res.status_code != 429:
+        breaker.on_success()
+    return res
+
+
+# Persistent HTTP response cache (SQLite), shared by every fetcher.
+# Keyed by the normalized URL with api_key stripped; list pages get a short
+# TTL, detail payloads a long one. Expired entries are revalidated with
+# ETag / Last-Modified when the upstream sent them.
+HTTP_CACHE_FILE = os.environ.get("HTTP_CACHE_FILE", os.path.join(".cache", "http_cache.sqlite"))
+HTTP_CACHE_ENABLED = _get_int_env("HTTP_CACHE", 1) == 1
+HTTP_CACHE_MAX_MB = _get_int_env("HTTP_CACHE_MAX_MB", 256)
+CACHE_TTL_LIST = _get_int_env("CACHE_TTL_LIST", 30 * 60)
+CACHE_TTL_DETAIL = _get_int_env("CACHE_TTL_DETAIL", 24 * 3600)
+CACHE_TTL_TVMAZE = _get_int_env("CACHE_TTL_TVMAZE", 24 * 3600)
+CACHE_TTL_WIKIDATA = _get_int_env("CACHE_TTL_WIKIDATA", 24 * 3600)
+
+_SECRET_PARAMS = {"api_key"}
+
+
+def cache_key(url: str, params: Dict[str, Any] = None) -> str:
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in _SECRET_PARAMS]
+    query += [(k, str(v)) for k, v in (params or {}).items() if k not in _SECRET_PARAMS]
+    return urlunsplit((parts.scheme, parts.netloc.lower(), parts.path, urlencode(sorted(query)), ""))
+
+
+def cache_ttl(url: str) -> int:
+    parts = urlsplit(url)
+    host, path = parts.netloc.lower(), parts.path
+    if host == TMDB_HOST:
+        # /3/movie/{id} and /3/tv/{id} are details; everything else is a list page
+        segments = path[len(urlsplit(TMDB_BASE_URL).path):].strip("/").split("/")
+        if len(segments) >= 2 and segments[0] in ("movie", "tv") and segments[1].isdigit():
+            return CACHE_TTL_DETAIL
+        return CACHE_TTL_LIST
+    if host == TVMAZE_HOST:
+        path = path[len(urlsplit(TVMAZE_BASE_URL).path):]
+        return CACHE_TTL_LIST if path.startswith("/updates") else CACHE_TTL_TVMAZE
+    if host == WIKIDATA_HOST:
+        return CACHE_TTL_WIKIDATA
+    return CACHE_TTL_LIST
+
+
+class ResponseCache:
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "revalidated": 0, "stored": 0, "evicted": 0}
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, status INTEGER, headers TEXT, body BLOB,"
+            " expires_at REAL, last_access REAL, size INTEGER)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)")
+        self.total_bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key: str):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT status, headers, body, expires_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row:
+                self.db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        if not row:
+            return None
+        return {"status": row[0], "headers": json.loads(row[1]), "body": row[2], "expires_at": row[3]}
+
+    def put(self, key: str, status: int, headers: Dict[str, str], body: bytes, ttl: int) -> None:
+        now = time.time()
+        with self.lock:
+            old = self.db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (key, status, headers, body, expires_at, last_access, size)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, status, json.dumps(headers), body, now + ttl, now, len(body))
+            )
+            self.total_bytes += len(body) - (old[0] if old else 0)
+            self.stats["stored"] += 1
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def count(self, name: str) -> None:
+        with self.lock:
+            self.stats[name] += 1
+
+    def touch(self, key: str, ttl: int) -> None:
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "UPDATE responses SET expires_at = ?, last_access = ? WHERE key = ?", (now + ttl, now, key)
+            )
+
+    def _evict(self) -> None:
+        # LRU: drop least recently used rows until we are ~10% under the limit
+        target = int(self.max_bytes * 0.9)
+        rows = self.db.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall()
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.total_bytes -= size
+            self.stats["evicted"] += 1
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+
+def _open_cache():
+    if not HTTP_CACHE_ENABLED:
+        return None
+    try:
+        return ResponseCache(HTTP_CACHE_FILE, HTTP_CACHE_MAX_MB * 1024 * 1024)
+    except Exception as e:
+        print(f"[CACHE] Disabled, failed to open {HTTP_CACHE_FILE}: {e}")
+        return None
+
+# Opened on the first request, like catalog_store(), so importing the module
+# leaves the working tree alone. Detail workers share it, hence the lock.
+_http_cache = []
+_http_cache_lock = threading.Lock()
+
+def http_cache():
+    with _http_cache_lock:
+        if not _http_cache:
+            _http_cache.append(_open_cache())
+        return _http_cache[0]
+
+def close_http_cache() -> None:
+    with _http_cache_lock:
+        cache = _http_cache.pop() if _http_cache else None
+    if cache is not None:
+        cache.close()
+
+
+def _cached_response(url: str, entry: Dict[str, Any]) -> requests.Response:
+    res = requests.Response()
+    res.status_code = entry["status"]
+    res.headers.update(entry["headers"])
+    res._content = entry["body"]
+    res.encoding = "utf-8"
+    res.url = url
+    return res
+
+
+def http_get(url: str, params: Dict[str, Any] = None, headers: Dict[str, str] = None, timeout: int = 60,
+             fresh: bool = False) -> requests.Response:
+    # fresh=True skips unexpired cache entries but still revalidates with ETag
+    cache = http_cache()
+    if cache is None:
+        return send_request(url, params=params, headers=headers, timeout=timeout)
+
+    key = cache_key(url, params)
+    entry = cache.get(key)
+    if entry and not fresh and entry["expires_at"] > time.time():
+        cache.count("hits")
+        METRICS.cache(url, "hits")
+        return _cached_response(url, entry)
+
+    request_headers = dict(headers or {})
+    if entry:
+        if entry["headers"].get("ETag"):
+            request_headers["If-None-Match"] = entry["headers"]["ETag"]
+        if entry["headers"].get("Last-Modified"):
+            request_headers["If-Modified-Since"] = entry["headers"]["Last-Modified"]
+
+    res = send_request(url, params=params, headers=request_headers, timeout=timeout)
+    ttl = cache_ttl(url)
+    if res.status_code == 304 and entry:
+        cache.count("revalidated")
+        METRICS.cache(url, "revalidated")
+        cache.touch(key, ttl)
+        return _cached_response(url, entry)
+
+    cache.count("misses")
+    METRICS.cache(url, "misses")
+    if res.status_code == 200:
+        kept = {k: res.headers[k] for k in ("Content-Type", "ETag", "Last-Modified") if k in res.headers}
+        cache.put(key, res.status_code, kept, res.content, ttl)
+    return res
+
+
+# List pages (category, index, feed and query pages) each source thread
+# fetched or failed to fetch this run; run_sources() reads them to tell a
+# source that got nothing from one that had nothing new
+_source_pages = threading.local()
+
+
+def note_source_page(ok: bool) -> None:
+    counts = getattr(_source_pages, "counts", None)
+    # Requests cut off by the run budget say nothing about the upstream
+    if counts is not None and (ok or not BUDGET.expired()):
+        counts["ok" if ok else "failed"] += 1
+
+
+def http_fetch(url: str, label: str, attempts: int = 3, params: Dict[str, Any] = None,
+               headers: Dict[str, str] = None, timeout: int = 60, ok_statuses=(200,), fresh: bool = False,
+               stage: str = "other_fetch"):
+    res = _http_fetch(url, label, attempts, params, headers, timeout, ok_statuses, fresh, stage)
+    if stage == "list_fetch":
+        note_source_page(res is not None)
+    return res
+
+
+def _http_fetch(url, label, attempts, params, headers, timeout, ok_statuses, fresh, stage):
+    # Returns the response once its status is in ok_statuses, or None once
+    # attempts run out / the status is not retryable
+    with METRICS.stage(stage):
+        for attempt in range(attempts):
+            try:
+                res = http_get(url, params=params, headers=headers, timeout=timeout, fresh=fresh)
+                if res.status_code in ok_statuses:
+                    return res
+                print(f"[{label} Retry {attempt+1}] Status Code: {res.status_code}")
+                if res.status_code not in RETRY_STATUSES:
+                    return None
+            except (CircuitOpenError, BudgetExpiredError):
+                return None
             except Exception as e:
-                print(f"[TMDb {category} Page {page} Error] {e}")
+                print(f"[{label} Retry {attempt+1}] {e}")
+            if attempt < attempts - 1 and not BUDGET.expired() and not circuit_open(url):
+                METRICS.retry(url)
+                sleep_ms(backoff_ms(attempt))
+            else:
+                break
+        return None
 
-        all_movies.extend(category_movies)
-        print(f"[INFO] {category} Total: {len(category_movies)} movies fetched")
-        
-    return all_movies
 
+CURRENCY_MAP = {
+    "US": "$", "GB": "£", "EU": "€", "IN": "₹", "JP": "¥"
+}
 
-def fetch_tmdb_tv():
-    print("[INFO] Fetching MAXIMUM TMDb TV series from all categories...")
-    categories = {
-        "trending": "https://api.themoviedb.org/3/trending/tv/week",
-        "popular": "https://api.themoviedb.org/3/tv/popular",
-        "top_rated": "https://api.themoviedb.org/3/tv/top_rated",
-        "on_the_air": "https://api.themoviedb.org/3/tv/on_the_air",
-        "airing_today": "https://api.themoviedb.org/3/tv/airing_today"
+
+def pick_trailers(videos, limit=2):
+    # Dedupe and cap: prefer official YouTube trailers
+    def trailer_priority(v):
+        # Higher is better
+        is_youtube = 1 if v.get("site") == "YouTube" else 0
+        is_official = 1 if v.get("official") else 0
+        name = (v.get("name") or "").lower()
+        name_bonus = 1 if "official trailer" in name else 0
+        type_rank = {"Trailer": 3, "Teaser": 2, "Clip": 1}.get(v.get("type") or "", 0)
+        date = v.get("published_at") or ""
+        return (is_youtube, is_official, name_bonus, type_rank, date)
+
+    trailers = []
+    seen = set()
+    for v in sorted(videos, key=trailer_priority, reverse=True):
+        url = None
+        if v.get("site") == "YouTube" and v.get("key"):
+            url = f"https://www.youtube.com/watch?v={v.get('key')}"
+        elif v.get("url"):
+            url = v.get("url")
+        if not url or url in seen:
+            continue
+        seen.add(url)
+        trailers.append(url)
+        if len(trailers) >= limit:
+            break
+    return trailers
+
+
+def build_cast(credits, limit=10):
+    return [
+        {
+            "name": c.get("name"),
+            "character": c.get("character"),
+            "profile": f"https://image.tmdb.org/t/p/w300{c.get('profile_path')}" if c.get("profile_path") else ""
+        }
+        for c in credits.get("cast", [])[:limit]
+    ]
+
+
+def fetch_list_page(url, label):
+    return http_fetch(url, label, attempts=3, stage="list_fetch")
+
+
+def fetch_detail_json(url, label, attempts=3, fresh=False):
+    res = http_fetch(url, label, attempts=attempts, fresh=fresh, stage="detail_fetch")
+    return res.json() if res is not None else None
+
+
+def fetch_tmdb_details(media_type, tmdb_id, label, fresh=False):
+    # One request per title: credits, videos and providers (plus any extras) ride along
+    append = ",".join(TMDB_APPEND + TMDB_EXTRA_APPEND)
+    return fetch_detail_json(
+        f"{TMDB_BASE_URL}/{media_type}/{tmdb_id}?api_key={TMDB_API_KEY}&append_to_response={append}",
+        label, fresh=fresh
+    )
+
+
+def tmdb_external_ids(details):
+    external = details.get("external_ids") or {}
+    return {k: external[k] for k in ("imdb_id", "tvdb_id", "wikidata_id") if external.get(k)}
+
+
+def extra_sub_resources(details):
+    return {key: details.get(key) for key in TMDB_EXTRA_APPEND if details.get(key) is not None}
+
+
+def shape_tmdb_movie(movie, details, category):
+    # Change-feed refreshes start from a bare {"id": ...}; details fill the gaps
+    movie = {**details, **movie}
+    release_date = movie.get("release_date")
+    year = release_date[:4] if release_date else "N/A"
+
+    credits = details.get("credits") or {"cast": [], "crew": []}
+
+    directors = [
+        c.get("name") for c in credits.get("crew", [])
+        if c.get("job") == "Director"
+    ]
+
+    writers = [
+        c.get("name") for c in credits.get("crew", [])
+        if c.get("job") in ["Writer", "Screenplay", "Story"]
+    ]
+
+    trailers = pick_trailers((details.get("videos") or {}).get("results", []))
+
+    # Currency sign
+    country_code = details.get("production_countries")[0]["iso_3166_1"] if details.get("production_countries") else "US"
+    currency_symbol = CURRENCY_MAP.get(country_code, "$")
+
+    # OTT providers
+    providers = details.get("watch/providers", {}).get("results", {})
+
+    return {
+        "id": movie.get("id"),
+        "title": movie.get("title"),
+        "year": year,
+        "overview": movie.get("overview") or "",
+        "poster": f"https://image.tmdb.org/t/p/w500{movie.get('poster_path')}" if movie.get("poster_path") else "",
+        "rating": movie.get("vote_average") or None,
+        "genres": [g["name"] if isinstance(g, dict) else g for g in details.get("genres", [])],
+        "budget": f"{currency_symbol}{details.get('budget', 0):,}" if details.get("budget") else None,
+        "revenue": f"{currency_symbol}{details.get('revenue', 0):,}" if details.get("revenue") else None,
+        "directors": directors,
+        "writers": writers,
+        "cast": build_cast(credits),
+        "trailers": trailers,
+        "networks": [n["name"] for n in details.get("networks", [])],
+        "origin_country": country_code,
+        "providers": providers,
+        "production_companies": [pc["name"] for pc in details.get("production_companies", [])],
+        "external_ids": tmdb_external_ids(details),
+        "category": category,
+        "source": "TMDb",
+        **extra_sub_resources(details)
     }
-    PAGES_PER_CATEGORY = 10
-    all_series = []
 
-    for category, base_url in categories.items():
-        print(f"[INFO] Fetching TV {category} (up to {PAGES_PER_CATEGORY} pages)...")
-        category_items = []
-        for page in range(1, PAGES_PER_CATEGORY + 1):
-            try:
-                url = f"{base_url}?api_key={TMDB_API_KEY}&page={page}"
-                for attempt in range(3):
-                    try:
-                        res = requests.get(url, timeout=60)
-                        if res.status_code == 200:
-                            break
-                        else:
-                            print(f"[TMDb TV {category} Page {page} Retry {attempt+1}] Status Code: {res.status_code}")
-                            if attempt < 2:
-                                time.sleep(5)
-                    except Exception as e:
-                        print(f"[TMDb TV {category} Page {page} Retry {attempt+1}] {e}")
-                        if attempt < 2:
-                            time.sleep(5)
-                else:
-                    print(f"[TMDb TV Error] Failed to fetch {category} page {page} after retries")
-                    continue
 
-                page_items = []
-                for show in res.json().get("results", []):
-                    tv_id = show.get("id")
-                    name = show.get("name")
-                    first_air_date = show.get("first_air_date")
-                    year = first_air_date[:4] if first_air_date else "N/A"
-
-                    try:
-                        # Details
-                        details = None
-                        for attempt in range(2):
-                            try:
-                                details = requests.get(
-                                    f"https://api.themoviedb.org/3/tv/{tv_id}?api_key={TMDB_API_KEY}&append_to_response=watch/providers",
-                                    timeout=60
-                                ).json()
-                                break
-                            except Exception as e:
-                                print(f"[TMDb TV Details Retry {attempt+1}] {name}: {e}")
-                                if attempt < 1:
-                                    time.sleep(3)
-                        if not details:
-                            continue
-
-                        # Credits
-                        credits = None
-                        for attempt in range(2):
-                            try:
-                                credits = requests.get(
-                                    f"https://api.themoviedb.org/3/tv/{tv_id}/credits?api_key={TMDB_API_KEY}",
-                                    timeout=60
-                                ).json()
-                                break
-                            except Exception as e:
-                                print(f"[TMDb TV Credits Retry {attempt+1}] {name}: {e}")
-                                if attempt < 1:
-                                    time.sleep(3)
-                        if not credits:
-                            credits = {"cast": [], "crew": []}
-
-                        cast_list = [
-                            {
-                                "name": c.get("name"),
-                                "character": c.get("character"),
-                                "profile": f"https://image.tmdb.org/t/p/w300{c.get('profile_path')}" if c.get("profile_path") else ""
-                            }
-                            for c in credits.get("cast", [])[:10]
-                        ]
-
-                        creators = [c.get("name") for c in details.get("created_by", [])]
-
-                        # Trailers (TV)
-                        trailers = []
-                        for attempt in range(2):
-                            try:
-                                videos = requests.get(
-                                    f"https://api.themoviedb.org/3/tv/{tv_id}/videos?api_key={TMDB_API_KEY}",
-                                    timeout=60
-                                ).json().get("results", [])
-                                def trailer_priority(v):
-                                    is_youtube = 1 if v.get("site") == "YouTube" else 0
-                                    is_official = 1 if v.get("official") else 0
-                                    name = (v.get("name") or "").lower()
-                                    name_bonus = 1 if "official trailer" in name else 0
-                                    type_rank = {"Trailer": 3, "Teaser": 2, "Clip": 1}.get(v.get("type") or "", 0)
-                                    date = v.get("published_at") or ""
-                                    return (is_youtube, is_official, name_bonus, type_rank, date)
-                                sorted_videos = sorted(videos, key=trailer_priority, reverse=True)
-                                seen = set()
-                                for v in sorted_videos:
-                                    url = None
-                                    if v.get("site") == "YouTube" and v.get("key"):
-                                        url = f"https://www.youtube.com/watch?v={v.get('key')}"
-                                    elif v.get("url"):
-                                        url = v.get("url")
-                                    if not url or url in seen:
-                                        continue
-                                    seen.add(url)
-                                    trailers.append(url)
-                                    if len(trailers) >= 2:
-                                        break
-                                break
-                            except Exception as e:
-                                print(f"[TMDb TV Videos Retry {attempt+1}] {name}: {e}")
-                                if attempt < 1:
-                                    time.sleep(3)
-
-                        providers = details.get("watch/providers", {}).get("results", {})
-                        origin_countries = details.get("origin_country") or []
-                        origin_country = origin_countries[0] if origin_countries else "US"
-
-                        page_items.append({
-                            "id": tv_id,
-                            "title": name,
-                            "year": year,
-                            "overview": details.get("overview") or "",
-                            "poster": f"https://image.tmdb.org/t/p/w500{show.get('poster_path')}" if show.get("poster_path") else "",
-                            "rating": show.get("vote_average") or None,
-                            "genres": [g.get("name") for g in details.get("genres", [])],
-                            "creators": creators,
-                            "cast": cast_list,
-                            "trailers": trailers,
-                            "origin_country": origin_country,
-                            "providers": providers,
-                            "category": category,
-                            "type": "tv",
-                            "source": "TMDb"
-                        })
-                    except Exception as e:
-                        print(f"[TMDb TV Show Error] {name} ({tv_id}): {e}")
-
-                category_items.extend(page_items)
-                print(f"[INFO] TV {category} Page {page}: {len(page_items)} items")
-            except Exception as e:
-                print(f"[TMDb TV {category} Page {page} Error] {e}")
+def shape_tmdb_tv(show, details, category):
+    show = {**details, **show}
+    first_air_date = show.get("first_air_date")
+    year = first_air_date[:4] if first_air_date else "N/A"
+
+    credits = details.get("credits") or {"cast": [], "crew": []}
+
+    creators = [c.get("name") for c in details.get("created_by", [])]
+
+    trailers = pick_trailers((details.get("videos") or {}).get("results", []))
+
+    providers = details.get("watch/providers", {}).get("results", {})
+    origin_countries = details.get("origin_country") or []
+    origin_country = origin_countries[0] if origin_countries else "US"
+
+    return {
+        "id": show.get("id"),
+        "title": show.get("name"),
+        "year": year,
+        "overview": details.get("overview") or "",
+        "poster": f"https://image.tmdb.org/t/p/w500{show.get('poster_path')}" if show.get("poster_path") else "",
+        "rating": show.get("vote_average") or None,
+        "genres": [g.get("name") for g in details.get("genres", [])],
+        "creators": creators,
+        "cast": build_cast(credits),
+        "trailers": trailers,
+        "origin_country": origin_country,
+        "providers": providers,
+        "external_ids": tmdb_external_ids(details),
+        "category": category,
+        "type": "tv",
+        "source": "TMDb",
+        **extra_sub_resources(details)
+    }
 
-        all_series.extend(category_items)
-        print(f"[INFO] TV {category} Total: {len(category_items)} items")
 
-    return all_series
+# TMDb sources are declarative: the categories to list, the state namespace
+# for their cursors and how details become a record. Everything else is the
+# shared crawl pipeline.
+TMDB_SOURCES = {
+    "movie": {
+        "namespace": "tmdb_movie",
+        "label": "TMDb",
+        "categories": {
+            "trending": f"{TMDB_BASE_URL}/trending/movie/week",
+            "popular": f"{TMDB_BASE_URL}/movie/popular",
+            "top_rated": f"{TMDB_BASE_URL}/movie/top_rated",
+            "now_playing": f"{TMDB_BASE_URL}/movie/now_playing",
+            "upcoming": f"{TMDB_BASE_URL}/movie/upcoming",
+            "latest": f"{TMDB_BASE_URL}/movie/latest",
+        },
+        # Tier 0 for the run budget; every other category is tier 1
+        "fresh": ("trending", "now_playing"),
+        "shape": shape_tmdb_movie,
+    },
+    "tv": {
+        "namespace": "tmdb_tv",
+        "label": "TMDb TV",
+        "categories": {
+            "trending": f"{TMDB_BASE_URL}/trending/tv/week",
+            "popular": f"{TMDB_BASE_URL}/tv/popular",
+            "top_rated": f"{TMDB_BASE_URL}/tv/top_rated",
+            "on_the_air": f"{TMDB_BASE_URL}/tv/on_the_air",
+            "airing_today": f"{TMDB_BASE_URL}/tv/airing_today",
+        },
+        "fresh": ("trending", "airing_today"),
+        "shape": shape_tmdb_tv,
+    },
+}
 
-def fetch_tvmaze():
-    print("[INFO] Fetching MAXIMUM TVMaze shows...")
-    
-    # Fetch multiple pages for maximum data
-    PAGES_TO_FETCH = 20  # Fetch 20 pages = 500+ shows
-    all_shows = []
-    
-    for page in range(1, PAGES_TO_FETCH + 1):
-        try:
-            url = f"https://api.tvmaze.com/shows?page={page}"
-            print(f"[INFO] Fetching TVMaze page {page}...")
-            
-            # Retry logic for each page
-            for attempt in range(3):
+
+# Per-run title memo shared by every category and by the movie/TV fetchers:
+# (media_type, tmdb_id) -> record. A repeat sighting only adds its category.
+# Titles whose details are still in flight sit in TITLE_CLAIMS with the
+# categories they were listed under so far, and TITLE_WAITERS holds the
+# other pages that listed them meanwhile: (page, list item) pairs that can't
+# finish until the claim resolves. Pipelines that don't keep records (the
+# back-catalog shards) map keys to None instead.
+TITLE_MEMO: Dict[tuple, Dict[str, Any]] = {}
+TITLE_CLAIMS: Dict[tuple, list] = {}
+TITLE_WAITERS: Dict[tuple, list] = {}
+_memo_lock = threading.Lock()
+
+
+def memo_add_category(record, category):
+    categories = record.setdefault("categories", [record.get("category")])
+    if category not in categories:
+        categories.append(category)
+
+
+# Crawl pipeline: a list-page producer, a detail fetch pool, a record
+# transformer and a sink, joined by bounded queues so list pagination,
+# detail I/O and shaping overlap. A full queue blocks the stage feeding it,
+# so only a few queues' worth of titles are ever in memory. The sink
+# finishes the pages of one stream (e.g. one category cursor) strictly in
+# list order, which keeps per-page journaling and checkpoints resumable.
+PIPELINE_QUEUE_SIZE = max(1, _get_int_env("PIPELINE_QUEUE_SIZE", MAX_IN_FLIGHT * 4))
+_PIPELINE_DONE = object()
+
+
+class CrawlPipeline:
+    def __init__(self, media_type, shape, label, workers=MAX_IN_FLIGHT, freshness=None, keep_records=True):
+        self.media_type = media_type
+        self.shape = shape
+        self.label = label
+        # False: the memo only remembers which titles were fetched, and repeat
+        # sightings aren't handed back to finish()
+        self.keep_records = keep_records
+        # Optional FreshnessStore noting every fetched title
+        self.freshness = freshness
+        self.workers = max(1, workers)
+        self.details = queue.Queue(PIPELINE_QUEUE_SIZE)
+        self.shaping = queue.Queue(PIPELINE_QUEUE_SIZE)
+        self.results = queue.Queue(PIPELINE_QUEUE_SIZE)
+        self.fetched = 0
+
+    def emit(self, results, stream, category, finish, plan=None, fresh=False, work=None):
+        # Producer side: claim the IDs not seen yet this run and queue their
+        # detail fetches. finish(records, reused) runs on the sink once every
+        # title on the page is done; work names the page in budget deferrals.
+        # With a change-feed plan, titles we hold that did not change get a
+        # stub (id, category, list rating) instead. A title another page has
+        # claimed holds this page back until its details are in, so this page
+        # journals the title under its own category too.
+        page = {"stream": stream, "category": category, "finish": finish, "work": work, "todo": [], "reused": [],
+                "pending": 0, "held": plan["held"] if plan else ()}
+        policy_rows = plan_policy_rows(plan, self.media_type, results) if category else None
+        now = int(time.time())
+        with _memo_lock:
+            for item in results:
+                key = (self.media_type, item.get("id"))
+                if key in TITLE_MEMO:
+                    if TITLE_MEMO[key] is None:
+                        continue
+                    if category:
+                        memo_add_category(TITLE_MEMO[key], category)
+                    page["reused"].append(TITLE_MEMO[key])
+                elif key in TITLE_CLAIMS:
+                    if category:
+                        if category not in TITLE_CLAIMS[key]:
+                            TITLE_CLAIMS[key].append(category)
+                        TITLE_WAITERS.setdefault(key, []).append((page, item))
+                        page["pending"] += 1
+                elif plan and plan_skips(plan, item.get("id")):
+                    stub = tmdb_stub(self.media_type, item, category)
+                    TITLE_MEMO[key] = stub
+                    page["reused"].append(stub)
+                    plan["skipped"] += 1
+                elif policy_rows is not None and item.get("id") in plan["held"] and not plan["freshness"].due(
+                        policy_rows.get(item.get("id")), category, now):
+                    stub = tmdb_stub(self.media_type, item, category)
+                    TITLE_MEMO[key] = stub
+                    page["reused"].append(stub)
+                    plan["not_due"] += 1
+                else:
+                    # A held title the policy says is due skips the HTTP cache too
+                    due = policy_rows is not None and item.get("id") in plan["held"]
+                    if due:
+                        plan["due"] += 1
+                    TITLE_CLAIMS[key] = [category] if category else []
+                    page["todo"].append((item, fresh or due or (bool(plan) and plan_changed(plan, item.get("id")))))
+                    page["pending"] += 1
+            page["records"] = [None] * len(page["todo"])
+        # Registered with the sink before any of its titles can get there
+        self.results.put((page, None, None))
+        for slot, (item, item_fresh) in enumerate(page["todo"]):
+            self.details.put((page, slot, item_fresh))
+
+    def _fetch_details(self):
+        while True:
+            job = self.details.get()
+            if job is _PIPELINE_DONE:
+                self.shaping.put(_PIPELINE_DONE)
+                return
+            page, slot, fresh = job
+            item = page["todo"][slot][0]
+            name = item.get("title") or item.get("name") or item.get("id")
+            if BUDGET.expired():
+                # Past the cutoff the rest of the queue is drained without
+                # requests; the page stays unfinished like a circuit-open one
+                BUDGET.drop(page["work"])
+                page["broken"] = "run budget spent"
+                self.shaping.put((page, slot, None))
+                continue
+            try:
+                details = fetch_tmdb_details(self.media_type, item.get("id"), f"{self.label} Details {name}", fresh=fresh)
+            except Exception as e:
+                print(f"[{self.label} Error] Details for {name}: {e}")
+                details = None
+            if details is None and BUDGET.expired():
+                # The cutoff hit while this title waited on the rate limiter
+                BUDGET.drop(page["work"])
+                page["broken"] = "run budget spent"
+            elif details is None and circuit_open(TMDB_BASE_URL):
+                page["broken"] = "circuit open"
+            self.shaping.put((page, slot, details))
+
+    def _transform(self):
+        finished = 0
+        while finished < self.workers:
+            job = self.shaping.get()
+            if job is _PIPELINE_DONE:
+                finished += 1
+                continue
+            page, slot, details = job
+            item = page["todo"][slot][0]
+            record = None
+            if details:
                 try:
-                    res = requests.get(url, timeout=60)  # Increased timeout
-                    if res.status_code == 200:
-                        break
-                    else:
-                        print(f"[TVMaze Page {page} Retry {attempt+1}] Status Code: {res.status_code}")
-                        if attempt < 2:
-                            time.sleep(5)
+                    record = self.shape(item, details, page["category"])
                 except Exception as e:
-                    print(f"[TVMaze Page {page} Retry {attempt+1}] {e}")
-                    if attempt < 2:
-                        time.sleep(5)
+                    print(f"[{self.label} Error] {item.get('title') or item.get('name')} ({item.get('id')}): {e}")
+            self.results.put((page, slot, record))
+        self.results.put(_PIPELINE_DONE)
+
+    def _sink(self):
+        streams = {}
+        # Streams stopped at a page whose details the circuit breaker refused,
+        # the run budget cut off, or whose finish() failed
+        halted = set()
+        while True:
+            job = self.results.get()
+            if job is _PIPELINE_DONE:
+                return
+            page, slot, record = job
+            ready = {page["stream"]}
+            if slot is None:
+                streams.setdefault(page["stream"], collections.deque()).append(page)
             else:
-                print(f"[TVMaze Error] Failed to fetch page {page} after retries")
+                item = page["todo"][slot][0]
+                key = (self.media_type, item.get("id"))
+                with _memo_lock:
+                    categories = TITLE_CLAIMS.pop(key, [])
+                    waiters = TITLE_WAITERS.pop(key, [])
+                    if record:
+                        if categories:
+                            record["categories"] = categories
+                        TITLE_MEMO[key] = record if self.keep_records else None
+                    for waiter, _ in waiters:
+                        waiter["pending"] -= 1
+                page["records"][slot] = record
+                page["pending"] -= 1
+                # Pages that listed the title meanwhile journal it under their
+                # own category. A held title whose details failed gets a stub,
+                # so the listing still counts for every page that saw it.
+                for listing, listed in waiters:
+                    if record:
+                        listing["reused"].append(record)
+                    elif listed.get("id") in listing["held"]:
+                        listing["reused"].append(tmdb_stub(self.media_type, listed, listing["category"]))
+                    ready.add(listing["stream"])
+                if not record and item.get("id") in page["held"] and page["category"]:
+                    page["reused"].append(tmdb_stub(self.media_type, item, page["category"]))
+            for stream in ready:
+                self._finish_ready(streams, halted, stream)
+
+    def _finish_ready(self, streams, halted, stream):
+        # Finish the stream's leading pages whose titles are all in
+        pages = streams.get(stream)
+        while pages and pages[0]["pending"] == 0:
+            done = pages.popleft()
+            if done.get("broken") or done["stream"] in halted:
+                # Neither this page nor any later one is checkpointed, so the cursor stays put
+                if done["stream"] not in halted:
+                    print(f"[{self.label} Error] {done['broken'].capitalize()}, "
+                          f"{done['category'] or done['stream']} stops before this page and resumes there next run")
+                halted.add(done["stream"])
+                continue
+            records = [r for r in done["records"] if r]
+            try:
+                if self.freshness is not None:
+                    self.freshness.record(self.media_type, records, int(time.time()))
+                done["finish"](records, done["reused"])
+            except Exception as e:
+                # Later pages must not checkpoint past this one
+                print(f"[{self.label} Error] Finishing {done['stream']}: {e}; "
+                      f"{done['category'] or done['stream']} stops before this page and resumes there next run")
+                halted.add(done["stream"])
                 continue
+            self.fetched += len(records)
+
+    def run(self, produce):
+        # produce(pipeline) walks the list pages on this thread, calling emit()
+        threads = [threading.Thread(target=self._fetch_details, daemon=True) for _ in range(self.workers)]
+        threads += [threading.Thread(target=self._transform, daemon=True),
+                    threading.Thread(target=self._sink, daemon=True)]
+        for thread in threads:
+            thread.start()
+        try:
+            produce(self)
+        finally:
+            for _ in range(self.workers):
+                self.details.put(_PIPELINE_DONE)
+            for thread in threads:
+                thread.join()
+        return self.fetched
+
+
+def category_tier(source, category):
+    return 0 if category in source.get("fresh", ()) else 1
+
+
+def mark_category_cycle(state, namespace, category, page, next_page, listed):
+    # A cycle starts when page 1 is listed and ends when the cursor wraps;
+    # "listed_since" is the start of the last full cycle
+    with STATE_LOCK:
+        cursor = state[namespace][category]
+        if page == 1:
+            cursor["cycle_started"] = listed
+        if next_page == 1 and cursor.get("cycle_started"):
+            cursor["listed_since"] = cursor["cycle_started"]
+
+
+def category_cutoffs(state):
+    # (media_type, category) -> time before which a listing has expired:
+    # the title wasn't on the list during its last full cycle
+    cutoffs = {}
+    for media_type, source in TMDB_SOURCES.items():
+        for category in source["categories"]:
+            since = ((state.get(source["namespace"]) or {}).get(category) or {}).get("listed_since")
+            if since:
+                cutoffs[(media_type, category)] = int(since)
+    return cutoffs
+
+
+def produce_tmdb_category(pipeline, state, source, category, base_url, plan=None, totals=None):
+    # Fetch a window of PAGES_PER_CATEGORY pages starting at the saved cursor.
+    # Each page is journaled and the cursor checkpointed by the sink once its
+    # titles are built, so a killed run resumes at the first unfinished page.
+    namespace, label = source["namespace"], source["label"]
+    work, tier = f"{namespace}/{category}", category_tier(source, category)
+    start = get_start_page(state, namespace, category)
+    print(f"[INFO] Fetching {label} {category} (pages {start}..{start + PAGES_PER_CATEGORY - 1}, wraps at total_pages)...")
+    page = start
+    for _ in range(PAGES_PER_CATEGORY):
+        if not BUDGET.allows(work, tier):
+            break
+        try:
+            url = f"{base_url}?api_key={TMDB_API_KEY}&page={page}"
+            res = fetch_list_page(url, f"{label} {category} Page {page}")
+            if res is None:
+                # Keep the cursor here so the next run retries this page
+                print(f"[{label} Error] Failed to fetch {category} page {page} after retries")
+                break
+
+            data = res.json()
+            # /movie/latest returns a single title instead of a result page
+            results = data.get("results", [data] if data.get("id") else [])
+            total_pages = min(int(data.get("total_pages") or 1), TMDB_MAX_PAGES)
+            next_page = page + 1 if page < total_pages else 1
+            listed = int(time.time())
+
+            def finish(records, reused, page=page, next_page=next_page, total_pages=total_pages, listed=listed):
+                # Stamp every category these titles were listed under this run
+                seen = int(time.time())
+                append_journal([dict(r, _category_seen={c: seen for c in record_categories(r)})
+                                for r in records + reused])
+                set_next_page(state, namespace, category, next_page, total_pages=total_pages)
+                mark_category_cycle(state, namespace, category, page, next_page, listed)
+                if plan:
+                    note_refetched(state, namespace, plan, [record["id"] for record in records])
+                save_state(state)
+                if totals is not None:
+                    totals[category] = totals.get(category, 0) + len(records)
+                print(f"[INFO] {label} {category} Page {page}/{total_pages}: {len(records)} items ({len(reused)} already seen)")
+
+            pipeline.emit(results, (namespace, category), category, finish, plan, work=work)
+            page = next_page
+            if page == start:
+                # The whole category fits inside one window
+                break
+        except Exception as e:
+            print(f"[{label} {category} Page {page} Error] {e}")
+            break
+
+
+# Change-feed refresh: /movie/changes and /tv/changes list every ID edited
+# since a date. Titles already in the catalog are only refetched when they
+# show up there; the rest keep their stored details. The feed reaches back
+# at most 14 days, so longer gaps (or the first run) fall back to a full
+# refresh of whatever the category windows list.
+TMDB_CHANGES = os.environ.get("TMDB_CHANGES", "1").lower() not in ("0", "false", "no")
+TMDB_CHANGES_MAX_DAYS = 14
+TMDB_CHANGES_MAX_PAGES = _get_int_env("TMDB_CHANGES_MAX_PAGES", 100)
+TMDB_CHANGES_PER_RUN = _get_int_env("TMDB_CHANGES_PER_RUN", 500)
+
+
+# Per-title refresh policy. Each fetched TMDb title gets a row in
+# .cache/title_freshness.sqlite: when it was last fetched, a hash of its
+# content and its change history. When the change feed can't vouch for a
+# held title (first run, feed gap or failure, TMDB_CHANGES=0), the title is
+# refetched only once its refresh interval has passed. The base interval
+# depends on the category it is listed under (REFRESH_INTERVALS, seconds,
+# e.g. "trending=3600,top_rated=2592000"; "*" is the default). It doubles
+# every time a refetch comes back unchanged, up to REFRESH_BACKOFF_STEPS
+# doublings and REFRESH_MAX_INTERVAL. REFRESH_POLICY=0 refetches every
+# listed title, as before.
+REFRESH_POLICY = _get_int_env("REFRESH_POLICY", 1) == 1
+FRESHNESS_FILE = os.environ.get("FRESHNESS_FILE", os.path.join(".cache", "title_freshness.sqlite"))
+DEFAULT_REFRESH_INTERVALS = {
+    "trending": 6 * 3600, "now_playing": 6 * 3600, "on_the_air": 6 * 3600, "airing_today": 6 * 3600,
+    "latest": 6 * 3600, "upcoming": 24 * 3600, "popular": 3 * 24 * 3600, "top_rated": 14 * 24 * 3600,
+    "*": 7 * 24 * 3600,
+}
+REFRESH_INTERVALS = dict(DEFAULT_REFRESH_INTERVALS, **{
+    name.strip(): int(value) for name, _, value in
+    (item.partition("=") for item in _get_list_env("REFRESH_INTERVALS")) if value.strip().isdigit()
+})
+REFRESH_BACKOFF_STEPS = _get_int_env("REFRESH_BACKOFF_STEPS", 4)
+REFRESH_MAX_INTERVAL = _get_int_env("REFRESH_MAX_INTERVAL", 90 * 24 * 3600)
+FRESHNESS_HISTORY = 8
+# Left out of the content hash: listing context, and the rating that list
+# pages already keep current through stubs
+UNHASHED_FIELDS = {"category", "categories", "rating"}
+# Per-source refresh counts for the run summary and run_metrics.json
+REFRESH_STATS: Dict[str, Dict[str, int]] = {}
+
+
+def content_hash(record):
+    content = {k: v for k, v in record.items() if k not in UNHASHED_FIELDS}
+    return hashlib.sha1(json.dumps(content, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def refresh_interval(category, unchanged):
+    base = REFRESH_INTERVALS.get(category, REFRESH_INTERVALS["*"])
+    return min(base * 2 ** min(unchanged, REFRESH_BACKOFF_STEPS), REFRESH_MAX_INTERVAL)
+
+
+class FreshnessStore:
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS titles ("
+            " media_type TEXT, id INTEGER, last_fetched INTEGER, content_hash TEXT, unchanged INTEGER,"
+            " fetches INTEGER, changes INTEGER, last_changed INTEGER, history TEXT,"
+            " PRIMARY KEY (media_type, id))"
+        )
+
+    def lookup(self, media_type, ids):
+        # id -> (last_fetched, content_hash, unchanged, fetches, changes, last_changed, history)
+        ids = [i for i in ids if isinstance(i, int)]
+        rows = {}
+        with self.lock:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                rows.update((row[0], row[1:]) for row in self.db.execute(
+                    "SELECT id, last_fetched, content_hash, unchanged, fetches, changes, last_changed, history"
+                    f" FROM titles WHERE media_type = ? AND id IN ({','.join('?' * len(chunk))})",
+                    [media_type] + chunk))
+        return rows
+
+    def due(self, row, category, now):
+        return row is None or now - row[0] >= refresh_interval(category, row[2])
+
+    def record(self, media_type, records, now):
+        records = [r for r in records if isinstance(r.get("id"), int)]
+        if not records:
+            return
+        known = self.lookup(media_type, [r["id"] for r in records])
+        rows = []
+        for record in records:
+            digest = content_hash(record)
+            old = known.get(record["id"])
+            if old is None:
+                rows.append((media_type, record["id"], now, digest, 0, 1, 0, None, "[]"))
+            elif old[1] == digest:
+                rows.append((media_type, record["id"], now, digest, old[2] + 1, old[3] + 1, old[4], old[5], old[6]))
+            else:
+                history = (json.loads(old[6] or "[]") + [now])[-FRESHNESS_HISTORY:]
+                rows.append((media_type, record["id"], now, digest, 0, old[3] + 1, old[4] + 1, now, json.dumps(history)))
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.executemany("INSERT OR REPLACE INTO titles VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.db.execute("COMMIT")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def held_tmdb_ids(media_type):
+    return catalog_store().held_ids("TMDb", media_type)
+
+
+def changes_window(since):
+    # The feed's start_date only has day precision
+    return datetime.fromtimestamp(since, timezone.utc).strftime("%Y-%m-%d")
+
+
+def fetch_tmdb_changes(media_type, since, label):
+    # Every changed ID since `since` (epoch seconds), or None if the feed
+    # can't be read completely
+    start_date = changes_window(since)
+    changed = set()
+    page = 1
+    while True:
+        url = (f"{TMDB_BASE_URL}/{media_type}/changes?api_key={TMDB_API_KEY}"
+               f"&start_date={start_date}&page={page}")
+        res = http_fetch(url, f"{label} Changes Page {page}", attempts=3, fresh=True, stage="list_fetch")
+        if res is None:
+            print(f"[{label} Error] Failed to fetch /{media_type}/changes page {page}")
+            return None
+        data = res.json()
+        changed.update(item["id"] for item in data.get("results", []) if item.get("id") is not None)
+        total_pages = int(data.get("total_pages") or 1)
+        if total_pages > TMDB_CHANGES_MAX_PAGES:
+            print(f"[{label}] /{media_type}/changes has {total_pages} pages (> {TMDB_CHANGES_MAX_PAGES}), doing a full refresh")
+            return None
+        if page >= total_pages:
+            return changed
+        page += 1
+
+
+def tmdb_refresh_plan(state, namespace, media_type, label):
+    # plan["changed"] is None when every listed title has to be refetched.
+    # The feed is read from the day of the last sync, so successive runs see
+    # the same IDs again until the sync point moves to a later day. Titles
+    # already refetched in that window (plan["refetched"]) count as unchanged,
+    # and plan["cursor"] is the last ID the out-of-page pass got to.
+    started = int(time.time())
+    held = held_tmdb_ids(media_type) if TMDB_CHANGES or REFRESH_POLICY else set()
+    saved = (state.get(namespace) or {}).get("changes") or {}
+    last_sync = int(saved.get("last_sync") or 0)
+    plan = {"started": started, "held": held, "changed": None, "ok": True, "skipped": 0, "refreshed": 0,
+            "not_due": 0, "due": 0, "freshness": FreshnessStore(FRESHNESS_FILE) if REFRESH_POLICY else None,
+            "window": None, "refetched": set(), "cursor": 0}
+    if not TMDB_CHANGES or not held:
+        return plan
+    if not last_sync or started - last_sync > TMDB_CHANGES_MAX_DAYS * 24 * 3600:
+        print(f"[INFO] {label}: no change-feed sync in the last {TMDB_CHANGES_MAX_DAYS} days, doing a full refresh")
+        return plan
+    plan["changed"] = fetch_tmdb_changes(media_type, last_sync, label)
+    if plan["changed"] is None:
+        # Full refresh this run, and keep the old sync point for the next one
+        plan["ok"] = False
+        return plan
+    plan["window"] = changes_window(last_sync)
+    if saved.get("window") == plan["window"]:
+        plan["refetched"] = set(saved.get("refetched") or [])
+        plan["cursor"] = int(saved.get("cursor") or 0)
+    print(f"[INFO] {label}: {len(plan['changed'])} IDs changed since {plan['window']}, "
+          f"{len(plan['changed'] & held)} of them in the catalog, "
+          f"{len(plan['changed'] & plan['refetched'])} already refetched since then")
+    plan["changed"] -= plan["refetched"]
+    return plan
+
+
+def note_refetched(state, namespace, plan, ids):
+    # Remember changed titles refetched in the current feed window; the caller
+    # saves state.json with its own checkpoint
+    ids = [i for i in ids if plan_changed(plan, i)]
+    if not ids:
+        return
+    plan["refetched"].update(ids)
+    set_next_page(state, namespace, "changes", 1, window=plan["window"], cursor=plan["cursor"],
+                  refetched=sorted(plan["refetched"]))
+
+
+def plan_changed(plan, tmdb_id):
+    return plan["changed"] is not None and tmdb_id in plan["changed"]
+
+
+def plan_skips(plan, tmdb_id):
+    return plan["changed"] is not None and tmdb_id in plan["held"] and tmdb_id not in plan["changed"]
+
+
+def plan_policy_rows(plan, media_type, results):
+    # Freshness rows for the held titles on a list page that the change feed
+    # can't vouch for; their refetch is up to the refresh policy
+    if not plan or plan["freshness"] is None or plan["changed"] is not None:
+        return None
+    return plan["freshness"].lookup(media_type, [item.get("id") for item in results if item.get("id") in plan["held"]])
+
+
+def tmdb_stub(media_type, item, category):
+    # Enough to re-list a held title under this category; merge_record keeps
+    # every other stored field
+    stub = {"id": item.get("id"), "source": "TMDb", "category": category, "categories": [category]}
+    if media_type == "tv":
+        stub["type"] = "tv"
+    if item.get("vote_average"):
+        stub["rating"] = item.get("vote_average")
+    return stub
+
+
+def produce_changed_titles(pipeline, state, plan, namespace, label):
+    # Changed titles we hold that the category windows did not reach this run,
+    # in page-sized batches so the run budget can stop between them. Each run
+    # resumes after the saved cursor and wraps around, so a backlog larger
+    # than TMDB_CHANGES_PER_RUN is worked off over several runs.
+    if plan["changed"] is None:
+        return
+    with _memo_lock:
+        todo = sorted((i for i in plan["changed"] & plan["held"]
+                       if (pipeline.media_type, i) not in TITLE_MEMO and (pipeline.media_type, i) not in TITLE_CLAIMS),
+                      key=lambda i: (i <= plan["cursor"], i))
+    if len(todo) > TMDB_CHANGES_PER_RUN:
+        plan["ok"] = False
+        todo = todo[:TMDB_CHANGES_PER_RUN]
+    print(f"[INFO] {label}: refetching {len(todo)} changed titles outside this run's pages")
+    # The sink finishes batches in order; the cursor stops at the first one
+    # with a failed title so the next run starts there
+    progress = {"stuck": False}
+
+    def finish(records, reused, batch):
+        if len(records) < len(batch):
+            plan["ok"] = False
+            progress["stuck"] = True
+        elif not progress["stuck"]:
+            plan["cursor"] = batch[-1]
+        # Categories stay as stored; this run didn't list the title anywhere
+        for record in records:
+            record.pop("category", None)
+        append_journal(records)
+        note_refetched(state, namespace, plan, [record["id"] for record in records])
+        save_state(state)
+        plan["refreshed"] += len(records)
+
+    for i in range(0, len(todo), 20):
+        if not BUDGET.allows(f"{namespace}/changes", 1):
+            # The sync point stays put, so the rest is read again next run
+            plan["ok"] = False
+            break
+        batch = todo[i:i + 20]
+        pipeline.emit([{"id": tmdb_id} for tmdb_id in batch], "changes", None,
+                      lambda records, reused, batch=batch: finish(records, reused, batch), fresh=True,
+                      work=f"{namespace}/changes")
+
+
+def finish_refresh_plan(state, namespace, plan, label):
+    print(f"[INFO] {label}: skipped {plan['skipped']} unchanged titles, refreshed {plan['refreshed']} outside the page windows")
+    if plan["freshness"] is not None:
+        plan["freshness"].close()
+        if plan["changed"] is None and plan["held"]:
+            print(f"[INFO] {label}: refresh policy skipped {plan['not_due']} held titles not yet due, refetched {plan['due']}")
+    REFRESH_STATS[label] = {"feed_skipped": plan["skipped"], "policy_skipped": plan["not_due"],
+                            "policy_refetched": plan["due"], "refreshed_outside_pages": plan["refreshed"]}
+    # Only move the sync point when the feed was read and every changed title
+    # was refetched; otherwise the next run reads the same window again and
+    # carries on from the saved cursor. A sync point on a later day starts a
+    # new window, so the refetched IDs of the old one are dropped.
+    if TMDB_CHANGES and plan["ok"] and not circuit_open(TMDB_BASE_URL) and not BUDGET.dropped:
+        window = changes_window(plan["started"])
+        refetched = sorted(plan["refetched"]) if window == plan["window"] else []
+        set_next_page(state, namespace, "changes", 1, last_sync=plan["started"], window=window, cursor=0,
+                      refetched=refetched)
+        save_state(state)
+
+
+def crawl_tmdb_source(media_type, state=None):
+    source = TMDB_SOURCES[media_type]
+    label = source["label"]
+    state = state if state is not None else load_state()
+    plan = tmdb_refresh_plan(state, source["namespace"], media_type, label)
+    totals = {}
+
+    def produce(pipeline):
+        # Highest-priority categories first; they share the TMDb rate limit
+        # with everything listed after them. A category deferred last run
+        # moves up one tier but stays behind the fresher lists it was behind.
+        categories = sorted(source["categories"].items(), key=lambda item: BUDGET.tier(
+            f"{source['namespace']}/{item[0]}", category_tier(source, item[0])))
+        for category, base_url in categories:
+            produce_tmdb_category(pipeline, state, source, category, base_url, plan, totals)
+        produce_changed_titles(pipeline, state, plan, source["namespace"], label)
+
+    fetched = CrawlPipeline(media_type, source["shape"], label, freshness=plan["freshness"]).run(produce)
+    for category in source["categories"]:
+        print(f"[INFO] {label} {category} Total: {totals.get(category, 0)} items")
+    finish_refresh_plan(state, source["namespace"], plan, label)
+    return fetched
+
+
+def fetch_tmdb(state=None):
+    print("[INFO] Fetching MAXIMUM TMDb data from all categories...")
+    return crawl_tmdb_source("movie", state)
+
+
+def fetch_tmdb_tv(state=None):
+    print("[INFO] Fetching MAXIMUM TMDb TV series from all categories...")
+    return crawl_tmdb_source("tv", state)
+
+
+# Back-catalog crawl for CI matrix workers (--shard i/N). The work space is
+# every (media type, discover category, year bucket, page range) unit; each
+# unit goes to worker crc32(unit) % N, so N runners split it without talking
+# to each other. Workers only write a partial spool; --merge folds the
+# partials into the catalog and publishes.
+PARTIAL_DIR = os.environ.get("PARTIAL_DIR", "partials")
+DISCOVER_YEAR_FROM = _get_int_env("DISCOVER_YEAR_FROM", 1900)
+DISCOVER_MAX_PAGES = min(_get_int_env("DISCOVER_MAX_PAGES", TMDB_MAX_PAGES), TMDB_MAX_PAGES)
+DISCOVER_PAGE_CHUNK = _get_int_env("DISCOVER_PAGE_CHUNK", 20)
+DISCOVER_CATEGORIES = {
+    "movie": {
+        "discover_popular": {"sort_by": "popularity.desc"},
+        "discover_top_rated": {"sort_by": "vote_average.desc", "vote_count.gte": 100},
+    },
+    "tv": {
+        "discover_popular": {"sort_by": "popularity.desc"},
+        "discover_top_rated": {"sort_by": "vote_average.desc", "vote_count.gte": 100},
+    },
+}
+DISCOVER_DATE_FIELD = {"movie": "primary_release_date", "tv": "first_air_date"}
+
+
+def discover_year_buckets():
+    # Decades while TMDb is sparse, single years from 1990 on; each bucket
+    # has to stay under the 500-page discover cap
+    this_year = datetime.now(timezone.utc).year
+    buckets = []
+    year = DISCOVER_YEAR_FROM
+    while year <= this_year:
+        span = 1 if year >= 1990 else 10 - year % 10
+        buckets.append((year, min(year + span - 1, this_year)))
+        year += span
+    return buckets
+
+
+def discover_work_units():
+    units = []
+    for media_type, categories in DISCOVER_CATEGORIES.items():
+        for category in categories:
+            for first_year, last_year in discover_year_buckets():
+                for first_page in range(1, DISCOVER_MAX_PAGES + 1, DISCOVER_PAGE_CHUNK):
+                    last_page = min(first_page + DISCOVER_PAGE_CHUNK - 1, DISCOVER_MAX_PAGES)
+                    units.append((media_type, category, first_year, last_year, first_page, last_page))
+    return units
+
+
+def shard_units(index, count):
+    return [unit for unit in discover_work_units()
+            if zlib.crc32("/".join(map(str, unit)).encode()) % count == index]
+
+
+def partial_path(index, count):
+    return os.path.join(PARTIAL_DIR, f"part-{index:03d}-of-{count:03d}.ndjson")
+
+
+def produce_discover_unit(pipeline, unit, out_path):
+    # Returns the bucket's total_pages, or None if its first page failed
+    media_type, category, first_year, last_year, first_page, last_page = unit
+    date_field = DISCOVER_DATE_FIELD[media_type]
+    label = f"TMDb Discover {media_type} {category} {first_year}-{last_year}"
+    params = dict(DISCOVER_CATEGORIES[media_type][category])
+    params[f"{date_field}.gte"] = f"{first_year}-01-01"
+    params[f"{date_field}.lte"] = f"{last_year}-12-31"
+    total_pages = None
+
+    def finish(records, reused):
+        # Discover partitions are crawl bookkeeping, not categories: records
+        # carry none, and merge_record keeps the ones the catalog already has.
+        # Titles seen in an earlier unit are already in the partial.
+        for record in records:
+            record.pop("category", None)
+        append_journal(records, out_path)
+
+    for page in range(first_page, last_page + 1):
+        if not BUDGET.allows("discover", 1):
+            break
+        url = f"{TMDB_BASE_URL}/discover/{media_type}?api_key={TMDB_API_KEY}&page={page}"
+        res = http_fetch(url, f"{label} Page {page}", attempts=3, params=params, stage="list_fetch")
+        if res is None:
+            print(f"[{label} Error] Failed to fetch page {page} after retries")
+            break
+        data = res.json()
+        pipeline.emit(data.get("results", []), unit, None, finish, work="discover")
+        total_pages = min(int(data.get("total_pages") or 1), TMDB_MAX_PAGES)
+        if page >= total_pages:
+            break
+    return total_pages
+
+
+def run_shard(index, count):
+    units = shard_units(index, count)
+    out_path = partial_path(index, count)
+    os.makedirs(PARTIAL_DIR, exist_ok=True)
+    if os.path.exists(out_path):
+        os.remove(out_path)
+    print(f"[SHARD] Worker {index}/{count}: {len(units)} discover units -> {out_path}")
+    # One pipeline per media type (the memo and detail endpoint are per type).
+    # Lowest page ranges first: once a bucket's total_pages is known, this
+    # worker's ranges past it are skipped without a request
+    known_totals = {}
+    skipped = 0
+    total = 0
+    for media_type in DISCOVER_CATEGORIES:
+
+        def produce(pipeline):
+            nonlocal skipped
+            for unit in sorted((u for u in units if u[0] == media_type), key=lambda u: (u[4],) + u[:4]):
+                bucket = unit[:4]
+                if unit[4] > known_totals.get(bucket, TMDB_MAX_PAGES):
+                    skipped += 1
+                    continue
+                try:
+                    total_pages = produce_discover_unit(pipeline, unit, out_path)
+                    if total_pages is not None:
+                        known_totals[bucket] = total_pages
+                except Exception as e:
+                    print(f"[SHARD] Unit {unit} failed: {e}")
+
+        # The memo keeps keys only: a worker sees up to a few hundred thousand titles
+        total += CrawlPipeline(media_type, TMDB_SOURCES[media_type]["shape"], f"TMDb Discover {media_type}",
+                               keep_records=False).run(produce)
+    print(f"[SHARD] Worker {index}/{count}: {total} titles fetched, {skipped} units past the last page skipped")
+    return total
+
+
+def iter_partials(paths, merged=None):
+    # Directories expand to their *.ndjson files; sorted for a stable merge.
+    # Each file is added to `merged` once it has been read. Missing paths
+    # (e.g. every shard job failed) are skipped with a warning.
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".ndjson"))
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            print(f"[MERGE] Warning: {path} does not exist, skipping it")
+    print(f"[MERGE] Folding {len(files)} partial spool(s) into the catalog")
+    for path in sorted(files):
+        if not os.path.isfile(path):
+            print(f"[MERGE] Warning: {path} disappeared before it was read, skipping it")
+            continue
+        yield from iter_ndjson(path)
+        if merged is not None:
+            merged.append(path)
+
+
+# TVMaze sync: one full crawl of the /shows index (resumable, until the 404
+# end marker), then incremental runs that read /updates/shows and refetch
+# only shows whose "updated" timestamp moved. A local store remembers the
+# last seen timestamp for every show.
+TVMAZE_STORE_FILE = os.environ.get("TVMAZE_STORE_FILE", os.path.join(".cache", "tvmaze_store.sqlite"))
+TVMAZE_UPDATES_PER_RUN = _get_int_env("TVMAZE_UPDATES_PER_RUN", 300)
+# /updates/shows?since=... windows, smallest first
+TVMAZE_UPDATE_WINDOWS = (("day", 24 * 3600), ("week", 7 * 24 * 3600), ("month", 30 * 24 * 3600))
+
+
+def open_tvmaze_store() -> sqlite3.Connection:
+    if os.path.dirname(TVMAZE_STORE_FILE):
+        os.makedirs(os.path.dirname(TVMAZE_STORE_FILE), exist_ok=True)
+    db = sqlite3.connect(TVMAZE_STORE_FILE, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("CREATE TABLE IF NOT EXISTS shows (id INTEGER PRIMARY KEY, updated INTEGER, record TEXT)")
+    return db
+
+
+def store_tvmaze_shows(db: sqlite3.Connection, shows: list, records: list) -> None:
+    db.execute("BEGIN")
+    db.executemany(
+        "INSERT OR REPLACE INTO shows (id, updated, record) VALUES (?, ?, ?)",
+        [(show.get("id"), show.get("updated") or 0, json.dumps(record, ensure_ascii=False))
+         for show, record in zip(shows, records)]
+    )
+    db.execute("COMMIT")
+
+
+def build_tvmaze_show(show):
+    premiered = show.get("premiered")
+    year = premiered[:4] if premiered else "N/A"
+    externals = show.get("externals") or {}
+    return {
+        "id": show.get("id"),
+        "title": show.get("name"),
+        "year": year,
+        "overview": show.get("summary", "").replace("<p>", "").replace("</p>", "") if show.get("summary") else "",
+        "poster": show.get("image", {}).get("medium") if show.get("image") else "",
+        "rating": show.get("rating", {}).get("average") if show.get("rating") else None,
+        "genres": show.get("genres", []),
+        "external_ids": {
+            name: externals[field]
+            for name, field in (("imdb_id", "imdb"), ("tvdb_id", "thetvdb"), ("tvrage_id", "tvrage"))
+            if externals.get(field)
+        },
+        "source": "TVMaze"
+    }
 
-            shows = []
-            for show in res.json():
-                premiered = show.get("premiered")
-                year = premiered[:4] if premiered else "N/A"
-                shows.append({
-                    "id": show.get("id"),
-                    "title": show.get("name"),
-                    "year": year,
-                    "overview": show.get("summary", "").replace("<p>", "").replace("</p>", "") if show.get("summary") else "",
-                    "poster": show.get("image", {}).get("medium") if show.get("image") else "",
-                    "rating": show.get("rating", {}).get("average") if show.get("rating") else None,
-                    "genres": show.get("genres", []),
-                    "source": "TVMaze"
-                })
+
+def crawl_tvmaze_index(state, db):
+    # TVMaze index pages start at 0; a 404 marks the end of the index
+    start = get_start_page(state, "tvmaze", "shows", default_start=0)
+    if start == 0:
+        # Updates that land while the full crawl is running are picked up
+        # by the first incremental sync
+        set_next_page(state, "tvmaze", "shows", 0, crawl_started=int(time.time()))
+    all_shows = []
+
+    page = start
+    for _ in range(TVMAZE_PAGES_PER_RUN):
+        if not BUDGET.allows("tvmaze/shows", 1):
+            break
+        try:
+            url = f"{TVMAZE_BASE_URL}/shows?page={page}"
+            print(f"[INFO] Fetching TVMaze page {page}...")
+
+            res = http_fetch(url, f"TVMaze Page {page}", attempts=3, ok_statuses=(200, 404), stage="list_fetch")
+            if res is None:
+                print(f"[TVMaze Error] Failed to fetch page {page} after retries")
+                break
+            if res.status_code == 404:
+                print(f"[INFO] TVMaze index ends before page {page}: full crawl complete, switching to /updates/shows")
+                crawl_started = state["tvmaze"]["shows"].get("crawl_started") or int(time.time())
+                set_next_page(state, "tvmaze", "shows", 0, full_sync_done=True, last_sync=crawl_started)
+                save_state(state)
+                break
+
+            raw_shows = res.json()
+            shows = [build_tvmaze_show(show) for show in raw_shows]
+            append_journal(shows)
+            store_tvmaze_shows(db, raw_shows, shows)
+            set_next_page(state, "tvmaze", "shows", page + 1)
+            save_state(state)
 
             all_shows.extend(shows)
             print(f"[INFO] TVMaze Page {page}: {len(shows)} shows fetched")
+            page += 1
 
         except Exception as e:
             print(f"[TVMaze Page {page} Error] {e}")
-    
-    print(f"[INFO] TVMaze Total: {len(all_shows)} shows fetched")
+            break
+
     return all_shows
 
 
-def fetch_wikidata(limit=50):
-    print(f"[INFO] Fetching MAXIMUM Wikidata movies (limit: {limit})...")
+def sync_tvmaze_updates(state, db):
+    if not BUDGET.allows("tvmaze/updates", 1):
+        return []
+    sync_started = int(time.time())
+    last_sync = int(state["tvmaze"]["shows"].get("last_sync") or 0)
+    elapsed = sync_started - last_sync
+    # Smallest /updates window that still covers everything since the last sync
+    since = next((name for name, seconds in TVMAZE_UPDATE_WINDOWS if elapsed < seconds), None)
+    url = f"{TVMAZE_BASE_URL}/updates/shows" + (f"?since={since}" if since else "")
+    res = http_fetch(url, "TVMaze Updates", attempts=3, fresh=True, stage="list_fetch")
+    if res is None:
+        print("[TVMaze Error] Failed to fetch /updates/shows")
+        return []
+
+    updates = {int(show_id): int(updated) for show_id, updated in res.json().items()}
+    known = {}
+    ids = sorted(updates)
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        rows = db.execute(
+            f"SELECT id, updated FROM shows WHERE id IN ({','.join('?' * len(chunk))})", chunk
+        ).fetchall()
+        known.update(rows)
+    changed = [show_id for show_id in ids if updates[show_id] > known.get(show_id, 0)]
+    todo = changed[:TVMAZE_UPDATES_PER_RUN]
+    print(f"[INFO] TVMaze updates since {since or 'ever'}: {len(updates)} listed, "
+          f"{len(changed)} changed, refetching {len(todo)}")
+
+    def fetch_show(show_id):
+        # Skipped shows leave the sync point where it is, so they come back next run
+        if not BUDGET.allows("tvmaze/updates", 1):
+            return None
+        res = http_fetch(f"{TVMAZE_BASE_URL}/shows/{show_id}", f"TVMaze Show {show_id}", attempts=3, fresh=True,
+                         stage="detail_fetch")
+        return res.json() if res is not None else None
+
+    with ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT) as pool:
+        raw_shows = [show for show in pool.map(fetch_show, todo) if show]
+    shows = [build_tvmaze_show(show) for show in raw_shows]
+    append_journal(shows)
+    store_tvmaze_shows(db, raw_shows, shows)
+
+    # Only move the sync point once every changed show has been refetched;
+    # otherwise the rest are picked up next run from the same window
+    if len(todo) == len(changed) and len(raw_shows) == len(todo):
+        set_next_page(state, "tvmaze", "shows", 0, last_sync=sync_started)
+        save_state(state)
+    return shows
+
+
+def fetch_tvmaze(state=None):
+    print("[INFO] Fetching MAXIMUM TVMaze shows...")
+    state = state if state is not None else load_state()
+    db = open_tvmaze_store()
     try:
-        # Optimized query with increased limit
-        query = f"""
-        SELECT ?movie ?movieLabel ?poster WHERE {{
-          ?movie wdt:P31 wd:Q11424.
-          OPTIONAL {{ ?movie wdt:P18 ?poster. }}
-          SERVICE wikibase:label {{ bd:serviceParam wikibase:language "en". }}
-        }} LIMIT {limit}
-        """
-        url = "https://query.wikidata.org/sparql"
-        headers = {
-            "Accept": "application/sparql-results+json",
-            "User-Agent": "MovieMetadataUpdater/1.0"
-        }
+        if (state.get("tvmaze", {}).get("shows") or {}).get("full_sync_done"):
+            all_shows = sync_tvmaze_updates(state, db)
+        else:
+            all_shows = crawl_tvmaze_index(state, db)
+    finally:
+        db.close()
 
-        # Enhanced retry logic with exponential backoff
-        for attempt in range(5):  # Increased retries
+    print(f"[INFO] TVMaze Total: {len(all_shows)} shows fetched")
+    return len(all_shows)
+
+
+# Wikidata films are crawled in pages keyed on the numeric entity ID
+# (?num > cursor ORDER BY ?num), never with OFFSET, so every page costs the
+# same no matter how deep the crawl is. Pages come back as TSV and are parsed
+# row by row while streaming; the cursor lives in state.json and wraps to the
+# start once a short page marks the end.
+WIKIDATA_PAGE_SIZE = _get_int_env("WIKIDATA_PAGE_SIZE", 500)
+WIKIDATA_PAGES_PER_RUN = _get_int_env("WIKIDATA_PAGES_PER_RUN", 4)
+WIKIDATA_TIMEOUT = _get_int_env("WIKIDATA_TIMEOUT", 60)
+_TSV_ESCAPES = {"t": "\t", "n": "\n", "r": "\r", "\\": "\\", '"': '"'}
+
+
+def wikidata_query(after, limit):
+    # The inner select picks the page of IDs; OPTIONALs and labels only run
+    # for those. IMDb (P345) and TMDb (P4947 movie / P4983 TV) IDs let the
+    # merge stage match these rows to TMDb/TVMaze records. Aggregates need
+    # fresh names: SPARQL won't rebind a variable already in scope.
+    return f"""
+    SELECT ?num ?movieLabel (SAMPLE(?poster) AS ?posterSample) (MIN(?date) AS ?minDate)
+           (SAMPLE(?imdb) AS ?imdbSample) (SAMPLE(?tmdbMovie) AS ?tmdbMovieSample)
+           (SAMPLE(?tmdbTv) AS ?tmdbTvSample)
+           (GROUP_CONCAT(DISTINCT ?genreLabel; separator="|") AS ?genres)
+           (GROUP_CONCAT(DISTINCT ?directorLabel; separator="|") AS ?directors) WHERE {{
+      {{
+        SELECT ?movie ?num WHERE {{
+          ?movie wdt:P31 wd:Q11424.
+          BIND(xsd:integer(STRAFTER(STR(?movie), "/entity/Q")) AS ?num)
+          FILTER(?num > {int(after)})
+        }}
+        ORDER BY ?num
+        LIMIT {int(limit)}
+      }}
+      OPTIONAL {{ ?movie wdt:P18 ?poster. }}
+      OPTIONAL {{ ?movie wdt:P577 ?date. }}
+      OPTIONAL {{ ?movie wdt:P345 ?imdb. }}
+      OPTIONAL {{ ?movie wdt:P4947 ?tmdbMovie. }}
+      OPTIONAL {{ ?movie wdt:P4983 ?tmdbTv. }}
+      OPTIONAL {{ ?movie wdt:P136 ?genre. }}
+      OPTIONAL {{ ?movie wdt:P57 ?director. }}
+      SERVICE wikibase:label {{
+        bd:serviceParam wikibase:language "en".
+        ?movie rdfs:label ?movieLabel.
+        ?genre rdfs:label ?genreLabel.
+        ?director rdfs:label ?directorLabel.
+      }}
+    }}
+    GROUP BY ?num ?movieLabel
+    ORDER BY ?num
+    """
+
+
+def parse_tsv_term(term):
+    # SPARQL TSV cells: <iri>, "literal"@lang, "literal"^^<type>, bare numbers
+    if not term:
+        return None
+    if term.startswith("<") and term.endswith(">"):
+        return term[1:-1]
+    if term.startswith('"'):
+        end = term.rfind('"')
+        text = term[1:end] if end > 0 else term[1:]
+        return re.sub(r'\\(.)', lambda m: _TSV_ESCAPES.get(m.group(1), m.group(1)), text)
+    return term
+
+
+def iter_tsv_rows(res):
+    # One row at a time off the socket; split on \n only, since labels can
+    # hold other Unicode line breaks
+    columns = None
+    for raw in res.iter_lines(delimiter=b"\n"):
+        METRICS.add_bytes(res.url, len(raw) + 1)
+        line = raw.decode("utf-8").rstrip("\r")
+        if not line:
+            continue
+        cells = line.split("\t")
+        if columns is None:
+            columns = [c.lstrip("?") for c in cells]
+            continue
+        yield {name: parse_tsv_term(cell) for name, cell in zip(columns, cells)}
+
+
+def fetch_wikidata_page(after, label, attempts=5):
+    # Streamed, so it skips the response cache; retries mirror http_fetch.
+    # A page that breaks mid-stream is retried whole.
+    query = wikidata_query(after, WIKIDATA_PAGE_SIZE)
+    headers = {"Accept": "text/tab-separated-values", "User-Agent": "MovieMetadataUpdater/1.0"}
+    with METRICS.stage("list_fetch"):
+        for attempt in range(attempts):
             try:
-                print(f"[Wikidata] Attempt {attempt+1}/5...")
-                res = requests.get(
-                    url, 
-                    params={"query": query}, 
-                    headers=headers, 
-                    timeout=120  # Increased timeout to 2 minutes
-                )
-                res.raise_for_status()
-                
-                data = res.json()
-                movies = []
-                for item in data.get("results", {}).get("bindings", []):
-                    movies.append({
-                        "title": item.get("movieLabel", {}).get("value") or "N/A",
-                        "poster": item.get("poster", {}).get("value") or "",
-                        "source": "Wikidata"
-                    })
-                print(f"[Wikidata] Successfully fetched {len(movies)} movies")
-                return movies
-                
-            except requests.exceptions.Timeout:
-                print(f"[Wikidata Timeout] Attempt {attempt+1} - Request timed out after 120s")
-                if attempt < 4:
-                    wait_time = (attempt + 1) * 10  # Exponential backoff: 10s, 20s, 30s, 40s
-                    print(f"[Wikidata] Waiting {wait_time}s before retry...")
-                    time.sleep(wait_time)
-                    
-            except requests.exceptions.ConnectionError:
-                print(f"[Wikidata Connection Error] Attempt {attempt+1} - Network issue")
-                if attempt < 4:
-                    wait_time = (attempt + 1) * 8
-                    print(f"[Wikidata] Waiting {wait_time}s before retry...")
-                    time.sleep(wait_time)
-                    
+                res = send_request(WIKIDATA_URL, params={"query": query}, headers=headers,
+                                   timeout=WIKIDATA_TIMEOUT, stream=True)
+                with res:
+                    if res.status_code == 200:
+                        return list(iter_tsv_rows(res))
+                    print(f"[{label} Retry {attempt+1}] Status Code: {res.status_code}")
+                    if res.status_code not in RETRY_STATUSES:
+                        return None
+            except (CircuitOpenError, BudgetExpiredError):
+                return None
             except Exception as e:
-                print(f"[Wikidata Error] Attempt {attempt+1}: {e}")
-                if attempt < 4:
-                    wait_time = (attempt + 1) * 5
-                    print(f"[Wikidata] Waiting {wait_time}s before retry...")
-                    time.sleep(wait_time)
+                print(f"[{label} Retry {attempt+1}] {e}")
+            if attempt < attempts - 1 and not BUDGET.expired() and not circuit_open(WIKIDATA_URL):
+                METRICS.retry(WIKIDATA_URL)
+                sleep_ms(backoff_ms(attempt))
+            else:
+                break
+        return None
 
-        print("[Wikidata Error] Failed to fetch after all retries")
-        return []
 
-    except Exception as e:
-        print(f"[Wikidata Fetch Error] {e}")
-        return []
+def build_wikidata_movie(row):
+    date = row.get("minDate") or ""
+    external_ids = {
+        name: row[field]
+        for name, field in (("imdb_id", "imdbSample"), ("tmdb_movie_id", "tmdbMovieSample"),
+                            ("tmdb_tv_id", "tmdbTvSample"))
+        if row.get(field)
+    }
+    return {
+        "id": f"Q{row['num']}",
+        "title": row.get("movieLabel") or "N/A",
+        "year": date[:4] if date[:4].isdigit() else "N/A",
+        "release_date": date[:10] if date[:4].isdigit() else None,
+        "poster": row.get("posterSample") or "",
+        "genres": [g for g in (row.get("genres") or "").split("|") if g],
+        "directors": [d for d in (row.get("directors") or "").split("|") if d],
+        "external_ids": external_ids,
+        "source": "Wikidata"
+    }
+
+
+def fetch_wikidata(state=None):
+    print(f"[INFO] Fetching Wikidata films ({WIKIDATA_PAGES_PER_RUN} pages x {WIKIDATA_PAGE_SIZE})...")
+    state = state if state is not None else load_state()
+    films = (state.get("wikidata") or {}).get("films") or {}
+    after = int(films.get("after") or 0)
+    page = int(films.get("next_page") or 1)
+    movies = []
+
+    for _ in range(WIKIDATA_PAGES_PER_RUN):
+        if not BUDGET.allows("wikidata/films", 2):
+            break
+        try:
+            label = f"Wikidata Page {page} (after Q{after})"
+            rows = fetch_wikidata_page(after, label)
+            note_source_page(rows is not None)
+            if rows is None:
+                # Keep the cursor here so the next run retries this page
+                print(f"[Wikidata Error] Failed to fetch page after Q{after}")
+                break
+
+            page_items = [build_wikidata_movie(row) for row in rows if (row.get("num") or "").isdigit()]
+            append_journal(page_items)
+            movies.extend(page_items)
+            if len(rows) < WIKIDATA_PAGE_SIZE:
+                # Short page: end of the list, start over to pick up edits and new films
+                print(f"[INFO] {label}: {len(page_items)} films, reached the end, wrapping")
+                after, page = 0, 1
+            else:
+                after = max(int(row["num"]) for row in rows if (row.get("num") or "").isdigit())
+                page += 1
+                print(f"[INFO] {label}: {len(page_items)} films")
+            set_next_page(state, "wikidata", "films", page, after=after)
+            save_state(state)
+            if after == 0:
+                break
+        except Exception as e:
+            print(f"[Wikidata Page {page} Error] {e}")
+            break
+
+    print(f"[Wikidata] Successfully fetched {len(movies)} movies")
+    return len(movies)
+
+
+# The upstream each source depends on. A source that raised, whose host's
+# circuit breaker opened, or that tried list pages and got none of them
+# (e.g. a 401 from a bad key) is marked stale in state.json ("sources")
+# and in the movies.json header. Its records from the last good run stay
+# in the catalog store, so the published catalog keeps them.
+SOURCE_URLS = {
+    "TMDb Movies": TMDB_BASE_URL, "TMDb TV": TMDB_BASE_URL, "TVMaze": TVMAZE_BASE_URL, "Wikidata": WIKIDATA_URL,
+}
+
+
+def update_source_health(state: Dict[str, Any], name: str, error) -> None:
+    now = datetime.now(timezone.utc).isoformat()
+    with STATE_LOCK:
+        health = state.setdefault("sources", {})
+        entry = dict(health.get(name) or {})
+        if error:
+            entry.update(status="stale", error=error)
+            entry.setdefault("stale_since", now)
+        else:
+            entry = {"status": "ok", "last_success": now}
+        health[name] = entry
+
 
+def stale_sources(state: Dict[str, Any]) -> Dict[str, Any]:
+    return {name: entry for name, entry in (state.get("sources") or {}).items() if entry.get("status") == "stale"}
 
-def main():
+
+def circuit_summary() -> Dict[str, Any]:
+    with _circuit_breakers_lock:
+        return {host: breaker.summary() for host, breaker in sorted(_circuit_breakers.items())}
+
+
+def run_sources(state: Dict[str, Any]):
+    # Each source runs on its own thread with its own worker pool; sources on
+    # the same host share that host's rate limiter. Results are collected as
+    # each source finishes, so the run takes about as long as the slowest one.
+    # Fetchers journal what they build and return how many records that was.
+    sources = {
+        "TMDb Movies": lambda: fetch_tmdb(state),
+        "TMDb TV": lambda: fetch_tmdb_tv(state),
+        "TVMaze": lambda: fetch_tvmaze(state),
+        "Wikidata": lambda: fetch_wikidata(state),
+    }
+    results = {}
+    timings = {}
+
+    def timed(name, fetch):
+        started = time.monotonic()
+        error = None
+        _source_pages.counts = pages = {"ok": 0, "failed": 0}
+        try:
+            fetched = fetch()
+        except Exception as e:
+            print(f"[{name} Error] Source failed: {e}")
+            fetched = 0
+            error = str(e)
+        if circuit_open(SOURCE_URLS[name]):
+            error = error or f"circuit open for {circuit_breaker(SOURCE_URLS[name]).host}"
+        if pages["failed"] and not pages["ok"]:
+            # Work the run budget deferred isn't tried, so it doesn't count here
+            error = error or f"none of its {pages['failed']} list page requests succeeded"
+        update_source_health(state, name, error)
+        if error:
+            last_success = state["sources"][name].get("last_success") or "never"
+            print(f"[{name} Error] Marked stale, keeping its records from the last good run ({last_success})")
+        return fetched, time.monotonic() - started
+
+    with ThreadPoolExecutor(max_workers=len(sources)) as pool:
+        futures = {pool.submit(timed, name, fetch): name for name, fetch in sources.items()}
+        for future in as_completed(futures):
+            name = futures[future]
+            results[name], timings[name] = future.result()
+            METRICS.source(name, timings[name], results[name])
+            print(f"✅ {name}: {results[name]} fetched in {timings[name]:.1f}s")
+
+    # Report in a fixed order regardless of which source finished first
+    return {name: results[name] for name in sources}, {name: timings[name] for name in sources}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fetch movie/TV metadata and publish movies.json")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--shard", metavar="i/N",
+                      help="crawl only worker i's slice (0 <= i < N) of the TMDb discover back catalog into a partial spool")
+    mode.add_argument("--merge", nargs="*", metavar="PATH",
+                      help=f"fold partial spools (files or directories, default {PARTIAL_DIR}/) into the catalog and publish")
+    args = parser.parse_args(argv)
+    if args.shard:
+        match = re.fullmatch(r"(\d+)/(\d+)", args.shard)
+        if not match or not 0 <= int(match.group(1)) < int(match.group(2)):
+            parser.error("--shard expects i/N with 0 <= i < N, e.g. 0/8")
+        args.shard = (int(match.group(1)), int(match.group(2)))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
     print("=" * 60)
     print("🎬 MOVIE METADATA AUTO-UPDATER")
     print("=" * 60)
     print(f"[INFO] Starting movie metadata update at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print()
 
+    TITLE_MEMO.clear()
+    TITLE_CLAIMS.clear()
+    TITLE_WAITERS.clear()
+    REFRESH_STATS.clear()
+    if args.shard:
+        require_tmdb_keys()
+        BUDGET.start({})
+        fetched = run_shard(*args.shard)
+        write_run_metrics({"mode": "shard", "shard": "/".join(map(str, args.shard)), "fetched": fetched,
+                           "budget": BUDGET.summary(), "circuits": circuit_summary()})
+        close_http_cache()
+        return
+
     # Track progress
     total_fetched = 0
-    
-    print("📡 Fetching from TMDb (movies)...")
-    tmdb_movies = fetch_tmdb()
-    print(f"✅ TMDb Movies: {len(tmdb_movies)} fetched")
-    total_fetched += len(tmdb_movies)
+    merged_partials = []
+    state = load_state()
+    BUDGET.start(state)
+    # The TMDb fetchers read the store to know which titles are already held
+    catalog_state = state.setdefault("catalog", {})
+    expected_version = catalog_state.get("pending_version") or catalog_state.get("version", 0)
+    if ensure_catalog_store(expected_version) == expected_version + 1:
+        catalog_state["pending_version"] = expected_version + 1
+
+    if args.merge is not None:
+        # The journal still goes first: it may hold pages from a killed run
+        updates = itertools.chain(iter_ndjson(JOURNAL_FILE), iter_partials(args.merge or [PARTIAL_DIR], merged_partials))
+        timings = {}
+    else:
+        require_tmdb_keys()
+        print("📡 Fetching TMDb (movies + TV), TVMaze and Wikidata in parallel...")
+        results, timings = run_sources(state)
+        total_fetched = sum(results.values())
+        updates = iter_ndjson(JOURNAL_FILE)
     print()
 
-    print("📡 Fetching from TMDb (TV series)...")
-    tmdb_tv = fetch_tmdb_tv()
-    print(f"✅ TMDb TV: {len(tmdb_tv)} fetched")
-    total_fetched += len(tmdb_tv)
-    print()
-
-    print("📺 Fetching from TVMaze...")
-    tvmaze_shows = fetch_tvmaze()
-    print(f"✅ TVMaze: {len(tvmaze_shows)} shows fetched")
-    total_fetched += len(tvmaze_shows)
-    print()
-
-    print("🌐 Fetching from Wikidata...")
-    wikidata_movies = fetch_wikidata(limit=50)  # Increased limit for maximum data
-    print(f"✅ Wikidata: {len(wikidata_movies)} movies fetched")
-    total_fetched += len(wikidata_movies)
-    print()
-
-    print("🔄 Combining all data...")
-    combined = tmdb_movies + tmdb_tv + tvmaze_shows + wikidata_movies
-
-    # Calculate category breakdown for TMDb movies
-    tmdb_categories = {}
-    for item in tmdb_movies:
-        category = item.get("category", "unknown")
-        tmdb_categories[category] = tmdb_categories.get(category, 0) + 1
-    tmdb_tv_categories = {}
-    for item in tmdb_tv:
-        category = item.get("category", "unknown")
-        tmdb_tv_categories[category] = tmdb_tv_categories.get(category, 0) + 1
-
-    print("💾 Saving to movies.json...")
-    output = {
-        "developer": {
-            "name": "Abdul Mueed",
-            "contact": "am-abdulmueed3@gmail.com",
-            "website": "https://github.com/betapix"
-        },
-        "last_updated": datetime.now(timezone.utc).isoformat(),
-        "total_entries": len(combined),
-        "breakdown": {
-            "tmdb_movies": len(tmdb_movies),
-            "tmdb_tv": len(tmdb_tv),
-            "tvmaze_shows": len(tvmaze_shows),
-            "wikidata_movies": len(wikidata_movies)
-        },
-        "tmdb_categories": tmdb_categories,
-        "tmdb_tv_categories": tmdb_tv_categories,
-        "movies": combined
-    }
-
+    total_entries = None
+    failed = False
+    publish_started = time.monotonic()
     try:
-        with open("movies.json", "w", encoding="utf-8") as f:
-            json.dump(output, f, ensure_ascii=False, indent=2)
-
-        # Also write compressed JSON for faster downloads
-        with gzip.open("movies.json.gz", "wt", encoding="utf-8") as f:
-            json.dump(output, f, ensure_ascii=False)
+        print("🔄 Merging into existing catalog...")
+        # A version whose delta was written by an interrupted run still has
+        # to be published, even if this run changes nothing
+        catalog_state = state.setdefault("catalog", {})
+        version = catalog_state.get("pending_version") or catalog_state.get("version", 0)
+        publish = bool(catalog_state.get("pending_version")) or not os.path.exists(CATALOG_FILE)
+        # A source going stale (or recovering) changes the header, so it is republished
+        source_status = {name: entry.get("status") for name, entry in state.get("sources", {}).items()}
+        publish = publish or catalog_state.get("source_status") != source_status
+
+        # The journal holds everything fetched since the last completed run,
+        # including pages from a run that was killed before writing output.
+        # Breakdown and category counts cover the whole catalog.
+        delta = new_delta()
+        with METRICS.stage("merge"):
+            stats = merge_catalog(updates, delta, category_cutoffs(state))
+        breakdown = stats["breakdown"]
+        tmdb_categories = stats["tmdb_categories"]
+        total_entries = stats["total_entries"]
+        # The delta is written before the store is committed at its version.
+        # A run killed before the commit leaves the store as it was, so the
+        # next run merges the journal again and rewrites the same version;
+        # one killed after it is picked up by ensure_catalog_store() and
+        # publishes that version (the journal it merges again changes nothing).
+        if delta_size(delta):
+            version += 1
+            with METRICS.stage("delta"):
+                write_delta(delta, version)
+        commit_catalog(version)
+        if delta_size(delta):
+            catalog_state["pending_version"] = version
+            save_state(state)
+            publish = True
+        print(f"🔁 Delta: {len(delta['added'])} added, {len(delta['changed'])} changed, "
+              f"{len(delta['removed'])} removed (version {version})")
+
+        if publish:
+            print("💾 Saving to movies.json...")
+            header = {
+                "developer": {
+                    "name": "Abdul Mueed",
+                    "contact": "am-abdulmueed3@gmail.com",
+                    "website": "https://github.com/betapix"
+                },
+                "last_updated": datetime.now(timezone.utc).isoformat(),
+                "version": version,
+                "delta": {
+                    "latest_version": version,
+                    "oldest_version": prune_deltas(version),
+                    "path": DELTA_DIR + "/delta_{version}.json.gz"
+                },
+                "total_entries": stats["total_entries"],
+                "merged_entries": stats["merged_entries"],
+                "breakdown": breakdown,
+                "tmdb_categories": tmdb_categories,
+                "tmdb_tv_categories": stats["tmdb_tv_categories"],
+                "encodings": catalog_encodings(CATALOG_FILE),
+                # Per source: "ok" or "stale" (upstream failed, last good records kept)
+                "source_status": state.get("sources", {}),
+            }
+            if SEARCH_INDEX:
+                header["search_index"] = {"format_version": SEARCH_INDEX_VERSION,
+                                          "encodings": catalog_encodings(SEARCH_INDEX_BASE)}
+            # Writes movies.json plus one compressed copy per OUTPUT_CODECS entry
+            COMPRESSION_STATS.clear()
+            write_catalog_outputs(header)
+            if SHARDED_OUTPUT:
+                with METRICS.stage("shards"):
+                    shard_count = write_shard_outputs(header)
+                print(f"🧩 Sharded output: {shard_count} chunk files + {SHARD_DIR}/manifest.json")
+            if COMPACT_OUTPUT:
+                with METRICS.stage("compact"):
+                    write_compact_output(header)
+                print(f"🗜️ Compact output: {COMPACT_FILE} ({os.path.getsize(COMPACT_FILE)} bytes vs "
+                      f"{os.path.getsize(CATALOG_GZ_FILE)} for {CATALOG_GZ_FILE})")
+            if SEARCH_INDEX:
+                with METRICS.stage("search_index"):
+                    mode = write_search_index(version, delta, stats["keys"])
+                print(f"🔎 Search index: {SEARCH_INDEX_FILE} {mode} ({os.path.getsize(SEARCH_INDEX_FILE)} bytes)")
+            catalog_state["version"] = version
+            catalog_state["source_status"] = source_status
+            catalog_state.pop("pending_version", None)
+            save_state(state)
+        else:
+            print("💤 Catalog unchanged, leaving outputs untouched")
+
+        # The publish time sizes the next run's budget reserve
+        BUDGET.finish(state, time.monotonic() - publish_started)
+        save_state(state)
         
         print("=" * 60)
         print("🎉 SUCCESS!")
-        print(f"📊 Total entries: {len(combined)}")
-        print(f"   • TMDb movies: {len(tmdb_movies)}")
-        print(f"   • TVMaze shows: {len(tvmaze_shows)}")
-        print(f"   • Wikidata movies: {len(wikidata_movies)}")
+        print(f"📊 Total entries: {stats['total_entries']} ({total_fetched} fetched this run)")
+        print(f"   • TMDb movies: {breakdown['tmdb_movies']}")
+        print(f"   • TMDb TV: {breakdown['tmdb_tv']}")
+        print(f"   • TVMaze shows: {breakdown['tvmaze_shows']}")
+        print(f"   • Wikidata movies: {breakdown['wikidata_movies']}")
+        print(f"   • Merged across sources: {stats['merged_entries']}")
         print()
         print("🎬 TMDb Categories:")
         for category, count in tmdb_categories.items():
             print(f"   • {category.title()}: {count} movies")
+        print("⏱️ Source wall-clock:")
+        for name, seconds in timings.items():
+            print(f"   • {name}: {seconds:.1f}s")
         print(f"⏰ Updated at: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        print("📦 Compressed output: movies.json.gz")
+        print_compression_summary()
+        if BUDGET.seconds:
+            budget = BUDGET.summary()
+            print(f"⏳ Run budget: {budget['elapsed_seconds']:.0f}s of {budget['budget_seconds']}s used"
+                  + (f", deferred to next run: {', '.join(budget['deferred'])}" if budget["deferred"] else "")
+                  + (f", {budget['dropped_details']} queued detail fetches dropped" if budget["dropped_details"] else ""))
+        for name, entry in stale_sources(state).items():
+            print(f"⚠️ {name} is stale since {entry['stale_since']} ({entry.get('error')}), "
+                  f"serving records from its last good run ({entry.get('last_success') or 'never'})")
+        if _http_cache and _http_cache[0] is not None:
+            stats = _http_cache[0].stats
+            print(f"🗄️ HTTP cache: {stats['hits']} hits, {stats['misses']} misses, "
+                  f"{stats['revalidated']} revalidated (304), {stats['evicted']} evicted")
         print("=" * 60)
         
     except Exception as e:
         print(f"❌ Error saving movies.json: {e}")
         print("=" * 60)
+        failed = True
+
+    if not failed:
+        # Journaled records are now part of the catalog, and so are the
+        # partials, which would otherwise be merged again by the next --merge
+        clear_journal()
+        removed = 0
+        for path in merged_partials:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError as e:
+                print(f"[MERGE] Could not remove {path}: {e}")
+        if removed:
+            print(f"[MERGE] Removed {removed} merged partial spool(s)")
+
+    close_catalog_store()
+    snapshot = write_run_metrics({"mode": "merge" if args.merge is not None else "crawl",
+                                  "fetched": total_fetched, "total_entries": total_entries,
+                                  "compression": COMPRESSION_STATS, "budget": BUDGET.summary(),
+                                  "refresh": REFRESH_STATS, "circuits": circuit_summary(),
+                                  "stale_sources": sorted(stale_sources(state))})
+    totals = snapshot["totals"]
+    print(f"📈 Metrics: {totals['requests']} requests ({totals['requests_per_second']}/s), "
+          f"{totals['retries']} retries, {totals['errors']} errors, {totals['bytes'] / 1e6:.1f} MB "
+          f"-> {RUN_METRICS_FILE}, {METRICS_PROM_FILE}")
+
+    close_http_cache()
+    if failed and args.merge is not None:
+        # Keeps CI from publishing (and the partials from being dropped) after a failed merge
+        sys.exit(1)
 
 
 if __name__ == "__main__":